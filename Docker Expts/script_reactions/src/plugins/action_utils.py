@@ -0,0 +1,109 @@
+r"""
+Helpers for plugins receiving Slack block actions through SlackV3BlocksExtension
+(see slackv3_blocks_extension.py).
+
+A plugin registers the action_ids or block_ids it owns, and each action is then
+routed to its owner only:
+
+    class MyPlugin(BotPlugin):
+        ACTION_IDS = ('submit_button', 'form_*')      # for its handle_block_action
+        BLOCK_IDS = (re.compile(r'poll_\d+'),)
+
+        @block_action('vote_*', block_ids=('ballot_block',))   # or per handler
+        def handle_vote(self, action_id, value, payload, message):
+            ...
+
+An id ending with '*' registers a prefix and a compiled regular expression a
+pattern. An action goes to the handler of its exact action_id, else of its
+exact block_id, else of the longest matching action_id then block_id prefix,
+else of the first matching pattern. A handle_block_action without registrations
+keeps getting every action.
+"""
+
+import re
+
+PREFIX = '*'
+ACTION_ID = 'action_id'
+BLOCK_ID = 'block_id'
+
+
+def block_action(*action_ids, block_ids=()):
+    """Register a method as the handler(action_id, value, payload, message) of these action_ids and block_ids."""
+    def decorator(handler):
+        handler._action_ids = tuple(action_ids)
+        handler._block_ids = tuple(block_ids)
+        return handler
+    return decorator
+
+
+def declared_handlers(plugin):
+    """The (method name, action_ids, block_ids) registrations of plugin."""
+    declared = []
+    seen = set()
+    for klass in type(plugin).__mro__:
+        for name, member in vars(klass).items():
+            if name in seen or not hasattr(member, '_action_ids'):
+                continue
+            seen.add(name)
+            declared.append((name, member._action_ids, member._block_ids))
+    action_ids = getattr(plugin, 'ACTION_IDS', ())
+    block_ids = getattr(plugin, 'BLOCK_IDS', ())
+    if (action_ids or block_ids) and 'handle_block_action' not in seen:
+        declared.append(('handle_block_action', tuple(action_ids), tuple(block_ids)))
+    return declared
+
+
+class ActionRouter:
+    """
+    Index of the registrations of the active plugins, routing an action to one handler.
+    """
+
+    def __init__(self):
+        self._exact = {ACTION_ID: {}, BLOCK_ID: {}}
+        self._prefixes = {ACTION_ID: {}, BLOCK_ID: {}}
+        self._longest = {ACTION_ID: -1, BLOCK_ID: -1}
+        self._patterns = []
+
+    def __len__(self):
+        registrations = list(self._exact.values()) + list(self._prefixes.values())
+        return sum(len(ids) for ids in registrations) + len(self._patterns)
+
+    def add(self, kind, registration, handler):
+        """
+        Register handler for an action_id or block_id (kind) registration.
+        Returns the handler already owning it, which is kept, or None.
+        """
+        if isinstance(registration, re.Pattern):
+            for other_kind, pattern, owner in self._patterns:
+                if other_kind == kind and pattern.pattern == registration.pattern:
+                    return owner
+            self._patterns.append((kind, registration, handler))
+            return None
+        if registration.endswith(PREFIX):
+            ids = self._prefixes[kind]
+            registration = registration[:-len(PREFIX)]
+            self._longest[kind] = max(self._longest[kind], len(registration))
+        else:
+            ids = self._exact[kind]
+        owner = ids.setdefault(registration, handler)
+        return None if owner is handler else owner
+
+    def route(self, action):
+        """The handler of action, or None when nobody registered it."""
+        ids = ((ACTION_ID, action.get('action_id')), (BLOCK_ID, action.get('block_id')))
+        for kind, value in ids:
+            if value is not None and value in self._exact[kind]:
+                return self._exact[kind][value]
+        for kind, value in ids:
+            prefixes = self._prefixes[kind]
+            if value is None or not prefixes:
+                continue
+            for end in range(min(len(value), self._longest[kind]), -1, -1):
+                handler = prefixes.get(value[:end])
+                if handler is not None:
+                    return handler
+        for kind, pattern, handler in self._patterns:
+            value = action.get(kind)
+            if value is not None and pattern.match(value):
+                return handler
+        return None
@@ -0,0 +1,158 @@
+"""
+Deferred processing of the Slack events (see slackv3_reactions_extension.py and
+slackv3_blocks_extension.py).
+
+The extensions acknowledge an event straight away and queue its handlers as a
+job on the event workers (see event_executor.py). While a handler runs,
+current_job() gives it the job of its event, which can show progress in the
+thread of the event:
+
+    job = current_job()
+    if job is not None:
+        job.working("⏳ Creating the ticket…")   # placeholder posted right away
+    ...                                         # slow work
+    job.reply("✅ Created MOCK-OPS-123")         # replaces the placeholder
+
+A placeholder left when the job ends is removed. A handler still running on
+its own when the event is done (see handler_guard.py) holds the job open, it
+ends when the last holder releases it, and only then are the when_finished()
+callbacks run, e.g. acknowledging the event and releasing its conversation.
+"""
+
+import logging
+import threading
+
+WORKING_TEXT = "⏳ Working…"
+FAILED_TEXT = "❌ Something went wrong while handling this, please try again."
+
+log = logging.getLogger('errbot.plugins.deferred_jobs')
+
+_local = threading.local()
+
+
+def current_job():
+    """The job of the event being handled by this thread, or None."""
+    return getattr(_local, 'job', None)
+
+
+class Job:
+    """
+    The deferred handling of one event, replying in its channel and thread.
+    """
+
+    def __init__(self, slack_client, channel, thread_ts=None):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.placeholder_ts = None
+        self._holders = 0
+        self._failed = False
+        self._finished = False
+        self._on_finished = []
+        self._lock = threading.Lock()
+
+    def working(self, text=WORKING_TEXT):
+        """Post a placeholder in the thread, replaced by the next reply of the job."""
+        if self.placeholder_ts is not None or not self.slack_client or not self.channel:
+            return
+        try:
+            response = self.slack_client.chat_postMessage(channel=self.channel, text=text, thread_ts=self.thread_ts)
+            self.placeholder_ts = response.get('ts')
+        except Exception as e:
+            log.error(f"Failed to post placeholder in {self.channel}: {e}")
+
+    def reply(self, text, blocks=None):
+        """Post in the thread, in place of the placeholder if there is one. Returns whether it was sent."""
+        if not self.slack_client or not self.channel:
+            return False
+        try:
+            if self.placeholder_ts is not None:
+                self.slack_client.chat_update(channel=self.channel, ts=self.placeholder_ts, text=text, blocks=blocks or [])
+                self.placeholder_ts = None
+            else:
+                self.slack_client.chat_postMessage(channel=self.channel, text=text, blocks=blocks, thread_ts=self.thread_ts)
+            return True
+        except Exception as e:
+            log.error(f"Failed to reply in {self.channel}: {e}")
+            return False
+
+    def finish(self, failed=False):
+        """Clean the placeholder up: removed if the job did not reply, an error if it failed."""
+        if self.placeholder_ts is None:
+            return
+        if failed:
+            self.reply(FAILED_TEXT)
+            return
+        try:
+            self.slack_client.chat_delete(channel=self.channel, ts=self.placeholder_ts)
+        except Exception as e:
+            log.error(f"Failed to remove placeholder in {self.channel}: {e}")
+        self.placeholder_ts = None
+
+    def adopt_thread(self, thread_ts):
+        """Reply in thread_ts instead, e.g. the root of a reacted reply. Only before a placeholder is posted."""
+        if self.placeholder_ts is None:
+            self.thread_ts = thread_ts
+
+    def hold(self):
+        """Keep the job open until the matching release()."""
+        with self._lock:
+            self._holders += 1
+
+    def release(self, failed=False):
+        """Release a hold, finishing the job once nothing holds it."""
+        with self._lock:
+            self._holders -= 1
+            self._failed = self._failed or failed
+            if self._holders:
+                return
+            failed = self._failed
+        self.finish(failed)
+        with self._lock:
+            self._finished = True
+            callbacks, self._on_finished = self._on_finished, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def when_finished(self, callback):
+        """Call callback() once the job is finished, right away if it already is."""
+        with self._lock:
+            if not self._finished:
+                self._on_finished.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            log.error(f"Error in a callback of the job of {self.channel}: {e}")
+
+    def for_thread(self, channel, thread_ts):
+        """Whether a reply to this channel and thread belongs to the job."""
+        return (channel, thread_ts) == (self.channel, self.thread_ts)
+
+
+def run_as(job, fn, *args):
+    """Run fn(*args) on this thread with job as its current job, leaving the job open."""
+    previous = current_job()
+    _local.job = job
+    try:
+        return fn(*args)
+    finally:
+        _local.job = previous
+
+
+def run_job(job, fn, *args):
+    """Run fn(*args) as job, making it the current job of the thread."""
+    _local.job = job
+    job.hold()
+    failed = False
+    try:
+        return fn(*args)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _local.job = None
+        job.release(failed)
@@ -0,0 +1,131 @@
+"""
+Deduplication of the Slack events redelivered when their acknowledgement was
+slow (see slackv3_reactions_extension.py and slackv3_blocks_extension.py).
+
+Each event is identified by its event_id (Events API), envelope_id (socket
+mode) or trigger_id (interactive payloads) and is only run the first time it
+is seen during the window. Ids are kept in memory, bounded by max_entries, and
+can be shared across replicas through Redis so that each event runs once per
+cluster. Configured with the 'dedup' entry of SLACK_EVENTS_CONFIG:
+
+    SLACK_EVENTS_CONFIG = {
+        'dedup': {
+            'window': 600,                      # seconds an id is remembered
+            'max_entries': 10000,               # ids remembered in memory
+            'redis_url': 'redis://redis:6379/0' # optional, shared window
+        },
+    }
+"""
+
+import collections
+import logging
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+DEFAULT_WINDOW = 600
+DEFAULT_MAX_ENTRIES = 10000
+REDIS_PREFIX = 'errbot-slack-event'
+
+log = logging.getLogger('errbot.plugins.event_dedup')
+
+_window = None
+_window_lock = threading.Lock()
+
+
+def event_id(payload):
+    """The id Slack gives to every delivery of this event, or None."""
+    for field in ('event_id', 'envelope_id', 'trigger_id'):
+        value = payload.get(field)
+        if value:
+            return value
+    # Block actions without trigger_id: the user and time of their actions
+    actions = payload.get('actions') or ()
+    stamps = [action.get('action_ts') for action in actions if action.get('action_ts')]
+    if stamps:
+        return f"{(payload.get('user') or {}).get('id')}:{':'.join(stamps)}"
+    return None
+
+
+class DedupWindow:
+    """
+    The ids seen during the last window seconds, in memory and optionally in Redis.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, max_entries=DEFAULT_MAX_ENTRIES, redis_url=None):
+        self.window = window
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # id -> expiry, oldest first
+        self._seen = collections.OrderedDict()
+        self._stats = collections.Counter()
+        self._redis = None
+        if redis_url:
+            if redis is None:
+                log.warning("redis is not installed, Slack events are deduplicated per process only")
+            else:
+                self._redis = redis.StrictRedis.from_url(redis_url)
+
+    def first_seen(self, id_):
+        """Record id_ and return whether it had not been seen during the window."""
+        now = time.monotonic()
+        with self._lock:
+            if self._seen.get(id_, 0) > now:
+                self._stats['duplicates'] += 1
+                return False
+            self._seen.pop(id_, None)
+            # Forget the expired ids, and the oldest ones over max_entries
+            while self._seen:
+                oldest, expires = next(iter(self._seen.items()))
+                if expires > now and len(self._seen) < self.max_entries:
+                    break
+                del self._seen[oldest]
+            self._seen[id_] = now + self.window
+        if self._redis is not None:
+            try:
+                if not self._redis.set(f"{REDIS_PREFIX}:{id_}", 1, nx=True, ex=self.window):
+                    # Already run by another replica
+                    with self._lock:
+                        self._stats['duplicates'] += 1
+                        self._stats['remote_duplicates'] += 1
+                    return False
+            except redis.RedisError as e:
+                # Run it rather than lose it, this replica has not seen it
+                log.warning(f"Could not check event {id_} in Redis: {e}")
+                with self._lock:
+                    self._stats['redis_errors'] += 1
+        with self._lock:
+            self._stats['unique'] += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'remembered': len(self._seen), 'window': self.window, 'shared': self._redis is not None})
+            return stats
+
+
+def get_dedup_window(bot_config=None):
+    """The window shared by the Slack extensions, created from SLACK_EVENTS_CONFIG on first use."""
+    global _window
+    with _window_lock:
+        if _window is None:
+            config = (getattr(bot_config, 'SLACK_EVENTS_CONFIG', None) or {}).get('dedup') or {}
+            _window = DedupWindow(
+                window=config.get('window', DEFAULT_WINDOW),
+                max_entries=config.get('max_entries', DEFAULT_MAX_ENTRIES),
+                redis_url=config.get('redis_url'),
+            )
+        return _window
+
+
+def is_duplicate(bot_config, payload):
+    """Whether this delivery of payload is a redelivery of an event already run."""
+    id_ = event_id(payload)
+    if id_ is None:
+        return False
+    return not get_dedup_window(bot_config).first_seen(id_)
@@ -0,0 +1,233 @@
+"""
+Execution of the Slack event handlers off the socket-mode receive thread (see
+slackv3_reactions_extension.py and slackv3_blocks_extension.py).
+
+Events are run by a bounded pool of worker threads. The events of one
+conversation (channel and thread) run one at a time in their arrival order,
+the events of different conversations run in parallel. A conversation is only
+held by a worker while it has events, and goes back to the end of the queue
+after each of them, so a slow thread cannot hog the pool. A task can keep its
+conversation held past its return with hold_current(), e.g. for a handler left
+running on its own (see handler_guard.py): the next events of the conversation
+wait for it, without taking a worker.
+
+The pool is configured with the SLACK_EVENTS_CONFIG dict of config.py:
+
+    SLACK_EVENTS_CONFIG = {
+        'workers': 8,               # handler threads
+        'max_pending': 1000,        # queued events, over it the receive thread waits...
+        'submit_timeout': 2.0,      # ...this long for room before dropping the event
+        'max_pending_per_key': 50,  # queued events of one conversation, over it they are dropped
+    }
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_MAX_PENDING_PER_KEY = 50
+DEFAULT_SUBMIT_TIMEOUT = 2.0
+
+log = logging.getLogger('errbot.plugins.event_executor')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_local = threading.local()
+
+
+def conversation_key(channel, thread_ts=None, ts=None):
+    """The ordering key of an event: its channel and thread, or its message outside threads."""
+    return f"{channel}:{thread_ts or ts or ''}"
+
+
+class _Running:
+    """A task being run, done once it returned and nothing holds its conversation."""
+
+    __slots__ = ('key', 'returned', 'holds')
+
+    def __init__(self, key):
+        self.key = key
+        self.returned = False
+        self.holds = 0
+
+
+class KeyedExecutor:
+    """
+    Bounded worker pool running the tasks of a key in submission order.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING,
+                 max_pending_per_key=DEFAULT_MAX_PENDING_PER_KEY, submit_timeout=DEFAULT_SUBMIT_TIMEOUT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_pending_per_key = max_pending_per_key
+        self.submit_timeout = submit_timeout
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        # key -> deque of (submitted at, fn, args) of the keys with pending or running tasks
+        self._tasks = {}
+        # keys with pending tasks and no running one, each at most once
+        self._ready = queue.Queue()
+        self._pending = 0
+        self._busy = 0
+        # conversations held by a task that returned
+        self._held = 0
+        self._stats = collections.Counter()
+        self._max_wait = 0.0
+        self._max_depth = 0
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=f'slack-events-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, fn, *args, block=False):
+        """
+        Queue fn(*args) after the tasks already queued for key. When the pool is
+        full, wait up to submit_timeout for room. Returns False if the task was dropped.
+        With block, wait for room as long as needed instead, also when the
+        conversation is full: the backpressure of the queue consumer.
+        """
+        with self._lock:
+            tasks = self._tasks.get(key)
+            if block:
+                if self._full(key):
+                    self._stats['throttled'] += 1
+                    while self._full(key):
+                        self._room.wait()
+                    tasks = self._tasks.get(key)
+            elif tasks is not None and len(tasks) >= self.max_pending_per_key:
+                self._stats['dropped_key_full'] += 1
+                log.warning(f"Dropping event of {key}: {len(tasks)} events of this conversation are pending")
+                return False
+            elif self._pending >= self.max_pending:
+                self._stats['throttled'] += 1
+                deadline = time.monotonic() + self.submit_timeout
+                while self._pending >= self.max_pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._room.wait(remaining):
+                        self._stats['dropped_full'] += 1
+                        log.warning(f"Dropping event of {key}: {self._pending} events are pending")
+                        return False
+                tasks = self._tasks.get(key)
+            if tasks is None:
+                tasks = self._tasks[key] = collections.deque()
+                self._ready.put(key)
+            tasks.append((time.monotonic(), fn, args))
+            self._pending += 1
+            self._max_depth = max(self._max_depth, self._pending)
+            self._stats['submitted'] += 1
+            return True
+
+    def _full(self, key):
+        tasks = self._tasks.get(key)
+        return self._pending >= self.max_pending or (tasks is not None and len(tasks) >= self.max_pending_per_key)
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                submitted, fn, args = self._tasks[key][0]
+                self._busy += 1
+            running = _local.running = _Running(key)
+            started = time.monotonic()
+            try:
+                fn(*args)
+                outcome = 'completed'
+            except Exception as e:
+                log.error(f"Error running event of {key}: {e}")
+                outcome = 'failed'
+            finally:
+                _local.running = None
+            finished = time.monotonic()
+            with self._lock:
+                running.returned = True
+                self._busy -= 1
+                self._stats[outcome] += 1
+                self._stats['wait_ms'] += int((started - submitted) * 1000)
+                self._stats['run_ms'] += int((finished - started) * 1000)
+                self._max_wait = max(self._max_wait, started - submitted)
+                if running.holds:
+                    # Done by the last release, the worker moves on to another conversation
+                    self._held += 1
+                    self._stats['deferred'] += 1
+                else:
+                    self._done(key)
+
+    def _done(self, key):
+        tasks = self._tasks[key]
+        tasks.popleft()
+        if tasks:
+            # The next event of the conversation, after the other conversations
+            self._ready.put(key)
+        else:
+            del self._tasks[key]
+        self._pending -= 1
+        # Waiters for room in the pool and in this conversation
+        self._room.notify_all()
+
+    def hold_current(self):
+        """
+        Keep the conversation of the task running on this thread held after it
+        returns, until the release() returned is called, from any thread. None
+        outside a task.
+        """
+        running = getattr(_local, 'running', None)
+        if running is None:
+            return None
+        with self._lock:
+            running.holds += 1
+        released = False
+
+        def release():
+            nonlocal released
+            with self._lock:
+                if released:
+                    return
+                released = True
+                running.holds -= 1
+                if running.returned and not running.holds:
+                    self._held -= 1
+                    self._done(running.key)
+
+        return release
+
+    def stats(self):
+        """Queue depth, activity and counters of the pool since it started."""
+        with self._lock:
+            stats = dict(self._stats)
+            done = stats.get('completed', 0) + stats.get('failed', 0)
+            stats.update({
+                'workers': self.workers,
+                'busy': self._busy,
+                'held': self._held,
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'max_depth': self._max_depth,
+                'conversations': len(self._tasks),
+                'avg_wait_ms': stats.get('wait_ms', 0) / done if done else 0.0,
+                'avg_run_ms': stats.get('run_ms', 0) / done if done else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+            })
+            return stats
+
+
+def get_event_executor(bot_config=None):
+    """The executor shared by the Slack extensions, created from SLACK_EVENTS_CONFIG on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            config = getattr(bot_config, 'SLACK_EVENTS_CONFIG', None) or {}
+            _executor = KeyedExecutor(
+                workers=config.get('workers', DEFAULT_WORKERS),
+                max_pending=config.get('max_pending', DEFAULT_MAX_PENDING),
+                max_pending_per_key=config.get('max_pending_per_key', DEFAULT_MAX_PENDING_PER_KEY),
+                submit_timeout=config.get('submit_timeout', DEFAULT_SUBMIT_TIMEOUT),
+            )
+            log.info(f"Started {_executor.workers} Slack event workers")
+        return _executor
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Receiver of the Slack Events API and interactivity requests, an alternative to
+Socket Mode that lets several replicas share the events behind a Service (see
+slack_router.py).
+
+An asyncio (aiohttp) server verifies the signature of each request and
+acknowledges it straight away. The payload then goes to the same dispatch path
+as the socket-mode events, the backend's _generic_wrapper, on a thread so the
+response never waits for it. Redeliveries (X-Slack-Retry-Num) are
+deduplicated there as any event. Configured with the 'http' entry of
+SLACK_EVENTS_CONFIG, the signing secret defaulting to $SLACK_SIGNING_SECRET:
+
+    SLACK_EVENTS_CONFIG = {
+        'http': {'host': '0.0.0.0', 'port': 3000, 'signing_secret': '...'},
+    }
+
+Point the Event Subscriptions and Interactivity request URLs of the Slack app
+to https://<host>/slack/events. A signed synthetic request can be sent locally
+with:
+
+    python events_http.py --secret $SLACK_SIGNING_SECRET http://localhost:3000/slack/events event.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 3000
+EVENTS_PATH = '/slack/events'
+HEALTH_PATH = '/healthz'
+# Requests older than this are rejected, against replays
+MAX_REQUEST_AGE = 300
+SIGNATURE_VERSION = 'v0'
+
+log = logging.getLogger('errbot.plugins.events_http')
+
+
+def sign(signing_secret, timestamp, body):
+    """The X-Slack-Signature of a request body sent at timestamp."""
+    base = b':'.join((SIGNATURE_VERSION.encode(), str(timestamp).encode(), body))
+    digest = hmac.new(signing_secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+    return f'{SIGNATURE_VERSION}={digest}'
+
+
+def verify_signature(signing_secret, timestamp, body, signature, now=None):
+    """Whether the request was signed by Slack with signing_secret, recently."""
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+    if age > MAX_REQUEST_AGE or not signature:
+        return False
+    return hmac.compare_digest(sign(signing_secret, timestamp, body), signature)
+
+
+def parse_payload(content_type, body):
+    """The payload of an Events API (JSON) or interactivity (form with a payload field) request."""
+    if content_type == 'application/x-www-form-urlencoded':
+        form = urllib.parse.parse_qs(body.decode('utf-8'))
+        return json.loads(form['payload'][0])
+    return json.loads(body)
+
+
+class EventsServer:
+    """
+    The HTTP receiver, serving from its own thread and event loop.
+    """
+
+    def __init__(self, feed, signing_secret, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        if web is None:
+            raise RuntimeError("aiohttp is not installed, it is needed to receive the Slack events over HTTP")
+        self.feed = feed
+        self.signing_secret = signing_secret
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def _app(self):
+        app = web.Application()
+        app.router.add_post(EVENTS_PATH, self._receive)
+        app.router.add_get(HEALTH_PATH, self._health)
+        return app
+
+    async def _health(self, request):
+        return web.Response(text='ok')
+
+    async def _receive(self, request):
+        body = await request.read()
+        headers = request.headers
+        if not verify_signature(self.signing_secret, headers.get('X-Slack-Request-Timestamp'), body,
+                                headers.get('X-Slack-Signature')):
+            log.warning(f"Rejected an unsigned or stale request from {request.remote}")
+            return web.Response(status=401)
+        try:
+            payload = parse_payload(request.content_type, body)
+        except (ValueError, KeyError) as e:
+            log.warning(f"Rejected a malformed request: {e}")
+            return web.Response(status=400)
+        if payload.get('type') == 'url_verification':
+            return web.json_response({'challenge': payload.get('challenge')})
+        # Acknowledged now, dispatched without the response waiting for it
+        future = self.loop.run_in_executor(None, self.feed, payload)
+        future.add_done_callback(self._fed)
+        return web.Response(status=200)
+
+    @staticmethod
+    def _fed(future):
+        if future.exception() is not None:
+            log.error(f"Error dispatching a Slack event received over HTTP: {future.exception()}")
+
+    def _serve(self):
+        asyncio.set_event_loop(self.loop)
+        runner = web.AppRunner(self._app())
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, self.host, self.port).start())
+        log.info(f"Receiving Slack events on http://{self.host}:{self.port}{EVENTS_PATH}")
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(runner.cleanup())
+            self.loop.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='slack-events-http', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def http_config(bot_config):
+    """The 'http' entry of SLACK_EVENTS_CONFIG, empty when the events only come from Socket Mode."""
+    return (getattr(bot_config, 'SLACK_EVENTS_CONFIG', None) or {}).get('http') or {}
+
+
+def start_events_server(bot_config, feed):
+    """Start the receiver configured in SLACK_EVENTS_CONFIG, feeding payloads to feed(), or return None."""
+    config = http_config(bot_config)
+    if not config:
+        return None
+    signing_secret = config.get('signing_secret') or os.environ.get('SLACK_SIGNING_SECRET')
+    if not signing_secret:
+        log.error("No signing secret for the Slack events HTTP receiver, not starting it")
+        return None
+    server = EventsServer(feed, signing_secret, config.get('host', DEFAULT_HOST), config.get('port', DEFAULT_PORT))
+    server.start()
+    return server
+
+
+def send_signed(url, signing_secret, payload, interactive=False):
+    """Send payload to the receiver at url the way Slack does. Returns the status and the response body."""
+    if interactive:
+        body = urllib.parse.urlencode({'payload': json.dumps(payload)}).encode('utf-8')
+        content_type = 'application/x-www-form-urlencoded'
+    else:
+        body = json.dumps(payload).encode('utf-8')
+        content_type = 'application/json'
+    timestamp = int(time.time())
+    request = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': content_type,
+        'X-Slack-Request-Timestamp': str(timestamp),
+        'X-Slack-Signature': sign(signing_secret, timestamp, body),
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a signed synthetic Slack request to the events receiver.")
+    parser.add_argument('--secret', default=os.environ.get('SLACK_SIGNING_SECRET'), help="the signing secret")
+    parser.add_argument('--interactive', action='store_true',
+                        help="send it as an interactivity payload (form encoded), default for block_actions")
+    parser.add_argument('url', help=f"e.g. http://localhost:{DEFAULT_PORT}{EVENTS_PATH}")
+    parser.add_argument('payload', help="a JSON file with the event_callback or interactive payload")
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("--secret or $SLACK_SIGNING_SECRET is required")
+    with open(args.payload) as f:
+        payload = json.load(f)
+    interactive = args.interactive or payload.get('type') in ('block_actions', 'interactive_message', 'message_action')
+    status, body = send_signed(args.url, args.secret, payload, interactive)
+    print(status, body)
+
+
+if __name__ == '__main__':
+    main()
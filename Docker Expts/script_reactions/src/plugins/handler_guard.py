@@ -0,0 +1,334 @@
+"""
+Isolation of the plugin handlers called for a Slack event (see
+slackv3_reactions_extension.py and slackv3_blocks_extension.py), so that one
+slow or failing plugin does not hold up the plugins after it.
+
+Each handler runs on the handler pool while the event worker waits for it, up
+to the time budget of its plugin. A handler over budget is left running and
+its plugin is moved to an overflow pool of its own: its next handlers run there
+without being waited for, until one of them completes within budget again.
+The slow plugin then only ever takes its own overflow threads. A handler left
+running holds the job of its event (see deferred_jobs.py), so the next events
+of the conversation wait for it, until it is abandoned after abandon_after
+seconds. Each plugin also has a circuit breaker: after a number of consecutive
+failures or handlers over budget its handlers are skipped for a while, then a
+call is let through to probe it. Configured with the 'handlers' entry of
+SLACK_EVENTS_CONFIG:
+
+    SLACK_EVENTS_CONFIG = {
+        'handlers': {
+            'budget': 10.0,             # seconds a handler is waited for
+            'budgets': {'JiraReactionMocker': 15.0},  # per plugin class
+            'workers': 16,              # handler pool, above the event workers
+            'overflow_workers': 2,      # overflow pool of each plugin over budget
+            'max_overflow': 20,         # handlers pending on the pool of a plugin, over it they are skipped
+            'abandon_after': 300,       # seconds a handler left running holds its event
+            'failures': 5,              # consecutive failures or timeouts tripping the breaker
+            'reset_after': 60,          # seconds the breaker stays open
+        },
+    }
+"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from deferred_jobs import current_job, run_as
+
+# Above the REACTION_DELAY of JiraReactionMocker and its Slack calls
+DEFAULT_BUDGET = 10.0
+DEFAULT_WORKERS = 16
+DEFAULT_OVERFLOW_WORKERS = 2
+DEFAULT_MAX_OVERFLOW = 20
+DEFAULT_ABANDON_AFTER = 300
+DEFAULT_FAILURES = 5
+DEFAULT_RESET_AFTER = 60
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Returned for a handler still running on its own, counted as having handled the event
+DEFERRED = 'deferred'
+
+log = logging.getLogger('errbot.plugins.handler_guard')
+
+_guard = None
+_guard_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    Consecutive failures of a plugin, open for reset_after seconds after too many.
+    """
+
+    def __init__(self, failures=DEFAULT_FAILURES, reset_after=DEFAULT_RESET_AFTER):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.state = CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def allow(self):
+        """Whether a call can go through, letting one through to probe an open breaker once it is due."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.state = HALF_OPEN
+            return True
+        # Half open: the probe is running, the other calls wait for its outcome
+        return self.state == CLOSED
+
+    def succeeded(self):
+        self.state = CLOSED
+        self.consecutive = 0
+
+    def failed(self):
+        """Record a failure, returning whether it opened the breaker."""
+        self.consecutive += 1
+        if self.state == HALF_OPEN or self.consecutive >= self.failures:
+            tripped = self.state != OPEN
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trips += tripped
+            return tripped
+        return False
+
+
+class PluginStats:
+    """Latency and outcomes of the handlers of a plugin."""
+
+    __slots__ = ('calls', 'seconds', 'max_seconds', 'waited', 'errors', 'timeouts', 'overflowed', 'abandoned',
+                 'skipped')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # time the event workers spent waiting for the plugin
+        self.waited = 0.0
+        self.errors = 0
+        self.timeouts = 0
+        self.overflowed = 0
+        self.abandoned = 0
+        self.skipped = 0
+
+
+class _Call:
+    """A handler run by the guard, over budget and done at most once."""
+
+    __slots__ = ('plugin_name', 'method_name', 'budget', 'overflow', 'job', 'overran', 'done', 'released', 'timer')
+
+    def __init__(self, plugin_name, method_name, budget, overflow, job):
+        self.plugin_name = plugin_name
+        self.method_name = method_name
+        self.budget = budget
+        self.overflow = overflow
+        self.job = job
+        self.overran = False
+        self.done = False
+        self.released = False
+        self.timer = None
+
+
+class HandlerGuard:
+    """
+    Runs the plugin handlers with a time budget, an overflow pool and a circuit breaker per plugin.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, budgets=None, workers=DEFAULT_WORKERS,
+                 overflow_workers=DEFAULT_OVERFLOW_WORKERS, max_overflow=DEFAULT_MAX_OVERFLOW,
+                 abandon_after=DEFAULT_ABANDON_AFTER, failures=DEFAULT_FAILURES, reset_after=DEFAULT_RESET_AFTER):
+        self.budget = budget
+        self.budgets = budgets or {}
+        self.overflow_workers = overflow_workers
+        self.max_overflow = max_overflow
+        self.abandon_after = abandon_after
+        self.failures = failures
+        self.reset_after = reset_after
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='slack-handler')
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._stats = {}
+        # plugins whose handlers run on their overflow pool, and their handlers pending there
+        self._overflowing = set()
+        self._overflow_pools = {}
+        self._overflow_pending = collections.Counter()
+
+    def _plugin(self, plugin_name):
+        if plugin_name not in self._stats:
+            self._stats[plugin_name] = PluginStats()
+            self._breakers[plugin_name] = CircuitBreaker(self.failures, self.reset_after)
+        return self._stats[plugin_name], self._breakers[plugin_name]
+
+    def _overflow_pool(self, plugin_name):
+        pool = self._overflow_pools.get(plugin_name)
+        if pool is None:
+            pool = self._overflow_pools[plugin_name] = concurrent.futures.ThreadPoolExecutor(
+                self.overflow_workers, thread_name_prefix=f'slack-overflow-{plugin_name}')
+        return pool
+
+    def call(self, plugin_name, method_name, callback, *args):
+        """
+        Run callback(*args) for plugin_name. Returns its result, DEFERRED when it
+        is left running, or None when it failed or was skipped.
+        """
+        budget = self.budgets.get(plugin_name, self.budget)
+        with self._lock:
+            stats, breaker = self._plugin(plugin_name)
+            overflow = plugin_name in self._overflowing
+            # Before the breaker, so a skipped call does not take the probe of an open breaker
+            if overflow and self._overflow_pending[plugin_name] >= self.max_overflow:
+                stats.skipped += 1
+                log.warning(f"Overflow pool of {plugin_name} full, skipping {plugin_name}.{method_name}")
+                return None
+            if not breaker.allow():
+                stats.skipped += 1
+                return None
+            if overflow:
+                self._overflow_pending[plugin_name] += 1
+                stats.overflowed += 1
+            pool = self._overflow_pool(plugin_name) if overflow else self._pool
+        call = _Call(plugin_name, method_name, budget, overflow, current_job())
+        if call.job is not None:
+            # Released by _run, so the job stays open while a handler left running still uses it
+            call.job.hold()
+        if overflow:
+            # Not waited for: over budget once its time is up, whether it ends or not
+            self._start_timer(call, budget, self._overran)
+            pool.submit(self._run, call, callback, args)
+            return DEFERRED
+        future = pool.submit(self._run, call, callback, args)
+        started = time.perf_counter()
+        try:
+            return future.result(timeout=budget)
+        except concurrent.futures.TimeoutError:
+            self._overran(call)
+            return DEFERRED
+        except Exception:
+            # Logged and recorded by _run
+            return None
+        finally:
+            with self._lock:
+                stats.waited += time.perf_counter() - started
+
+    def _start_timer(self, call, delay, fn):
+        call.timer = threading.Timer(delay, fn, (call,))
+        call.timer.daemon = True
+        call.timer.start()
+
+    def _overran(self, call):
+        """Count a handler still running at the end of its budget, once."""
+        with self._lock:
+            if call.overran or call.done:
+                return
+            call.overran = True
+            stats, breaker = self._plugin(call.plugin_name)
+            stats.timeouts += 1
+            moved = call.plugin_name not in self._overflowing
+            self._overflowing.add(call.plugin_name)
+            tripped = breaker.failed()
+            # Under the lock, so _run cancels it if the handler ends first
+            self._start_timer(call, max(self.abandon_after - call.budget, 0), self._abandon)
+        moving = f", moving {call.plugin_name} to its overflow pool" if moved else ""
+        log.warning(f"{call.plugin_name}.{call.method_name} is over its {call.budget}s budget{moving}")
+        if tripped:
+            log.error(f"Circuit breaker of {call.plugin_name} opened for {breaker.reset_after}s")
+
+    def _abandon(self, call):
+        """Stop holding the job of a handler still running after abandon_after."""
+        with self._lock:
+            if call.done:
+                return
+            self._plugin(call.plugin_name)[0].abandoned += 1
+        log.error(f"{call.plugin_name}.{call.method_name} still running after {self.abandon_after}s, "
+                  f"no longer holding its event")
+        self._release(call, True)
+
+    def _release(self, call, failed):
+        with self._lock:
+            if call.released:
+                return
+            call.released = True
+        if call.job is not None:
+            call.job.release(failed)
+
+    def _run(self, call, callback, args):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return run_as(call.job, callback, *args)
+        except Exception as e:
+            failed = True
+            log.error(f"Error in {call.plugin_name}.{call.method_name}: {e}", exc_info=True)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                call.done = True
+                if call.timer is not None:
+                    call.timer.cancel()
+                stats, breaker = self._plugin(call.plugin_name)
+                stats.calls += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+                if call.overflow:
+                    self._overflow_pending[call.plugin_name] -= 1
+                tripped = False
+                if failed:
+                    stats.errors += 1
+                    # An overrun was already counted by the breaker
+                    if not call.overran:
+                        tripped = breaker.failed()
+                elif not call.overran:
+                    breaker.succeeded()
+                    # Back within budget
+                    self._overflowing.discard(call.plugin_name)
+            self._release(call, failed)
+            if tripped:
+                log.error(f"Circuit breaker of {call.plugin_name} opened for {breaker.reset_after}s")
+
+    def stats(self):
+        """Per plugin: calls, latency, failures and breaker state, the most waited for first."""
+        with self._lock:
+            rows = []
+            for plugin_name, stats in self._stats.items():
+                breaker = self._breakers[plugin_name]
+                rows.append({
+                    'plugin': plugin_name,
+                    'calls': stats.calls,
+                    'avg_ms': stats.seconds * 1000 / stats.calls if stats.calls else 0.0,
+                    'max_ms': stats.max_seconds * 1000,
+                    'waited_ms': stats.waited * 1000,
+                    'errors': stats.errors,
+                    'timeouts': stats.timeouts,
+                    'overflowed': stats.overflowed,
+                    'abandoned': stats.abandoned,
+                    'skipped': stats.skipped,
+                    'breaker': breaker.state,
+                    'trips': breaker.trips,
+                    'overflowing': plugin_name in self._overflowing,
+                })
+            return sorted(rows, key=lambda row: row['waited_ms'], reverse=True)
+
+
+def get_handler_guard(bot_config=None):
+    """The guard shared by the Slack extensions, created from SLACK_EVENTS_CONFIG on first use."""
+    global _guard
+    with _guard_lock:
+        if _guard is None:
+            config = (getattr(bot_config, 'SLACK_EVENTS_CONFIG', None) or {}).get('handlers') or {}
+            _guard = HandlerGuard(
+                budget=config.get('budget', DEFAULT_BUDGET),
+                budgets=config.get('budgets'),
+                workers=config.get('workers', DEFAULT_WORKERS),
+                overflow_workers=config.get('overflow_workers', DEFAULT_OVERFLOW_WORKERS),
+                max_overflow=config.get('max_overflow', DEFAULT_MAX_OVERFLOW),
+                abandon_after=config.get('abandon_after', DEFAULT_ABANDON_AFTER),
+                failures=config.get('failures', DEFAULT_FAILURES),
+                reset_after=config.get('reset_after', DEFAULT_RESET_AFTER),
+            )
+        return _guard
@@ -0,0 +1,221 @@
+"""
+Logging for the hot paths of the Slack extensions, the code run for every
+event (see slackv3_reactions_extension.py and slackv3_blocks_extension.py).
+
+    hot = hot_logger('errbot.plugins.slackv3_blocks_extension')
+    hot.info("Routing %s event", event_type)        # formatted only if emitted
+    hot.debug("Action %s", action_id, sample=10)    # one call in 10
+    hot.trace(payload, "Interactive payload")       # dumped only when traced
+
+Messages are %-formatted lazily, only when the level is enabled and the record
+goes out. Each call site is rate limited to 'rate' records every 'per'
+seconds, the next record emitted there tells how many were suppressed, and can
+be sampled to one call in n. Payloads are only dumped for the channels and
+users traced, from the 'trace' entry or the !slack trace command. The records
+of the file handlers of errbot (BOT_LOG_FILE) are written by a background
+thread from a bounded queue, so the event workers never wait on the disk.
+Configured with the 'logging' entry of SLACK_EVENTS_CONFIG:
+
+    SLACK_EVENTS_CONFIG = {
+        'logging': {
+            'rate': 20,                 # records per call site...
+            'per': 60,                  # ...every this many seconds
+            'trace': ['C0123', 'U0456'],
+            'async_file': True,         # the file handlers behind a queue
+            'queue_size': 10000,        # records waiting to be written, over it they are dropped
+        },
+    }
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+DEFAULT_RATE = 20
+DEFAULT_PER = 60
+DEFAULT_QUEUE_SIZE = 10000
+
+log = logging.getLogger('errbot.plugins.hot_log')
+
+_config = {}
+_traced = set()
+_listener = None
+_setup_lock = threading.Lock()
+
+
+class _CallSite:
+    __slots__ = ('window_start', 'emitted', 'suppressed', 'calls')
+
+    def __init__(self):
+        self.window_start = 0.0
+        self.emitted = 0
+        self.suppressed = 0
+        self.calls = 0
+
+
+class HotLogger:
+    """
+    A logger rate limited and sampled per call site, formatting lazily.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def _admit(self, site, sample):
+        """Whether the call at site is logged, and how many records were suppressed there before it."""
+        now = time.monotonic()
+        rate = _config.get('rate', DEFAULT_RATE)
+        per = _config.get('per', DEFAULT_PER)
+        with self._lock:
+            state = self._sites.get(site)
+            if state is None:
+                state = self._sites[site] = _CallSite()
+            state.calls += 1
+            if sample > 1 and state.calls % sample:
+                return False, 0
+            if now - state.window_start >= per:
+                state.window_start = now
+                state.emitted = 0
+            if state.emitted >= rate:
+                state.suppressed += 1
+                return False, 0
+            state.emitted += 1
+            suppressed, state.suppressed = state.suppressed, 0
+            return True, suppressed
+
+    def _log(self, level, msg, args, sample):
+        if not self.logger.isEnabledFor(level):
+            return
+        caller = sys._getframe(2)
+        admitted, suppressed = self._admit((caller.f_code.co_filename, caller.f_lineno), sample)
+        if not admitted:
+            return
+        if suppressed:
+            msg = f"{msg} (%d similar records suppressed)"
+            args = args + (suppressed,)
+        # stacklevel: the caller of debug()/info()... rather than this module
+        self.logger.log(level, msg, *args, stacklevel=3)
+
+    def debug(self, msg, *args, sample=1):
+        self._log(logging.DEBUG, msg, args, sample)
+
+    def info(self, msg, *args, sample=1):
+        self._log(logging.INFO, msg, args, sample)
+
+    def warning(self, msg, *args, sample=1):
+        self._log(logging.WARNING, msg, args, sample)
+
+    def trace(self, payload, msg, *args):
+        """Dump payload after msg if its channel or user is traced."""
+        if not _traced or not self.logger.isEnabledFor(logging.INFO) or not is_traced(payload):
+            return
+        self.logger.info(f"{msg}: %s", *args, _Dump(payload), stacklevel=2)
+
+
+class _Dump:
+    """A payload serialized only if the record is formatted."""
+
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        return json.dumps(self.payload, indent=2, default=str)
+
+
+def hot_logger(name):
+    return HotLogger(logging.getLogger(name))
+
+
+def _ids(payload):
+    """The channel and user ids of an event or interactive payload."""
+    if not isinstance(payload, dict):
+        return ()
+    ids = []
+    for source in (payload, payload.get('item') or {}):
+        for field in ('channel', 'user'):
+            value = source.get(field)
+            if isinstance(value, dict):
+                value = value.get('id')
+            if value:
+                ids.append(value)
+    return ids
+
+
+def is_traced(payload):
+    """Whether tracing is on for the channel or the user of payload."""
+    return any(id_ in _traced for id_ in _ids(payload))
+
+
+def trace(id_, enabled=True):
+    """Turn payload tracing on or off for a channel or user id."""
+    if enabled:
+        _traced.add(id_)
+    else:
+        _traced.discard(id_)
+
+
+def traced():
+    return sorted(_traced)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records without waiting, dropping them when the queue is full."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Only the message is merged here, the formatting is left to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _async_file_handlers(queue_size):
+    """Move the file handlers of the root logger behind a queue written by a thread."""
+    global _listener
+    root = logging.getLogger()
+    files = [handler for handler in root.handlers if isinstance(handler, logging.FileHandler)]
+    if not files:
+        return
+    records = queue.Queue(queue_size)
+    _listener = logging.handlers.QueueListener(records, *files, respect_handler_level=True)
+    for handler in files:
+        root.removeHandler(handler)
+    root.addHandler(_DroppingQueueHandler(records))
+    _listener.start()
+    # Written out before the process exits
+    atexit.register(_listener.stop)
+    log.info(f"Writing {len(files)} log file(s) from a background thread")
+
+
+def setup_hot_logging(bot_config):
+    """Apply the 'logging' entry of SLACK_EVENTS_CONFIG, once per process."""
+    global _config
+    with _setup_lock:
+        if _config:
+            return
+        _config = dict((getattr(bot_config, 'SLACK_EVENTS_CONFIG', None) or {}).get('logging') or {})
+        _config.setdefault('rate', DEFAULT_RATE)
+        _traced.update(_config.get('trace', ()))
+        if _config.get('async_file', True) and _listener is None:
+            _async_file_handlers(_config.get('queue_size', DEFAULT_QUEUE_SIZE))
+
+
+def dropped_records():
+    """Log records dropped because the file writer was behind."""
+    return _DroppingQueueHandler.dropped
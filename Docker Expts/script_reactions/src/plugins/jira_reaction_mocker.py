@@ -4,6 +4,12 @@ import time
 import re
 import random
 
+from deferred_jobs import current_job
+from hot_log import hot_logger
+from store_utils import batch, get_fields, set_fields
+
+hot = hot_logger('errbot.plugins.JiraReactionMocker')
+
 CLOSURE_FORM_BLOCKS = [
     {
         "type": "section",
@@ -122,10 +128,19 @@ class JiraReactionMocker(BotPlugin):
     Reactions: :jira: (create), :jirainreview: (review), :jiracloseticket: (close), :add2jira: (add comments)
     """
     
+    # Only these reactions are delivered to callback_reaction_added
+    REACTIONS = ('jira', 'jirainreview', 'jiracloseticket', 'add2jira')
+
+    # Only the buttons of the closure and review forms are routed to handle_block_action
+    ACTION_IDS = ('close_ticket_action', 'close_ticket_cancel', 'mark_in_review_action', 'review_cancel')
+
     # Rate limiting configuration
     REACTION_DELAY = 3
     API_RETRY_DELAY = 10
 
+    # Closed tickets, their comments and thread mapping are dropped from storage after this delay
+    CLOSED_TICKET_TTL = 30 * 24 * 3600
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.user_cache = {}  # Cache for user display names
@@ -153,15 +168,12 @@ class JiraReactionMocker(BotPlugin):
     def callback_reaction_added(self, event):
         """Handle Slack reaction_added events."""
         try:
-            self.log.info(f"🎯 Reaction added event: {event}")
+            hot.trace(event, "🎯 Reaction added event")
             
             reaction = event.get('reaction')
-            if reaction not in ['jira', 'jirainreview', 'jiracloseticket', 'add2jira']:
+            if reaction not in self.REACTIONS:
                 return False
             
-            # Add configurable delay to avoid rate limiting
-            time.sleep(self.REACTION_DELAY)
-            
             item = event.get('item', {})
             channel = item.get('channel')
             ts = item.get('ts')
@@ -171,6 +183,9 @@ class JiraReactionMocker(BotPlugin):
                 self.log.warning("Missing channel or timestamp in reaction event")
                 return False
             
+            # Add configurable delay to avoid rate limiting
+            time.sleep(self.REACTION_DELAY)
+            
             # Get message context to determine if it's root or reply
             message_info = self._get_message_info(channel, ts)
             if not message_info:
@@ -187,6 +202,12 @@ class JiraReactionMocker(BotPlugin):
             
             self.log.info(f"Processing {reaction} reaction: is_root={is_root}, thread_ts={thread_ts}, message_ts={ts}")
             
+            # Show the reaction is being handled in the thread the outcome message goes to, replacing it
+            job = current_job()
+            if job is not None:
+                job.adopt_thread(thread_ts)
+                job.working(f"⏳ Processing :{reaction}:…")
+            
             # Route to appropriate handler
             if reaction == 'jira':
                 return self._handle_jira_create(channel, ts, thread_ts, is_root, user_id, message_info)
@@ -251,22 +272,55 @@ class JiraReactionMocker(BotPlugin):
             self.log.error("No Slack client available")
             return None
 
+    def _thread_mapping_key(self, thread_ts):
+        """Storage key mapping a thread to its ticket key."""
+        return f"thread_to_ticket_{thread_ts}"
+
+    def _comments_key(self, ticket_key):
+        """Storage key of the append-only list of comments of a ticket."""
+        return f"{ticket_key}:comments"
+
+    def _load_ticket(self, thread_ts):
+        """
+        Return (ticket_key, ticket_data) for a thread, None for what is missing.
+        Ticket attributes are stored as fields, comments are kept apart and not loaded.
+        """
+        ticket_key = self.get(self._thread_mapping_key(thread_ts))
+        if not ticket_key:
+            return None, None
+        try:
+            ticket_data = get_fields(self, ticket_key)
+        except KeyError:
+            return ticket_key, None
+        if 'comments' in ticket_data:
+            ticket_data = self._migrate_ticket(ticket_key, ticket_data)
+        return ticket_key, ticket_data
+
+    def _migrate_ticket(self, ticket_key, ticket_data):
+        """Split a ticket saved as a single record into its fields and its comments list."""
+        comments = ticket_data.pop('comments') or []
+        comments_key = self._comments_key(ticket_key)
+        with batch(self) as b:
+            b.set_fields(ticket_key, ticket_data, replace=True)
+            b.delete(comments_key)
+            if comments:
+                b.append(comments_key, *comments)
+        self.log.info(f"Migrated ticket {ticket_key} to field storage ({len(comments)} comments)")
+        return ticket_data
+
     def _handle_jira_create(self, channel, ts, thread_ts, is_root, user_id, message_info):
         """Handle :jira: reaction - create mock ticket."""
         try:
             if not is_root:
-                self._post_error_message(channel, ts, "❌ :jira: reaction can only be used on root messages.")
+                self._post_error_message(channel, thread_ts, "❌ :jira: reaction can only be used on root messages.")
                 return True
             
             # Check if ticket already exists for this thread
-            thread_mapping_key = f"thread_to_ticket_{thread_ts}"
-            existing_ticket_key = self.get(thread_mapping_key)
-            
-            if existing_ticket_key:
-                existing_ticket = self.get(existing_ticket_key)
-                if existing_ticket:
-                    self._post_error_message(channel, ts, f"❌ Ticket already exists: {existing_ticket['key']}")
-                    return True
+            thread_mapping_key = self._thread_mapping_key(thread_ts)
+            _, existing_ticket = self._load_ticket(thread_ts)
+            if existing_ticket:
+                self._post_error_message(channel, thread_ts, f"❌ Ticket already exists: {existing_ticket['key']}")
+                return True
             
             # Create mock ticket
             ticket_id = self._generate_ticket_id()
@@ -285,48 +339,45 @@ class JiraReactionMocker(BotPlugin):
                 'created_at': datetime.datetime.now().isoformat(),
                 'channel': channel,
                 'thread_ts': thread_ts,
-                'comments': [],
                 'last_add2jira_ts': None
             }
             
-            # Save ticket to storage using JIRA ticket key
-            self[jira_ticket_key] = ticket_data
-            # Create thread mapping for lookup
-            self[thread_mapping_key] = jira_ticket_key
+            # Save ticket (keyed by JIRA ticket key) and thread mapping in one transaction
+            with batch(self) as b:
+                b.set_fields(jira_ticket_key, ticket_data, replace=True)
+                b.set(thread_mapping_key, jira_ticket_key)
             
             # Post concise success message
             success_msg = f"✅ Created: {ticket_data['key']} - {ticket_title[:50]}{'...' if len(ticket_title) > 50 else ''}"
-            self._post_success_message(channel, ts, success_msg)
+            self._post_success_message(channel, thread_ts, success_msg)
             self.log.info(f"Created ticket {ticket_data['key']} for thread {thread_ts}")
             return True
             
         except Exception as e:
             self.log.error(f"Error creating JIRA ticket: {e}")
-            self._post_error_message(channel, ts, f"❌ Error creating JIRA ticket: {str(e)}")
+            self._post_error_message(channel, thread_ts, f"❌ Error creating JIRA ticket: {str(e)}")
             return True
 
     def _handle_jira_review(self, channel, ts, thread_ts, is_root, user_id):
         """Handle :jirainreview: reaction - show review form and mark ticket in review."""
         try:
             if not is_root:
-                self._post_error_message(channel, ts, "❌ :jirainreview: can only be used on root messages.")
+                self._post_error_message(channel, thread_ts, "❌ :jirainreview: can only be used on root messages.")
                 return True
             
             # Get existing ticket
-            thread_mapping_key = f"thread_to_ticket_{thread_ts}"
-            ticket_key = self.get(thread_mapping_key)
+            ticket_key, ticket_data = self._load_ticket(thread_ts)
             
             if not ticket_key:
-                self._post_error_message(channel, ts, "❌ No JIRA ticket found in this thread. Create one with :jira: reaction first.")
+                self._post_error_message(channel, thread_ts, "❌ No JIRA ticket found in this thread. Create one with :jira: reaction first.")
                 return True
                 
-            ticket_data = self.get(ticket_key)
             if not ticket_data:
-                self._post_error_message(channel, ts, "❌ JIRA ticket data not found.")
+                self._post_error_message(channel, thread_ts, "❌ JIRA ticket data not found.")
                 return True
             
             if ticket_data['status'] in ['In Review', 'Closed']:
-                self._post_error_message(channel, ts, f"❌ {ticket_data['key']} is already {ticket_data['status'].lower()}.")
+                self._post_error_message(channel, thread_ts, f"❌ {ticket_data['key']} is already {ticket_data['status'].lower()}.")
                 return True
             
             # Show the review form
@@ -341,7 +392,7 @@ class JiraReactionMocker(BotPlugin):
             
             response = self._send_blocks(blocks=review_blocks, text="Enter review summary", channel=channel, thread_ts=ts)
             if not response:
-                self._post_error_message(channel, ts, "❌ Failed to show review form")
+                self._post_error_message(channel, thread_ts, "❌ Failed to show review form")
                 return True
                 
             self.log.info(f"Showed review form for {ticket_data['key']}")
@@ -355,24 +406,22 @@ class JiraReactionMocker(BotPlugin):
         """Handle :jiraticketclose: reaction - show closure form and close ticket."""
         try:
             if not is_root:
-                self._post_error_message(channel, ts, "❌ :jiracloseticket: can only be used on root messages.")
+                self._post_error_message(channel, thread_ts, "❌ :jiracloseticket: can only be used on root messages.")
                 return True
             
             # Get existing ticket
-            thread_mapping_key = f"thread_to_ticket_{thread_ts}"
-            ticket_key = self.get(thread_mapping_key)
+            ticket_key, ticket_data = self._load_ticket(thread_ts)
             
             if not ticket_key:
-                self._post_error_message(channel, ts, "❌ No JIRA ticket found in this thread. Create one with :jira: reaction first.")
+                self._post_error_message(channel, thread_ts, "❌ No JIRA ticket found in this thread. Create one with :jira: reaction first.")
                 return True
                 
-            ticket_data = self.get(ticket_key)
             if not ticket_data:
-                self._post_error_message(channel, ts, "❌ JIRA ticket data not found.")
+                self._post_error_message(channel, thread_ts, "❌ JIRA ticket data not found.")
                 return True
             
             if ticket_data['status'] == 'Closed':
-                self._post_error_message(channel, ts, f"❌ {ticket_data['key']} is already closed.")
+                self._post_error_message(channel, thread_ts, f"❌ {ticket_data['key']} is already closed.")
                 return True
             
             # Show the closure form
@@ -388,7 +437,7 @@ class JiraReactionMocker(BotPlugin):
             
             response = self._send_blocks(blocks=closure_blocks, text="Enter closure summary", channel=channel, thread_ts=ts)
             if not response:
-                self._post_error_message(channel, ts, "❌ Failed to show closure form")
+                self._post_error_message(channel, thread_ts, "❌ Failed to show closure form")
                 return True
                 
             self.log.info(f"Showed closure form for {ticket_data['key']}")
@@ -401,36 +450,34 @@ class JiraReactionMocker(BotPlugin):
             
         except Exception as e:
             self.log.error(f"Error closing ticket: {e}")
-            self._post_error_message(channel, ts, f"❌ Error closing ticket: {str(e)}")
+            self._post_error_message(channel, thread_ts, f"❌ Error closing ticket: {str(e)}")
             return True
 
     def _handle_add2jira(self, channel, ts, thread_ts, is_root, user_id):
         """Handle :add2jira: reaction - add replies as comments."""
         try:
             if is_root:
-                self._post_error_message(channel, ts, "❌ :add2jira: can only be used on replies.")
+                self._post_error_message(channel, thread_ts, "❌ :add2jira: can only be used on replies.")
                 return True
             
             # Get existing ticket
-            thread_mapping_key = f"thread_to_ticket_{thread_ts}"
-            ticket_key = self.get(thread_mapping_key)
+            ticket_key, ticket_data = self._load_ticket(thread_ts)
             
             if not ticket_key:
-                self._post_error_message(channel, ts, "❌ No JIRA ticket found in this thread. Create one with :jira: reaction first.")
+                self._post_error_message(channel, thread_ts, "❌ No JIRA ticket found in this thread. Create one with :jira: reaction first.")
                 return True
                 
-            ticket_data = self.get(ticket_key)
             if not ticket_data:
-                self._post_error_message(channel, ts, "❌ JIRA ticket data not found.")
+                self._post_error_message(channel, thread_ts, "❌ JIRA ticket data not found.")
                 return True
             
             # Get all replies in the thread
             all_replies = self._get_thread_replies(channel, thread_ts)
             if all_replies is None:
-                self._post_error_message(channel, ts, "❌ Could not retrieve thread replies. Check bot permissions or try again.")
+                self._post_error_message(channel, thread_ts, "❌ Could not retrieve thread replies. Check bot permissions or try again.")
                 return True
             elif len(all_replies) == 0:
-                self._post_error_message(channel, ts, "❌ No replies found in this thread to add as comments.")
+                self._post_error_message(channel, thread_ts, "❌ No replies found in this thread to add as comments.")
                 return True
             
             # Determine which replies to add as comments (excluding bot messages)
@@ -448,7 +495,7 @@ class JiraReactionMocker(BotPlugin):
                               and msg.get('user') != self._bot_user_id]  # Exclude bot messages
             
             if not new_replies:
-                self._post_error_message(channel, ts, "❌ No new comments to add (bot messages excluded).")
+                self._post_error_message(channel, thread_ts, "❌ No new comments to add (bot messages excluded).")
                 return True
             
             # Format replies as comments
@@ -471,21 +518,21 @@ class JiraReactionMocker(BotPlugin):
                 }
                 comments.append(comment)
             
-            # Update ticket with new comments
-            ticket_data['comments'].extend(comments)
-            ticket_data['last_add2jira_ts'] = ts
-            self[ticket_key] = ticket_data
+            # Append the new comments and move the marker, without rewriting the ticket
+            with batch(self) as b:
+                b.append(self._comments_key(ticket_key), *comments)
+                b.set_fields(ticket_key, {'last_add2jira_ts': ts})
             
             # Create concise summary
             success_msg = f"✅ Added {len(comments)} comments to {ticket_data['key']}"
-            self._post_success_message(channel, ts, success_msg)
+            self._post_success_message(channel, thread_ts, success_msg)
             
             self.log.info(f"Added {len(comments)} comments to ticket {ticket_data['key']}")
             return True
             
         except Exception as e:
             self.log.error(f"Error adding comments to JIRA: {e}")
-            self._post_error_message(channel, ts, f"❌ Error adding comments to JIRA: {str(e)}")
+            self._post_error_message(channel, thread_ts, f"❌ Error adding comments to JIRA: {str(e)}")
             return True
 
     def _get_thread_replies(self, channel, thread_ts):
@@ -607,6 +654,9 @@ class JiraReactionMocker(BotPlugin):
     def _post_error_message(self, channel, thread_ts, message):
         """Post error message to thread."""
         try:
+            job = current_job()
+            if job is not None and job.for_thread(channel, thread_ts) and job.reply(message):
+                return
             slack_client = self._get_slack_client()
             if slack_client:
                 slack_client.chat_postMessage(
@@ -620,6 +670,9 @@ class JiraReactionMocker(BotPlugin):
     def _post_success_message(self, channel, thread_ts, message):
         """Post success message to thread."""
         try:
+            job = current_job()
+            if job is not None and job.for_thread(channel, thread_ts) and job.reply(message):
+                return
             slack_client = self._get_slack_client()
             if slack_client:
                 slack_client.chat_postMessage(
@@ -674,9 +727,7 @@ class JiraReactionMocker(BotPlugin):
         try:
             self.log.info(f"Handling block action: action_id={action_id}")
             
-            if action_id not in [
-                'close_ticket_action', 'close_ticket_cancel',
-                'mark_in_review_action', 'review_cancel']:
+            if action_id not in self.ACTION_IDS:
                 return
             
             channel = payload.get('channel', {}).get('id')
@@ -719,8 +770,7 @@ class JiraReactionMocker(BotPlugin):
                     return
                 
                 # Get ticket data
-                thread_mapping_key = f"thread_to_ticket_{thread_ts}"
-                ticket_key = self.get(thread_mapping_key)
+                ticket_key, ticket_data = self._load_ticket(thread_ts)
                 
                 if not ticket_key:
                     self._update_message(
@@ -731,7 +781,6 @@ class JiraReactionMocker(BotPlugin):
                     )
                     return
                 
-                ticket_data = self.get(ticket_key)
                 if not ticket_data:
                     self._update_message(
                         blocks=[],
@@ -751,11 +800,17 @@ class JiraReactionMocker(BotPlugin):
                     return
                 
                 # Update ticket with closure info
-                ticket_data['status'] = 'Closed'
-                ticket_data['closed_by'] = user_id
-                ticket_data['closed_at'] = datetime.datetime.now().isoformat()
-                ticket_data['closure_summary'] = closure_summary
-                self[ticket_key] = ticket_data
+                closure = {
+                    'status': 'Closed',
+                    'closed_by': user_id,
+                    'closed_at': datetime.datetime.now().isoformat(),
+                    'closure_summary': closure_summary
+                }
+                with batch(self) as b:
+                    b.set_fields(ticket_key, closure)
+                    for key in (ticket_key, self._comments_key(ticket_key), self._thread_mapping_key(thread_ts)):
+                        b.expire(key, self.CLOSED_TICKET_TTL)
+                ticket_data.update(closure)
                 
                 # Update the message to show mock JIRA closure and summary
                 user_name = self._get_user_display_name(user_id)
@@ -796,8 +851,7 @@ class JiraReactionMocker(BotPlugin):
                     return
                 
                 # Get ticket data
-                thread_mapping_key = f"thread_to_ticket_{thread_ts}"
-                ticket_key = self.get(thread_mapping_key)
+                ticket_key, ticket_data = self._load_ticket(thread_ts)
                 
                 if not ticket_key:
                     self._update_message(
@@ -808,7 +862,6 @@ class JiraReactionMocker(BotPlugin):
                     )
                     return
                 
-                ticket_data = self.get(ticket_key)
                 if not ticket_data:
                     self._update_message(
                         blocks=[],
@@ -828,11 +881,14 @@ class JiraReactionMocker(BotPlugin):
                     return
                 
                 # Update ticket with review info
-                ticket_data['status'] = 'In Review'
-                ticket_data['reviewed_by'] = user_id
-                ticket_data['reviewed_at'] = datetime.datetime.now().isoformat()
-                ticket_data['review_summary'] = review_summary
-                self[ticket_key] = ticket_data
+                review = {
+                    'status': 'In Review',
+                    'reviewed_by': user_id,
+                    'reviewed_at': datetime.datetime.now().isoformat(),
+                    'review_summary': review_summary
+                }
+                set_fields(self, ticket_key, review)
+                ticket_data.update(review)
                 
                 # Update the message to show mock JIRA review and summary
                 user_name = self._get_user_display_name(user_id)
@@ -1,5 +1,9 @@
 from errbot import BotPlugin, botcmd
 import logging
+from hot_log import hot_logger
+from reaction_utils import reactions
+
+hot = hot_logger('errbot.plugins.mypriorlife')
 
 BLOCKS_PRIORLIFE = [
     {
@@ -56,6 +60,9 @@ BLOCKS_PRIORLIFE = [
 ]
 
 class MyPriorLife(BotPlugin):
+    # The form buttons have generic action_ids, so the plugin owns their block instead
+    BLOCK_IDS = ('prior_life_actions_block',)
+
     def activate(self):
         super().activate()
         if 'collected_prior_lives' not in self:
@@ -154,12 +161,8 @@ class MyPriorLife(BotPlugin):
     def handle_block_action(self, action_id, value, payload, message):
         """Handle Slack block interactive actions for prior life form"""
         try:
-            self.log.info("=" * 50)
-            self.log.info("🔥 MYPRIORLIFE HANDLE_BLOCK_ACTION CALLED!")
-            self.log.info(f"MyPriorLife handling block action: action_id={action_id}, value={value}")
-            self.log.info(f"Payload keys: {list(payload.keys()) if payload else 'None'}")
-            self.log.info(f"Full payload: {payload}")
-            self.log.info("=" * 50)
+            hot.info("MyPriorLife handling block action: action_id=%s", action_id)
+            hot.trace(payload, "MyPriorLife block action payload")
             
             if action_id == 'actionId-0':  # Submit button
                 self.log.info("✅ Processing actionId-0 (Submit button)")
@@ -435,6 +438,7 @@ class MyPriorLife(BotPlugin):
             self.log.error(f"Error sending prior life form: {e}")
             return f"Error sending form: {str(e)}"
 
+    @reactions('pl')
     def callback_reaction_added(self, event):
         """
         Respond to :pl: reaction on any message sent by the bot.
@@ -0,0 +1,43 @@
+"""
+Notification of the changes of the set of active plugins, for the Slack
+extensions that precompute their dispatch from it (see
+slackv3_reactions_extension.py and slackv3_blocks_extension.py).
+"""
+
+# Plugin manager methods after which the set of active plugins may have changed.
+PLUGIN_SET_CHANGES = (
+    '_activate_plugin',
+    'activate_plugin',
+    'deactivate_plugin',
+    'deactivate_all_plugins',
+    'reload_plugin_by_name',
+)
+
+
+def watch_plugin_set(manager, listener):
+    """Call listener() after plugins are activated, deactivated or reloaded by manager."""
+    listeners = getattr(manager, '_plugin_set_listeners', None)
+    if listeners is None:
+        listeners = manager._plugin_set_listeners = []
+        for name in PLUGIN_SET_CHANGES:
+            method = getattr(manager, name, None)
+            if method is None:
+                continue
+
+            def watched(*args, _method=method, **kwargs):
+                try:
+                    return _method(*args, **kwargs)
+                finally:
+                    for notify in list(listeners):
+                        notify()
+
+            setattr(manager, name, watched)
+    if listener not in listeners:
+        listeners.append(listener)
+
+
+def unwatch_plugin_set(manager, listener):
+    """Stop calling listener() on the changes of the set of active plugins."""
+    listeners = getattr(manager, '_plugin_set_listeners', [])
+    if listener in listeners:
+        listeners.remove(listener)
@@ -0,0 +1,37 @@
+"""
+Helpers for plugins receiving Slack reactions through SlackV3ReactionsExtension
+(see slackv3_reactions_extension.py).
+
+A plugin declares the reactions it cares about, and only gets the events of
+those emoji:
+
+    class MyPlugin(BotPlugin):
+        REACTIONS = ('jira', 'add2jira')   # for all its reaction callbacks
+
+        @reactions('pl')                   # or per callback, overriding REACTIONS
+        def callback_reaction_added(self, event):
+            ...
+
+A callback without a declaration gets every reaction, as does one subscribed to
+WILDCARD.
+"""
+
+WILDCARD = '*'
+
+
+def reactions(*names):
+    """Subscribe a reaction callback to the given reaction names (without colons)."""
+    def decorator(callback):
+        callback._reactions = frozenset(names)
+        return callback
+    return decorator
+
+
+def subscribed_reactions(plugin, callback):
+    """The reaction names callback of plugin is subscribed to, {WILDCARD} when it takes them all."""
+    names = getattr(callback, '_reactions', None)
+    if names is None:
+        names = getattr(plugin, 'REACTIONS', None)
+    if not names:
+        return frozenset((WILDCARD,))
+    return frozenset(names)
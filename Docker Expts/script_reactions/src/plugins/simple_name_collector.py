@@ -58,6 +58,9 @@ BLOCKS_NAME_COLLECTION = [
 
 class SimpleNameCollector(BotPlugin):
     """A simple name collector plugin that uses direct Slack client access."""
+
+    # Buttons of the name collection form routed to handle_block_action
+    ACTION_IDS = ('submit_name_button', 'cancel_name_button')
     
     def activate(self):
         """Initialize the plugin and set up storage."""
@@ -0,0 +1,316 @@
+"""
+The single entry point of the Slack events, shared by the Slack extensions (see
+slackv3_reactions_extension.py and slackv3_blocks_extension.py).
+
+The router replaces the backend's _generic_wrapper once, whatever the number
+and activation order of the extensions. Each payload is classified a single
+time as a reaction, an interactive payload or any other event. Other events go
+straight to the original wrapper. Reactions and interactive payloads go through
+the middleware chain (metrics, the filters registered with use(), redelivery
+deduplication) and are then queued as jobs on the event workers, in order per
+conversation (see event_executor.py and deferred_jobs.py). A reaction belongs
+to the thread of the reacted message, whose root is remembered from the message
+events seen, or looked up once. In queue mode they
+are published to a durable queue instead, and the jobs run on the replica that
+consumes them (see event_queue.py). Besides Socket Mode, the payloads can be
+received over HTTP from the Events API (see events_http.py).
+
+    router = get_event_router(self._bot)
+    router.route(REACTION, self._handle_reaction_event, locate_reaction)
+    router.use(my_filter)    # my_filter(event, call_next): return call_next(event) to go on
+"""
+
+import collections
+import logging
+import threading
+import time
+import zlib
+
+from deferred_jobs import Job, run_job
+from event_dedup import is_duplicate
+from event_executor import conversation_key, get_event_executor
+from event_queue import decode_event, encode_event, open_event_queue, queue_config
+from events_http import start_events_server
+
+REACTION = 'reaction'
+INTERACTIVE = 'interactive'
+EVENT = 'event'
+
+REACTION_EVENTS = ('reaction_added', 'reaction_removed')
+INTERACTIVE_EVENTS = ('block_actions', 'interactive_message', 'message_action')
+
+# Redeliveries of a queued event of a kind not routed here before it is dead-lettered
+MAX_UNROUTED_REDELIVERIES = 3
+# Messages whose thread root is remembered
+THREAD_ROOTS_SIZE = 10000
+
+log = logging.getLogger('errbot.plugins.slack_router')
+
+_routers_lock = threading.Lock()
+
+
+class SlackEvent:
+    """A payload received from Slack, classified once."""
+
+    __slots__ = ('kind', 'type', 'body', 'payload')
+
+    def __init__(self, kind, type_, body, payload):
+        self.kind = kind
+        # e.g. reaction_added, block_actions
+        self.type = type_
+        # what the handlers get: the inner event of reactions, the payload of interactive events
+        self.body = body
+        self.payload = payload
+
+
+def classify(payload):
+    """Classify a payload as a REACTION, INTERACTIVE or other EVENT."""
+    payload_type = payload.get('type')
+    if payload_type in INTERACTIVE_EVENTS:
+        return SlackEvent(INTERACTIVE, payload_type, payload, payload)
+    event = payload.get('event')
+    if isinstance(event, dict):
+        event_type = event.get('type')
+        if event_type in REACTION_EVENTS:
+            return SlackEvent(REACTION, event_type, event, payload)
+        return SlackEvent(EVENT, event_type, event, payload)
+    return SlackEvent(EVENT, payload_type, payload, payload)
+
+
+class ThreadRoots:
+    """
+    The thread root of recent messages, from the message events and lookups, bounded.
+    """
+
+    def __init__(self, max_entries=THREAD_ROOTS_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (channel, ts) -> ts of the root of its thread, the message itself outside threads
+        self._roots = collections.OrderedDict()
+
+    def remember(self, channel, ts, root):
+        with self._lock:
+            self._roots[(channel, ts)] = root
+            self._roots.move_to_end((channel, ts))
+            while len(self._roots) > self.max_entries:
+                self._roots.popitem(last=False)
+
+    def get(self, channel, ts):
+        with self._lock:
+            return self._roots.get((channel, ts))
+
+
+def _link(middleware, call_next):
+    return lambda event: middleware(event, call_next)
+
+
+class EventRouter:
+    """
+    Routes the events of one backend to the handlers registered per kind.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._original = backend._generic_wrapper
+        self._executor = get_event_executor(backend.bot_config)
+        self._queue = open_event_queue(backend.bot_config)
+        self._consuming = False
+        # kind -> (handler(event_type, body), locate(body) -> (channel, thread_ts, ts))
+        self._routes = {}
+        self._filters = []
+        self._chain = self._build_chain()
+        self._stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self._route_seconds = 0.0
+        # crc32 of the queued events of unrouted kinds -> deliveries
+        self._unrouted_attempts = {}
+        self.thread_roots = ThreadRoots()
+        # The Events API payloads take the same path as the socket-mode ones
+        self._http = start_events_server(backend.bot_config, self)
+
+    def route(self, kind, handler, locate):
+        """Send the events of this kind to handler, as jobs of the conversation locate() finds."""
+        self._routes[kind] = (handler, locate)
+        consume = queue_config(self.backend.bot_config).get('consume', True)
+        if self._queue is not None and not self._consuming and consume:
+            # Once there is a handler to run what is consumed
+            self._consuming = True
+            self._queue.consume(self._consumed)
+
+    def unroute(self, kind, handler):
+        route = self._routes.get(kind)
+        if route is not None and route[0] == handler:
+            del self._routes[kind]
+
+    def use(self, middleware):
+        """Add a filter middleware(event, call_next) to the chain, before deduplication."""
+        self._filters.append(middleware)
+        self._chain = self._build_chain()
+
+    def _build_chain(self):
+        chain = self._dispatch
+        for middleware in reversed([self._metrics] + self._filters + [self._dedup]):
+            chain = _link(middleware, chain)
+        return chain
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def __call__(self, payload):
+        """The replacement of the backend's _generic_wrapper."""
+        event = classify(payload)
+        if event.type == 'message':
+            self._remember_message(event.body)
+        if event.kind not in self._routes:
+            return self._original(payload)
+        self._chain(event)
+        # Acknowledged now, the handlers run as a job
+        return None
+
+    def _remember_message(self, message):
+        channel, ts = message.get('channel'), message.get('ts')
+        if channel and ts:
+            self.thread_roots.remember(channel, ts, message.get('thread_ts') or ts)
+
+    def thread_root(self, channel, ts):
+        """
+        The ts of the root of the thread of message ts, looked up once if it was
+        not seen, or None when it cannot be found.
+        """
+        root = self.thread_roots.get(channel, ts)
+        if root is not None or not channel or not ts:
+            return root
+        slack_client = getattr(self.backend, 'slack_web', None)
+        if slack_client is None:
+            return None
+        try:
+            response = slack_client.conversations_replies(channel=channel, ts=ts, limit=1, inclusive=True)
+        except Exception as e:
+            log.warning(f"Could not look up the thread of {channel}:{ts}: {e}")
+            self._count('thread_lookup_errors')
+            return None
+        self._count('thread_lookups')
+        for message in response.get('messages') or ():
+            if message.get('ts') == ts:
+                root = message.get('thread_ts') or ts
+                self.thread_roots.remember(channel, ts, root)
+                return root
+        return None
+
+    def _metrics(self, event, call_next):
+        started = time.perf_counter()
+        try:
+            return call_next(event)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                self._stats[f'{event.kind}:{event.type}'] += 1
+                self._route_seconds += elapsed
+
+    def _dedup(self, event, call_next):
+        if is_duplicate(self.backend.bot_config, event.payload):
+            log.debug(f"Ignoring redelivered {event.type} event")
+            self._count('redelivered')
+            return None
+        return call_next(event)
+
+    def _dispatch(self, event):
+        handler, locate = self._routes[event.kind]
+        channel, thread_ts, ts = locate(event.body)
+        if self._queue is not None:
+            # Partitioned by conversation, so a single replica runs its events, in order
+            try:
+                self._queue.publish(conversation_key(channel, thread_ts, ts), encode_event(event, channel, thread_ts, ts))
+                self._count('published')
+                return
+            except Exception as e:
+                log.error(f"Could not queue {event.type} event, running it here: {e}")
+                self._count('publish_failed')
+        self._submit(handler, event.type, event.body, channel, thread_ts, ts)
+
+    def _submit(self, handler, event_type, body, channel, thread_ts, ts, ack=None):
+        # Handled off the socket thread, in order with the other events of the conversation
+        job = Job(getattr(self.backend, 'slack_web', None), channel, thread_ts or ts)
+        key = conversation_key(channel, thread_ts, ts)
+        # Consumed from the queue: wait for room, which holds the next deliveries back
+        submitted = self._executor.submit(key, self._run, job, ack, handler, event_type, body, block=ack is not None)
+        self._count('queued' if submitted else 'dropped')
+        return submitted
+
+    def _run(self, job, ack, handler, event_type, body):
+        # Acknowledged, and the next events of the conversation run, once the
+        # handlers left running on their own are done too
+        if ack is not None:
+            job.when_finished(ack)
+        release = self._executor.hold_current()
+        if release is not None:
+            job.when_finished(release)
+        run_job(job, handler, event_type, body)
+
+    def _consumed(self, message, ack, nack):
+        """Run an event delivered by the queue, acknowledging it once handled."""
+        event = decode_event(message)
+        route = self._routes.get(event['kind'])
+        if route is None:
+            self._unrouted(event, message, nack)
+            return
+        if self._unrouted_attempts:
+            with self._stats_lock:
+                self._unrouted_attempts.pop(zlib.crc32(message), None)
+        self._submit(route[0], event['type'], event['body'], event['channel'], event['thread_ts'], event['ts'], ack)
+
+    def _unrouted(self, event, message, nack):
+        # Requeued a few times, e.g. for an extension being activated, then dead-lettered rather than looping
+        id_ = zlib.crc32(message)
+        with self._stats_lock:
+            attempts = self._unrouted_attempts[id_] = self._unrouted_attempts.get(id_, 0) + 1
+            if attempts > MAX_UNROUTED_REDELIVERIES:
+                del self._unrouted_attempts[id_]
+        if attempts <= MAX_UNROUTED_REDELIVERIES:
+            self._count('unrouted_requeued')
+            nack()
+            return
+        log.error(f"No handler for the queued {event['type']} event after {attempts} deliveries, dead-lettering it")
+        self._count('dead_lettered')
+        nack(requeue=False)
+
+    def stats(self):
+        """Events routed per kind and type, redeliveries ignored, average routing time."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+            routed = sum(count for name, count in stats.items() if ':' in name)
+            stats['avg_route_ms'] = self._route_seconds * 1000 / routed if routed else 0.0
+            return stats
+
+    def queue_stats(self):
+        """Counters of the broker in queue mode, None otherwise."""
+        return self._queue.stats() if self._queue is not None else None
+
+    def uninstall(self):
+        if self._queue is not None:
+            self._queue.close()
+        if self._http is not None:
+            self._http.stop()
+        self.backend._generic_wrapper = self._original
+        del self.backend._event_router
+
+
+def get_event_router(backend):
+    """The router of backend, patching its _generic_wrapper on first use."""
+    with _routers_lock:
+        router = getattr(backend, '_event_router', None)
+        if router is None:
+            router = backend._event_router = EventRouter(backend)
+            backend._generic_wrapper = router
+            log.info("Routing the Slack events of the backend")
+        return router
+
+
+def release_event_router(backend):
+    """Restore the backend's _generic_wrapper once no extension routes events anymore."""
+    with _routers_lock:
+        router = getattr(backend, '_event_router', None)
+        if router is not None and not router._routes and not router._filters:
+            router.uninstall()
+            log.info("Restored the Slack backend _generic_wrapper")
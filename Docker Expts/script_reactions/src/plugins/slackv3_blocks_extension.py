@@ -1,6 +1,16 @@
-import json
 import logging
 from errbot import BotPlugin
+from action_utils import ACTION_ID, BLOCK_ID, ActionRouter, declared_handlers
+from handler_guard import DEFERRED, get_handler_guard
+from hot_log import hot_logger, setup_hot_logging
+from plugin_watch import unwatch_plugin_set, watch_plugin_set
+from slack_router import INTERACTIVE, INTERACTIVE_EVENTS, get_event_router, release_event_router
+
+# Callbacks getting the whole payload of an interactive event, besides callback_<event type>
+PAYLOAD_CALLBACKS = ('callback_interactive', 'callback_interactive_component')
+
+# Rate limited logging of the code run for every event
+hot = hot_logger('errbot.plugins.SlackV3BlocksExtension')
 
 
 class SlackV3BlocksExtension(BotPlugin):
@@ -9,73 +19,55 @@ class SlackV3BlocksExtension(BotPlugin):
     to SlackV3 backend via websocket mode.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (action router, unregistered handle_block_action handlers, payload callbacks), None when stale
+        self._routes = None
+        self._client = None
+
     def activate(self):
         """Activate the extension."""
         super().activate()
         self.log.info("Activating SlackV3 Blocks Extension...")
+        setup_hot_logging(self._bot.bot_config)
         self._patch_backend()
+        watch_plugin_set(self._bot.plugin_manager, self._invalidate_routes)
         self.log.info("Extension activated - blocks support available via helper methods")
 
     def deactivate(self):
         """Deactivate the plugin and restore original backend"""
         self._unpatch_backend()
+        unwatch_plugin_set(self._bot.plugin_manager, self._invalidate_routes)
+        self._routes = None
         super().deactivate()
         self.log.info("SlackV3BlocksExtension plugin deactivated")
 
     def send_blocks_to_channel(self, channel, blocks, text=""):
         """Send blocks to a specific channel."""
         try:
-            self.log.info(f"🔵 send_blocks_to_channel called with channel={channel}, text={text}, blocks={len(blocks) if blocks else 0} blocks")
-            
-            # Get the bot instance and check its type
-            bot = self._bot
-            self.log.info(f"Bot type: {type(bot)}")
-            self.log.info(f"Bot attributes: {[attr for attr in dir(bot) if not attr.startswith('_')]}")
-            
+            hot.debug("send_blocks_to_channel: channel=%s, %d blocks", channel, len(blocks) if blocks else 0)
+
             # The bot itself might be the backend or have backend attribute
-            backend = None
-            if hasattr(bot, 'backend'):
-                backend = bot.backend
-                self.log.info(f"Backend type: {type(backend)}")
-            else:
-                # The bot itself might be the backend
-                backend = bot
-                self.log.info(f"Using bot as backend, type: {type(backend)}")
-            
-            self.log.info(f"Backend attributes: {[attr for attr in dir(backend) if not attr.startswith('_')]}")
-            
-            # Try different ways to access the Slack client
-            slack_client = None
-            
-            # Check for web client attributes
-            for attr in ['web_client', 'slack_web', '_slack_client', 'client', 'slack_client', '_web_client']:
-                if hasattr(backend, attr):
-                    client = getattr(backend, attr)
-                    self.log.info(f"Found attribute {attr}: {type(client)}")
-                    if client and hasattr(client, 'chat_postMessage'):
-                        slack_client = client
-                        self.log.info(f"Using {attr} as Slack client")
-                        break
-            
+            backend = getattr(self._bot, 'backend', self._bot)
+            slack_client = self._slack_client(backend)
+
             if slack_client:
-                self.log.info(f"✅ Attempting to send blocks to channel {channel}")
-                self.log.info(f"Blocks to send: {json.dumps(blocks, indent=2) if blocks else 'None'}")
+                hot.trace({'channel': channel, 'blocks': blocks}, "Blocks to send")
                 response = slack_client.chat_postMessage(
                     channel=channel,
                     text=text,
                     blocks=blocks or []
                 )
-                self.log.info(f"✅ Slack API response: {response}")
-                
+
                 # Check if response indicates success
                 if hasattr(response, 'get') and response.get('ok'):
-                    self.log.info("✅ Slack API returned success")
+                    hot.debug("Blocks sent to %s", channel)
                     return response
                 elif hasattr(response, 'status_code') and response.status_code == 200:
-                    self.log.info("✅ HTTP status indicates success")
+                    hot.debug("Blocks sent to %s", channel)
                     return response
                 else:
-                    self.log.warn(f"⚠️ Unclear response status: {response}")
+                    self.log.warning(f"⚠️ Unclear response status: {response}")
                     return response
             else:
                 self.log.error("❌ No Slack client with chat_postMessage method found")
@@ -88,6 +80,18 @@ class SlackV3BlocksExtension(BotPlugin):
             self.log.error(f"Traceback: {traceback.format_exc()}")
             return None
 
+    def _slack_client(self, backend):
+        """The web client of the backend, looked up once."""
+        if self._client is None:
+            # Check for web client attributes
+            for attr in ['web_client', 'slack_web', '_slack_client', 'client', 'slack_client', '_web_client']:
+                client = getattr(backend, attr, None)
+                if client and hasattr(client, 'chat_postMessage'):
+                    self.log.info(f"Using {attr} as Slack client")
+                    self._client = client
+                    break
+        return self._client
+
     def send_blocks_to_message(self, message, blocks, text=""):
         """Send blocks in response to a message."""
         try:
@@ -135,175 +139,134 @@ class SlackV3BlocksExtension(BotPlugin):
             self.log.error(f"Error creating fake message: {e}")
             return None
 
+    @staticmethod
+    def _locate_interactive(payload):
+        """Interactive events are ordered with the other events of their thread."""
+        channel = payload.get('channel') or {}
+        thread_ts = (payload.get('message') or {}).get('thread_ts')
+        message_ts = (payload.get('container') or {}).get('message_ts')
+        return channel.get('id'), thread_ts, message_ts
+
     def _patch_backend(self):
-        """Patch the SlackV3 backend to handle block_actions"""
+        """Route the interactive events of the SlackV3 backend to the plugins"""
         try:
             # In ErrBot, self._bot IS the backend
-            backend = self._bot
-            
-            # Store original method if not already stored
-            if not hasattr(backend, '_original_generic_wrapper'):
-                original_method = getattr(backend, '_generic_wrapper', None)
-                backend._original_generic_wrapper = original_method
-                self.log.info(f"Found original _generic_wrapper: {original_method}")
-            
-            # Create a closure that captures the extension instance
-            extension = self
-            original_wrapper = backend._original_generic_wrapper
-            
-            def patched_wrapper(event_data):
-                return extension._patched_generic_wrapper(backend, event_data, original_wrapper)
-            
-            # Replace the method
-            backend._generic_wrapper = patched_wrapper
-            
-            self.log.info("✅ Successfully patched SlackV3 backend _generic_wrapper to handle interactive events")
-            
-            # Verify the patch is in place
-            current_method = getattr(backend, '_generic_wrapper', None)
-            self.log.info(f"Current _generic_wrapper method after patch: {current_method}")
-            
+            get_event_router(self._bot).route(INTERACTIVE, self._handle_interactive_event, self._locate_interactive)
+            self.log.info("✅ Routing Slack interactive events to plugins")
         except Exception as e:
             self.log.error(f"❌ Failed to patch SlackV3 backend: {e}")
-            # Debug information
-            self.log.error(f"Bot object type: {type(self._bot)}")
-            self.log.error(f"Available methods: {[attr for attr in dir(self._bot) if 'generic' in attr.lower()]}")
             import traceback
             self.log.error(f"Traceback: {traceback.format_exc()}")
 
     def _unpatch_backend(self):
-        """Restore original backend functionality"""
+        """Stop routing interactive events, restoring the backend once no extension uses it"""
         try:
-            backend = self._bot
-            if hasattr(backend, '_original_generic_wrapper'):
-                backend._generic_wrapper = backend._original_generic_wrapper
-                delattr(backend, '_original_generic_wrapper')
-                self.log.info("✅ Successfully restored original SlackV3 backend _generic_wrapper")
+            router = getattr(self._bot, '_event_router', None)
+            if router is not None:
+                router.unroute(INTERACTIVE, self._handle_interactive_event)
+                release_event_router(self._bot)
         except Exception as e:
             self.log.error(f"❌ Failed to unpatch SlackV3 backend: {e}")
 
-    def _patched_generic_wrapper(self, backend, event_data, original_wrapper):
-        """Patched generic event wrapper to handle interactive events"""
-        try:
-            self.log.info(f"🚀 PATCHED _generic_wrapper CALLED! Event data keys: {list(event_data.keys()) if event_data else 'None'}")
-            self.log.debug(f"🔍 Patched wrapper - Full event data: {event_data}")
-            
-            # Check if this is an interactive event (block_actions, etc.)
-            if 'type' in event_data and event_data['type'] in ['block_actions', 'interactive_message', 'message_action']:
-                self.log.info(f"✅ Handling interactive event: {event_data['type']}")
-                interactive_type = event_data['type']
-                result = self._handle_interactive_event(interactive_type, event_data)
-                if result:
-                    return result
-                else:
-                    self.log.info(f"ℹ️ Interactive event {interactive_type} processed but no plugin handled it")
-                    return None
-            
-            # For regular events, use the original logic
-            self.log.info(f"🔄 Processing as regular event")
-            
-            # Call the original _generic_wrapper method
-            if original_wrapper:
-                return original_wrapper(event_data)
-            else:
-                # Fallback to original logic from _generic_wrapper
-                try:
-                    event = event_data["event"]
-                    event_type = event["type"]
+    def _invalidate_routes(self):
+        """Rebuild the routes on the next event, the set of active plugins has changed."""
+        self._routes = None
 
-                    try:
-                        event_handler = getattr(backend, f"_handle_{event_type}")
-                        return event_handler(backend.slack_web, event)
-                    except AttributeError:
-                        self.log.debug(f"Event type {event_type} not supported.")
-                except KeyError:
-                    # This is where the "Ignoring unsupported Slack event!" used to come from
-                    # But now we've already handled interactive events above
-                    self.log.debug("Event has no 'event' key - might be a different event structure")
-                    self.log.debug(f"Event structure: {event_data}")
-            
-        except Exception as e:
-            self.log.error(f"❌ Error in patched generic wrapper: {e}")
-            import traceback
-            self.log.error(f"Traceback: {traceback.format_exc()}")
-        
-        return None
+    def _build_routes(self):
+        """Index the action_id and block_id registrations and the callbacks of the active plugins."""
+        router = ActionRouter()
+        unregistered = []
+        payload_callbacks = {event_type: [] for event_type in INTERACTIVE_EVENTS}
+        for plugin in self._bot.plugin_manager.get_all_active_plugins():
+            # Skip self to avoid infinite recursion
+            if plugin is self:
+                continue
+            plugin_name = plugin.__class__.__name__
+            declared = declared_handlers(plugin)
+            for method_name, action_ids, block_ids in declared:
+                handler = (plugin_name, method_name, getattr(plugin, method_name))
+                for kind, registrations in ((ACTION_ID, action_ids), (BLOCK_ID, block_ids)):
+                    for registration in registrations:
+                        owner = router.add(kind, registration, handler)
+                        if owner is not None:
+                            self.log.warning(
+                                f"{plugin_name}.{method_name} registers {kind} {registration} "
+                                f"already owned by {owner[0]}.{owner[1]}, ignoring it")
+            if not declared and callable(getattr(plugin, 'handle_block_action', None)):
+                # Plugins without registrations keep getting every action
+                unregistered.append((plugin_name, 'handle_block_action', plugin.handle_block_action))
+            for event_type in INTERACTIVE_EVENTS:
+                # e.g., callback_block_actions
+                for method_name in (f'callback_{event_type}',) + PAYLOAD_CALLBACKS:
+                    callback = getattr(plugin, method_name, None)
+                    if callable(callback):
+                        payload_callbacks[event_type].append((plugin_name, method_name, callback))
+        self.log.info(f"Block action routes: {len(router)} registrations, "
+                      f"{len(unregistered)} unregistered handlers")
+        return router, unregistered, payload_callbacks
+
+    def _get_routes(self):
+        routes = self._routes
+        if routes is None:
+            routes = self._routes = self._build_routes()
+        return routes
+
+    def _call(self, event_type, plugin_name, method_name, callback, *args):
+        """Call a plugin handler, returning whether it handled the event."""
+        hot.debug("📞 Calling %s.%s", plugin_name, method_name)
+        # Time-boxed, a slow or failing plugin does not hold up the next ones
+        result = get_handler_guard(self._bot.bot_config).call(plugin_name, method_name, callback, *args)
+        if result is DEFERRED:
+            hot.info("⏳ Interactive event %s left running in %s.%s", event_type, plugin_name, method_name)
+            return True
+        if result:
+            hot.info("✅ Interactive event %s handled by %s.%s", event_type, plugin_name, method_name)
+            return True
+        return False
 
     def _handle_interactive_event(self, event_type, payload):
         """Handle interactive events by routing to appropriate plugins"""
         try:
-            self.log.info(f"🎯 Routing {event_type} event to plugins")
-            self.log.info(f"Payload keys: {list(payload.keys())}")
-            
-            # Initialize action variables
-            action_id = None
-            action_value = None
-            
-            # Extract action information for block_actions
+            hot.debug("🎯 Routing %s event to plugins", event_type)
+            hot.trace(payload, "Interactive %s payload", event_type)
+            router, unregistered, payload_callbacks = self._get_routes()
+            fake_message = self._create_fake_message_from_payload(payload)
+            handled = False
+
             if event_type == 'block_actions':
                 actions = payload.get('actions', [])
-                if actions:
-                    action = actions[0]  # Use first action
-                    action_id = action.get('action_id')
-                    action_value = action.get('value')
-                    self.log.info(f"Extracted action_id: {action_id}, value: {action_value}")
-                else:
+                if not actions:
                     self.log.warn("No actions found in block_actions event")
                     return None
-            
-            handled = False
-            
-            # Get all active plugins
-            active_plugins = self._bot.plugin_manager.get_all_active_plugins()
-            
-            for plugin in active_plugins:
-                # Skip self to avoid infinite recursion
-                if plugin.__class__.__name__ == 'SlackV3BlocksExtension':
-                    continue
-                
-                # Try different callback method names
-                callback_methods = [
-                    'handle_block_action',          # Our NameCollector uses this
-                    f'callback_{event_type}',       # e.g., callback_block_actions  
-                    'callback_interactive',         # Generic interactive handler
-                    'callback_interactive_component' # Alternative name
-                ]
-                
-                for method_name in callback_methods:
-                    if hasattr(plugin, method_name):
-                        try:
-                            callback = getattr(plugin, method_name)
-                            plugin_name = plugin.__class__.__name__
-                            self.log.info(f"📞 Calling {plugin_name}.{method_name}")
-                            
-                            # Call the plugin's handler with correct parameters
-                            if method_name == 'handle_block_action':
-                                # NameCollector expects: handle_block_action(action_id, value, payload, message)
-                                fake_message = self._create_fake_message_from_payload(payload)
-                                result = callback(action_id, action_value, payload, fake_message)
-                            else:
-                                result = callback(payload)
-                                
-                            if result:
-                                self.log.info(f"✅ Interactive event {event_type} handled by {plugin_name}.{method_name}")
-                                handled = True
-                                # Don't return here - let other plugins also handle their actions
-                                # return result  # REMOVED: This was causing the bug!
-                                
-                        except Exception as e:
-                            plugin_name = plugin.__class__.__name__
-                            self.log.error(f"❌ Error in {plugin_name}.{method_name}: {e}")
-                            import traceback
-                            self.log.error(f"Traceback: {traceback.format_exc()}")
-            
+                # Each action goes to the plugin owning its action_id or block_id
+                for action in actions:
+                    action_id = action.get('action_id')
+                    action_value = action.get('value')
+                    hot.debug("Extracted action_id: %s, block_id: %s", action_id, action.get('block_id'))
+                    handler = router.route(action)
+                    handlers = [handler] if handler is not None else unregistered
+                    for plugin_name, method_name, callback in handlers:
+                        # Handlers expect: handle_block_action(action_id, value, payload, message)
+                        if self._call(event_type, plugin_name, method_name, callback,
+                                      action_id, action_value, payload, fake_message):
+                            handled = True
+            else:
+                for plugin_name, method_name, callback in unregistered:
+                    if self._call(event_type, plugin_name, method_name, callback, None, None, payload, fake_message):
+                        handled = True
+
+            for plugin_name, method_name, callback in payload_callbacks.get(event_type, ()):
+                if self._call(event_type, plugin_name, method_name, callback, payload):
+                    handled = True
+
             if not handled:
-                self.log.info(f"ℹ️ No plugin handled the {event_type} event")
-            
+                hot.info("ℹ️ No plugin handled the %s event", event_type)
+
         except Exception as e:
             self.log.error(f"❌ Error handling interactive event {event_type}: {e}")
             import traceback
             self.log.error(f"Traceback: {traceback.format_exc()}")
-        
+
         return None
 
     # Static helper methods for other plugins to use
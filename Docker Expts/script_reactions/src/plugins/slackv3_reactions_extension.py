@@ -1,66 +1,190 @@
-from errbot import BotPlugin
+from errbot import BotPlugin, botcmd
+from event_dedup import get_dedup_window
+from event_executor import get_event_executor
+from handler_guard import DEFERRED, get_handler_guard
+from hot_log import dropped_records, hot_logger, setup_hot_logging, trace, traced
+from plugin_watch import unwatch_plugin_set, watch_plugin_set
+from reaction_utils import WILDCARD, subscribed_reactions
+from slack_router import REACTION, REACTION_EVENTS, get_event_router, release_event_router
+
+# Rate limited logging of the code run for every event
+hot = hot_logger('errbot.plugins.SlackV3ReactionsExtension')
+
 
 class SlackV3ReactionsExtension(BotPlugin):
     """
     Extension to patch SlackV3 backend to handle Slack reaction events.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # event type -> ({reaction: callbacks}, wildcard callbacks), None when stale, where
+        # callbacks are [(plugin name, method name, bound callback)] in plugin order
+        self._dispatch_table = None
+
     def activate(self):
         super().activate()
         self.log.info("Activating SlackV3 Reactions Extension...")
+        setup_hot_logging(self._bot.bot_config)
         backend = self._bot  # FIXED: use self._bot directly
         if hasattr(backend, "_generic_wrapper"):
-            self._patch_backend(backend)
+            get_event_router(backend).route(REACTION, self._handle_reaction_event, self._locate_reaction)
+            self.log.info("✅ Routing Slack reaction events to plugins.")
         else:
             self.log.error("Slack backend does not have _generic_wrapper method.")
+        watch_plugin_set(self._bot.plugin_manager, self._invalidate_dispatch_table)
+        self._executor = get_event_executor(self._bot.bot_config)
+        self._guard = get_handler_guard(self._bot.bot_config)
 
-    def _patch_backend(self, backend):
-        original_wrapper = backend._generic_wrapper
+    def _locate_reaction(self, event):
+        """Reactions are ordered with the other events of the thread of the reacted message."""
+        item = event.get('item', {})
+        channel, ts = item.get('channel'), item.get('ts')
+        router = getattr(self._bot, '_event_router', None)
+        # Keyed on the message itself when its thread is unknown
+        thread_ts = router.thread_root(channel, ts) if router is not None else None
+        return channel, thread_ts, ts
 
-        def patched_wrapper(event_data):
-            # Handle reaction events
-            if 'event' in event_data:
-                event = event_data['event']
-                event_type = event.get('type')
-                if event_type in ['reaction_added', 'reaction_removed']:
-                    self.log.info(f"Handling Slack reaction event: {event_type}")
-                    self._handle_reaction_event(event_type, event)
-                    return None
-            # Fallback to original logic
-            return original_wrapper(event_data)
+    def deactivate(self):
+        router = getattr(self._bot, '_event_router', None)
+        if router is not None:
+            router.unroute(REACTION, self._handle_reaction_event)
+            release_event_router(self._bot)
+        unwatch_plugin_set(self._bot.plugin_manager, self._invalidate_dispatch_table)
+        self._dispatch_table = None
+        super().deactivate()
+
+    def _invalidate_dispatch_table(self):
+        """
+        Mark the dispatch table stale when plugins are activated, deactivated or
+        reloaded, so it is rebuilt on the next event rather than on every event.
+        """
+        self._dispatch_table = None
 
-        backend._generic_wrapper = patched_wrapper
-        self.log.info("✅ Successfully patched SlackV3 backend _generic_wrapper to handle reaction events.")
+    def _build_dispatch_table(self):
+        subscriptions = {event_type: [] for event_type in REACTION_EVENTS}
+        for plugin in self._bot.plugin_manager.get_all_active_plugins():
+            # Skip self to avoid recursion
+            if plugin is self:
+                continue
+            plugin_name = plugin.__class__.__name__
+            for event_type in REACTION_EVENTS:
+                for method_name in (f'callback_{event_type}', 'callback_reaction'):
+                    callback = getattr(plugin, method_name, None)
+                    if callable(callback):
+                        names = subscribed_reactions(plugin, callback)
+                        subscriptions[event_type].append(((plugin_name, method_name, callback), names))
+
+        table = {}
+        for event_type, entries in subscriptions.items():
+            wildcard = [entry for entry, names in entries if WILDCARD in names]
+            reactions = {name for _, names in entries for name in names} - {WILDCARD}
+            # Each reaction gets its subscribers and the wildcard ones, keeping the plugin order
+            by_reaction = {
+                reaction: [entry for entry, names in entries if reaction in names or WILDCARD in names]
+                for reaction in reactions
+            }
+            table[event_type] = (by_reaction, wildcard)
+        self.log.info(
+            "Reaction dispatch table: "
+            + ", ".join(
+                f"{event_type} -> {sorted(by_reaction)} + {len(wildcard)} wildcard callbacks"
+                for event_type, (by_reaction, wildcard) in table.items()
+            )
+        )
+        return table
+
+    def _callbacks(self, event_type, reaction):
+        table = self._dispatch_table
+        if table is None:
+            table = self._dispatch_table = self._build_dispatch_table()
+        by_reaction, wildcard = table.get(event_type, ({}, ()))
+        return by_reaction.get(reaction, wildcard)
 
     def _handle_reaction_event(self, event_type, event):
         """
         Route Slack reaction events to plugins.
         """
         try:
-            self.log.info(f"Routing {event_type} to plugins. Reaction: {event.get('reaction')}, User: {event.get('user')}")
+            reaction = event.get('reaction')
+            hot.debug("Routing %s to plugins. Reaction: %s, User: %s", event_type, reaction, event.get('user'))
+            hot.trace(event, "Reaction %s event", event_type)
             handled = False
-            active_plugins = self._bot.plugin_manager.get_all_active_plugins()
-            for plugin in active_plugins:
-                # Skip self to avoid recursion
-                if plugin.__class__.__name__ == 'SlackV3ReactionsExtension':
-                    continue
-                callback_methods = [
-                    f'callback_{event_type}',      # e.g., callback_reaction_added
-                    'callback_reaction',           # generic
-                ]
-                for method_name in callback_methods:
-                    if hasattr(plugin, method_name):
-                        try:
-                            callback = getattr(plugin, method_name)
-                            plugin_name = plugin.__class__.__name__
-                            self.log.info(f"Calling {plugin_name}.{method_name}")
-                            result = callback(event)
-                            if result:
-                                self.log.info(f"Reaction event {event_type} handled by {plugin_name}.{method_name}")
-                                handled = True
-                        except Exception as e:
-                            self.log.error(f"Error in {plugin_name}.{method_name}: {e}")
+            for plugin_name, method_name, callback in self._callbacks(event_type, reaction):
+                hot.debug("Calling %s.%s", plugin_name, method_name)
+                # Time-boxed, a slow or failing plugin does not hold up the next ones
+                result = self._guard.call(plugin_name, method_name, callback, event)
+                if result is DEFERRED:
+                    hot.info("Reaction event %s left running in %s.%s", event_type, plugin_name, method_name)
+                    handled = True
+                elif result:
+                    hot.info("Reaction event %s handled by %s.%s", event_type, plugin_name, method_name)
+                    handled = True
             if not handled:
-                self.log.info(f"No plugin handled the {event_type} event")
+                hot.debug("No plugin handled the %s event", event_type)
         except Exception as e:
-            self.log.error(f"Error handling reaction event {event_type}: {e}")
\ No newline at end of file
+            self.log.error(f"Error handling reaction event {event_type}: {e}")
+
+    @botcmd(admin_only=True)
+    def slack_events(self, msg, args):
+        """Queue depth and activity of the Slack event workers: !slack events"""
+        stats = self._executor.stats()
+        dedup = get_dedup_window(self._bot.bot_config).stats()
+        router = getattr(self._bot, '_event_router', None)
+        routed = router.stats() if router is not None else {}
+        by_type = ", ".join(f"{name.split(':', 1)[1]} {count}" for name, count in sorted(routed.items()) if ':' in name)
+        lines = [
+            f"📨 routed: {by_type or '-'}, {routed.get('queued', 0)} queued, {routed.get('dropped', 0)} dropped, "
+            f"routing avg {routed.get('avg_route_ms', 0.0):.2f}ms"
+        ]
+        queue = router.queue_stats() if router is not None else None
+        if queue is not None:
+            depth = f", depth {queue['depth']}" if 'depth' in queue else ""
+            lines.append(
+                f"📬 queue: {queue.get('published', 0)} published, {queue.get('acked', 0)} acked, "
+                f"{queue.get('requeued', 0)} requeued, {queue.get('dead_lettered', 0)} dead-lettered{depth}"
+            )
+        lines += [
+            f"⚙️ {stats['busy']}/{stats['workers']} workers busy, {stats['pending']} events pending "
+            f"in {stats['conversations']} conversations (limit {stats['max_pending']}, peak {stats['max_depth']}), "
+            f"{stats['held']} held by a handler left running",
+            f"✅ {stats.get('completed', 0)} completed, ❌ {stats.get('failed', 0)} failed, "
+            f"⏳ {stats.get('throttled', 0)} throttled, 🗑️ {stats.get('dropped_full', 0)} dropped (full), "
+            f"{stats.get('dropped_key_full', 0)} dropped (conversation full)",
+            f"⏱️ wait avg {stats['avg_wait_ms']:.0f}ms max {stats['max_wait_ms']:.0f}ms, run avg {stats['avg_run_ms']:.0f}ms",
+            f"🔁 {dedup.get('duplicates', 0)} redeliveries ignored ({dedup.get('remote_duplicates', 0)} run by another "
+            f"replica), {dedup['remembered']} ids remembered for {dedup['window']}s"
+            f"{', shared through Redis' if dedup['shared'] else ''}",
+        ]
+        return "\n".join(lines)
+
+    @botcmd(admin_only=True)
+    def slack_handlers(self, msg, args):
+        """Latency, failures and circuit breakers of the plugin handlers: !slack handlers"""
+        rows = self._guard.stats()
+        if not rows:
+            return "No plugin handler has run yet"
+        lines = []
+        for row in rows:
+            state = {'closed': '🟢', 'half-open': '🟡', 'open': '🔴'}[row['breaker']]
+            overflow = ", on the overflow pool" if row['overflowing'] else ""
+            lines.append(
+                f"{state} {row['plugin']}: {row['calls']} calls, avg {row['avg_ms']:.0f}ms max {row['max_ms']:.0f}ms, "
+                f"waited {row['waited_ms']:.0f}ms, {row['errors']} errors, {row['timeouts']} timeouts, "
+                f"{row['overflowed']} overflowed, {row['abandoned']} abandoned, {row['skipped']} skipped, "
+                f"{row['trips']} trips{overflow}"
+            )
+        return "\n".join(lines)
+
+    @botcmd(admin_only=True)
+    def slack_trace(self, msg, args):
+        """Dump the payloads of a channel or user to the log: !slack trace <channel or user id> [off]"""
+        words = args.split()
+        if words:
+            trace(words[0], enabled=words[1:2] != ['off'])
+        ids = traced()
+        dropped = dropped_records()
+        return (
+            f"🔍 tracing {', '.join(ids) if ids else 'nothing'}"
+            f"{f', {dropped} log records dropped by the file writer' if dropped else ''}"
+        )
@@ -0,0 +1,69 @@
+from errbot import BotPlugin, botcmd, webhook
+from flask import Response
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _ms(seconds):
+    return '>2.5s' if seconds == float('inf') else f"{seconds * 1000:g}ms"
+
+
+class StorageStats(BotPlugin):
+    """Exposes the statistics of the storage plugin (see src/storageplugins/redismetrics.py)."""
+
+    def _storage_stats(self):
+        storage_plugin = getattr(self._bot, 'storage_plugin', None)
+        if not hasattr(storage_plugin, 'storage_stats'):
+            return None
+        return storage_plugin.storage_stats()
+
+    @botcmd(admin_only=True)
+    def storage_stats(self, msg, args):
+        """Storage latency, calls and bytes per namespace: !storage stats [namespace]"""
+        stats = self._storage_stats()
+        if stats is None:
+            return "❌ Storage metrics are not enabled, add 'metrics' to STORAGE_CONFIG."
+        namespaces = [args.strip()] if args.strip() else sorted(stats)
+        lines = []
+        for namespace in namespaces:
+            ns_stats = stats.get(namespace)
+            if ns_stats is None:
+                lines.append(f"❌ No storage activity recorded for **{namespace}**.")
+                continue
+            lines.append(
+                f"**{namespace}** — read {ns_stats['bytes_read'] / 1024:.1f} KiB, "
+                f"written {ns_stats['bytes_written'] / 1024:.1f} KiB"
+            )
+            for op, op_stats in sorted(ns_stats['ops'].items(), key=lambda item: -item[1]['calls']):
+                lines.append(
+                    f"  {op}: {op_stats['calls']} calls, {op_stats['errors']} errors, "
+                    f"avg {_ms(op_stats['avg'])}, p50 ≤ {_ms(op_stats['p50'])}, p99 ≤ {_ms(op_stats['p99'])}"
+                )
+        return "\n".join(lines) or "📊 No storage activity recorded yet."
+
+    @botcmd(admin_only=True)
+    def storage_hotkeys(self, msg, args):
+        """The most used and the biggest keys per namespace (sampled): !storage hotkeys [namespace]"""
+        stats = self._storage_stats()
+        if stats is None:
+            return "❌ Storage metrics are not enabled, add 'metrics' to STORAGE_CONFIG."
+        namespaces = [args.strip()] if args.strip() else sorted(stats)
+        lines = []
+        for namespace in namespaces:
+            ns_stats = stats.get(namespace)
+            if ns_stats is None:
+                continue
+            lines.append(f"**{namespace}**")
+            hot = ", ".join(f"`{key}` ({count:g})" for key, count in ns_stats['hot_keys'][:10])
+            big = ", ".join(f"`{key}` ({size / 1024:.1f} KiB)" for key, size in ns_stats['big_keys'][:10])
+            lines.append(f"  hot: {hot or '-'}")
+            lines.append(f"  big: {big or '-'}")
+        return "\n".join(lines) or "📊 No storage activity recorded yet."
+
+    @webhook('/storage/metrics', raw=True)
+    def storage_metrics(self, request):
+        """Prometheus scrape endpoint of the storage metrics."""
+        storage_plugin = getattr(self._bot, 'storage_plugin', None)
+        if not hasattr(storage_plugin, 'prometheus_metrics'):
+            return Response("# storage metrics are not available\n", status=404, content_type=PROMETHEUS_CONTENT_TYPE)
+        return Response(storage_plugin.prometheus_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,157 @@
+"""
+Helpers giving plugins access to the extended operations of the storage plugin
+(see src/storageplugins/redisstorage.py), with a plain key by key fallback when
+the bot runs with a storage that does not have them (e.g. the default Shelf
+storage in text mode).
+"""
+
+
+def _store(plugin):
+    return plugin._store
+
+
+def get_many(plugin, keys):
+    """Get several keys of the plugin storage in one round-trip. Missing keys are left out."""
+    store = _store(plugin)
+    if hasattr(store, 'get_many'):
+        return store.get_many(keys)
+    found = {}
+    for key in keys:
+        try:
+            found[key] = store.get(key)
+        except KeyError:
+            pass
+    return found
+
+
+def set_many(plugin, mapping):
+    """Atomically set several keys of the plugin storage in one round-trip."""
+    store = _store(plugin)
+    if hasattr(store, 'set_many'):
+        return store.set_many(mapping)
+    for key, value in mapping.items():
+        store.set(key, value)
+
+
+def delete_many(plugin, keys):
+    """Remove several keys of the plugin storage, ignoring missing ones. Returns how many existed."""
+    store = _store(plugin)
+    if hasattr(store, 'delete_many'):
+        return store.delete_many(keys)
+    deleted = 0
+    for key in keys:
+        try:
+            store.remove(key)
+            deleted += 1
+        except KeyError:
+            pass
+    return deleted
+
+
+def expire(plugin, key, ttl):
+    """
+    Expire a key of the plugin storage after ttl seconds (None to never expire it).
+    Returns False if the key does not exist or the storage has no expiry.
+    """
+    store = _store(plugin)
+    if hasattr(store, 'expire'):
+        return store.expire(key, ttl)
+    return False
+
+
+def get_fields(plugin, key, fields=None):
+    """Read some or all fields of a record. Raises KeyError if the record does not exist."""
+    store = _store(plugin)
+    if hasattr(store, 'get_fields'):
+        return store.get_fields(key, fields)
+    record = store.get(key)
+    if fields is None:
+        return dict(record)
+    return {field: record[field] for field in fields if field in record}
+
+
+def set_fields(plugin, key, mapping, replace=False):
+    """Set some fields of a record, leaving the others untouched (all dropped if replace)."""
+    with batch(plugin) as b:
+        b.set_fields(key, mapping, replace)
+
+
+def get_range(plugin, key, start=0, end=-1):
+    """Read a slice of a list built with append(), both ends included. A missing list reads as empty."""
+    store = _store(plugin)
+    if hasattr(store, 'get_range'):
+        return store.get_range(key, start, end)
+    try:
+        values = store.get(key)
+    except KeyError:
+        return []
+    return values[start:] if end == -1 else values[start:end + 1]
+
+
+def async_storage(plugin):
+    """
+    The awaitable storage behind the plugin storage with the AsyncRedis storage plugin,
+    None with any other. Await it from coroutines running on its loop (async_storage(self).redis
+    belongs to the loop of the storage plugin).
+    """
+    return getattr(_store(plugin), 'async_storage', None)
+
+
+def batch(plugin):
+    """
+    Group writes (set, set_fields, append, delete, expire) to the plugin storage so they are
+    applied atomically, in one round-trip, when the with block exits:
+
+        with batch(self) as b:
+            b.set_fields(ticket_key, {'status': 'Closed'})
+            b.append(comments_key, comment)
+    """
+    store = _store(plugin)
+    if hasattr(store, 'batch'):
+        return store.batch()
+    return _ImmediateBatch(store)
+
+
+class _ImmediateBatch:
+    """
+    Applies each write right away on storages without batches, emulating fields and
+    lists. Expiry is not supported there, keys are kept.
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    def set(self, key, value):
+        self._store.set(key, value)
+
+    def set_fields(self, key, mapping, replace=False):
+        record = {}
+        if not replace:
+            try:
+                record = dict(self._store.get(key))
+            except KeyError:
+                pass
+        record.update(mapping)
+        self._store.set(key, record)
+
+    def append(self, key, *values):
+        try:
+            current = list(self._store.get(key))
+        except KeyError:
+            current = []
+        self._store.set(key, current + list(values))
+
+    def expire(self, key, ttl):
+        pass
+
+    def delete(self, key):
+        try:
+            self._store.remove(key)
+        except KeyError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from deferred_jobs import Job, run_job
+from event_executor import KeyedExecutor
+from handler_guard import DEFERRED, OPEN, HandlerGuard
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_skipped_call_leaves_the_open_breaker_to_the_next_probe():
+    guard = HandlerGuard(budget=5.0, max_overflow=1)
+    blocker = threading.Event()
+    guard._overflowing.add('Slow')
+    assert guard.call('Slow', 'handle', blocker.wait) is DEFERRED
+    breaker = guard._breakers['Slow']
+    breaker.state = OPEN
+    breaker.opened_at = time.monotonic() - breaker.reset_after
+
+    # Overflow pool of the plugin full: skipped, without taking the probe
+    assert guard.call('Slow', 'handle', lambda: True) is None
+    assert breaker.state == OPEN
+    assert guard.stats()[0]['skipped'] == 1
+
+    blocker.set()
+    assert wait_for(lambda: guard._overflow_pending['Slow'] == 0)
+
+
+def test_hung_handler_trips_its_breaker_without_starving_another_plugin():
+    guard = HandlerGuard(budget=0.05, overflow_workers=1, max_overflow=1, failures=2)
+    hung = threading.Event()
+    # Waited for, over budget: moved to its overflow pool
+    assert guard.call('Slow', 'handle', hung.wait) is DEFERRED
+    # Left running there, counted over budget once its time is up
+    assert guard.call('Slow', 'handle', hung.wait) is DEFERRED
+    assert wait_for(lambda: guard._breakers['Slow'].state == OPEN)
+    assert guard.call('Slow', 'handle', lambda: True) is None
+
+    ran = threading.Event()
+    guard._overflowing.add('Other')
+    assert guard.call('Other', 'handle', ran.set) is DEFERRED
+    assert ran.wait(1.0)
+    rows = {row['plugin']: row for row in guard.stats()}
+    assert rows['Slow']['timeouts'] == 2
+    assert rows['Slow']['trips'] == 1
+    assert rows['Other']['timeouts'] == 0
+    hung.set()
+
+
+def run_event(executor, guard, handler):
+    job = Job(None, 'C1', '1.0')
+    job.when_finished(executor.hold_current())
+    run_job(job, guard.call, 'Slow', 'handle', handler)
+
+
+def test_conversation_held_until_the_deferred_handler_finishes():
+    executor = KeyedExecutor(workers=2)
+    guard = HandlerGuard(budget=0.05)
+    done = threading.Event()
+    order = []
+
+    def slow():
+        done.wait()
+        order.append('first')
+
+    executor.submit('C1:1.0', run_event, executor, guard, slow)
+    executor.submit('C1:1.0', order.append, 'second')
+    assert wait_for(lambda: executor.stats()['held'] == 1)
+    time.sleep(0.1)
+    assert order == []
+
+    done.set()
+    assert wait_for(lambda: order == ['first', 'second'])
+    assert wait_for(lambda: executor.stats()['pending'] == 0)
+
+
+def test_abandoned_handler_releases_its_conversation():
+    executor = KeyedExecutor(workers=2)
+    guard = HandlerGuard(budget=0.05, abandon_after=0.2)
+    hung = threading.Event()
+    order = []
+
+    executor.submit('C1:1.0', run_event, executor, guard, hung.wait)
+    executor.submit('C1:1.0', order.append, 'second')
+    assert wait_for(lambda: order == ['second'])
+    assert guard.stats()[0]['abandoned'] == 1
+    hung.set()
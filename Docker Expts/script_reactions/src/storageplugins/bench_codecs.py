@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+Micro-benchmark of the stored value codecs on payloads shaped like the ones the
+plugins write: JiraReactionMocker tickets with a growing comments list, and the
+collected_names list of SimpleNameCollector.
+
+    python bench_codecs.py --comments 10 100 1000
+    python bench_codecs.py --compression zstd --threshold 4096
+"""
+
+import argparse
+import datetime
+import timeit
+
+from rediscodecs import Serializer, available_codecs
+from rediscompress import Compressor, available_algorithms
+
+
+def ticket_payload(comments: int) -> dict:
+    now = datetime.datetime(2025, 7, 24, 10, 0, 0)
+    return {
+        "key": "MOCK-OPS-482913",
+        "title": "Prod deploy of wrcbot failed on the redis readiness probe, see thread",
+        "status": "In Review",
+        "created_by": "U0922H0H00N",
+        "created_at": now.isoformat(),
+        "channel": "C08TQ3V2ABC",
+        "thread_ts": "1721815200.123456",
+        "last_add2jira_ts": "1721818800.654321",
+        "reviewed_by": "U07ABCDEF12",
+        "reviewed_at": now.isoformat(),
+        "review_summary": "Root cause identified, fix in review.",
+        "comments": [
+            {
+                "author": "Jane Doe %d" % i,
+                "text": "Checked the pod logs, the probe times out after %d seconds <@U0922H0H00N>" % i,
+                "timestamp": (now + datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+                "ts": "%d.%06d" % (1721815200 + i * 60, i),
+            }
+            for i in range(comments)
+        ],
+    }
+
+
+def names_payload(entries: int) -> list:
+    return [
+        {"user_id": "U%010d" % i, "slack_user_name": "user%d" % i, "submitted_name": "Name %d" % i}
+        for i in range(entries)
+    ]
+
+
+def bench(serializer: Serializer, value, number: int):
+    data = serializer.dumps(value)
+    dumps = min(timeit.repeat(lambda: serializer.dumps(value), number=number, repeat=3)) / number
+    loads = min(timeit.repeat(lambda: serializer.loads(data), number=number, repeat=3)) / number
+    return len(data), dumps, loads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--comments", type=int, nargs="+", default=[0, 10, 100, 1000])
+    parser.add_argument("--number", type=int, default=200, help="iterations per measure")
+    parser.add_argument("--compression", choices=available_algorithms(), help="compress the encoded values")
+    parser.add_argument("--threshold", type=int, default=4096, help="compress values from this size")
+    args = parser.parse_args()
+
+    payloads = [("ticket/%d comments" % n, ticket_payload(n)) for n in args.comments]
+    payloads.append(("collected_names/200", names_payload(200)))
+
+    print("%-22s %-11s %10s %12s %12s" % ("payload", "codec", "bytes", "dumps (us)", "loads (us)"))
+    for label, value in payloads:
+        for codec in available_codecs():
+            compressor = Compressor(args.compression, args.threshold) if args.compression else None
+            size, dumps, loads = bench(Serializer(codec, compressor), value, args.number)
+            print("%-22s %-11s %10d %12.1f %12.1f" % (label, codec, size, dumps * 1e6, loads * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+Benchmark of the storage plugins on the access patterns of the bot plugins:
+
+- ticket: the JiraReactionMocker lifecycle, i.e. create (fields + thread mapping),
+  reads of the mapping and of the ticket fields on every reaction, add2jira
+  (append comments + one field) and close (fields + expiry).
+- names: the SimpleNameCollector submission, a read-modify-write of the whole
+  collected_names list.
+- lookup: the thread_to_ticket_* read done on every reaction.
+- keys: keys() and len() of the namespace.
+
+    python bench_storage.py --redis redis://localhost:6379/15 --tickets 200
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+
+from bench_codecs import names_payload
+
+
+def redis_storage(url: str, namespace: str):
+    from redisstorage import RedisPlugin
+
+    plugin = RedisPlugin(SimpleNamespace(STORAGE_CONFIG={"url": url}))
+    storage = plugin.open(namespace)
+    storage.redis.flushdb()
+    return plugin.open(namespace)
+
+
+def sqlite_storage(path: str, namespace: str):
+    from sqlitestorage import SQLitePlugin
+
+    return SQLitePlugin(SimpleNamespace(STORAGE_CONFIG={"path": path})).open(namespace)
+
+
+class Timer:
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+
+def ticket(i: int) -> dict:
+    return {
+        "key": "MOCK-OPS-%06d" % i,
+        "title": "Prod deploy of wrcbot failed on the redis readiness probe, see thread",
+        "status": "Open",
+        "created_by": "U0922H0H00N",
+        "created_at": "2025-07-24T10:00:00",
+        "channel": "C08TQ3V2ABC",
+        "thread_ts": "1721815200.%06d" % i,
+        "last_add2jira_ts": None,
+    }
+
+
+def comments(n: int) -> list:
+    return [{"author": "Jane Doe", "text": "Checked the pod logs, the probe times out %d" % i, "ts": str(i)} for i in range(n)]
+
+
+def run_tickets(storage, timer: Timer, tickets: int, reads: int) -> None:
+    for i in range(tickets):
+        data = ticket(i)
+        mapping_key = "thread_to_ticket_%s" % data["thread_ts"]
+
+        def create(data=data, mapping_key=mapping_key):
+            with storage.batch() as batch:
+                batch.set_fields(data["key"], data, replace=True)
+                batch.set(mapping_key, data["key"])
+
+        timer.time("ticket create", create)
+        for _ in range(reads):
+            timer.time("ticket load", lambda mapping_key=mapping_key: storage.get_fields(storage.get(mapping_key)))
+
+        def add2jira(data=data):
+            with storage.batch() as batch:
+                batch.append(data["key"] + ":comments", *comments(5))
+                batch.set_fields(data["key"], {"last_add2jira_ts": "1721818800.654321"})
+
+        timer.time("ticket add2jira", add2jira)
+
+        def close(data=data, mapping_key=mapping_key):
+            with storage.batch() as batch:
+                batch.set_fields(data["key"], {"status": "Closed", "closure_summary": "Fixed."})
+                for key in (data["key"], data["key"] + ":comments", mapping_key):
+                    batch.expire(key, 30 * 24 * 3600)
+
+        timer.time("ticket close", close)
+
+
+def run_names(storage, timer: Timer, submissions: int) -> None:
+    storage.set("collected_names", names_payload(200))
+    for i in range(submissions):
+
+        def submit(i=i):
+            names = storage.get("collected_names")
+            names.append({"user_id": "U%010d" % i, "slack_user_name": "user%d" % i, "submitted_name": "Name"})
+            storage.set("collected_names", names)
+
+        timer.time("names submit", submit)
+
+
+def run_lookups(storage, timer: Timer, lookups: int) -> None:
+    storage.set("thread_to_ticket_lookup", "MOCK-OPS-000001")
+    for _ in range(lookups):
+        timer.time("lookup", storage.get, "thread_to_ticket_lookup")
+
+
+def run_keys(storage, timer: Timer, rounds: int) -> None:
+    for _ in range(rounds):
+        timer.time("keys", storage.keys)
+        timer.time("len", storage.len)
+
+
+def report(backend: str, timer: Timer) -> None:
+    for name, samples in timer.samples.items():
+        samples = sorted(samples)
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        print(
+            "%-8s %-16s %8d %10.0f %10.1f %10.1f"
+            % (backend, name, len(samples), len(samples) / sum(samples), statistics.median(samples) * 1e6, p99 * 1e6)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", help="redis URL of a scratch database (flushed!), skipped if not given")
+    parser.add_argument("--sqlite", help="SQLite file, a temporary one by default")
+    parser.add_argument("--tickets", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=5, help="ticket loads per ticket")
+    parser.add_argument("--submissions", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    backends = []
+    tmpdir = None
+    if args.sqlite is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        args.sqlite = os.path.join(tmpdir.name, "bench.sqlite")
+    backends.append(("sqlite", lambda ns: sqlite_storage(args.sqlite, ns)))
+    if args.redis:
+        backends.append(("redis", lambda ns: redis_storage(args.redis, ns)))
+
+    print("%-8s %-16s %8s %10s %10s %10s" % ("backend", "operation", "count", "ops/s", "p50 (us)", "p99 (us)"))
+    for backend, open_storage in backends:
+        timer = Timer()
+        tickets = open_storage("BenchJira")
+        run_tickets(tickets, timer, args.tickets, args.reads)
+        run_names(open_storage("BenchNames"), timer, args.submissions)
+        run_lookups(tickets, timer, args.lookups)
+        run_keys(tickets, timer, 50)
+        report(backend, timer)
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,625 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Mapping, Optional
+
+import redis
+import redis.asyncio as aioredis
+from errbot.storage.base import StorageBase, StoragePluginBase
+from rediscodecs import Serializer
+from rediscompress import make_compressor
+from redispool import (
+    DEFAULT_HEALTH_CHECK_INTERVAL,
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_POOL_TIMEOUT,
+    POOL_OPTIONS,
+    _pool_key,
+    _pool_name,
+)
+from redisstorage import (
+    INDEXED_NAMESPACES,
+    LEGACY_INDEX_PREFIX,
+    SCAN_COUNT,
+    STORAGE_OPTIONS,
+    RedisBatch,
+    RedisNamespace,
+    compat_str,
+    expiry_score,
+    is_wrongtype,
+)
+from ttlpolicy import TtlPolicy
+
+log = logging.getLogger("errbot.storage.redis.async")
+
+# Pools of the asyncio client, per event loop: a connection belongs to the loop
+# that opened it, so loops cannot share a pool.
+_async_pools = weakref.WeakKeyDictionary()
+_async_pools_lock = threading.Lock()
+
+
+def _create_async_pool(config: Dict[str, Any]):
+    kwargs = {k: v for k, v in config.items() if k not in POOL_OPTIONS}
+    kwargs.setdefault("socket_keepalive", True)
+    kwargs.setdefault("health_check_interval", DEFAULT_HEALTH_CHECK_INTERVAL)
+
+    blocking = config.get("pool_blocking", True)
+    pool_class = aioredis.BlockingConnectionPool if blocking else aioredis.ConnectionPool
+    pool_kwargs = {"max_connections": config.get("max_connections", DEFAULT_MAX_CONNECTIONS)}
+    if blocking:
+        pool_kwargs["timeout"] = config.get("pool_timeout", DEFAULT_POOL_TIMEOUT)
+
+    url = config.get("url", "")
+    if url.startswith("unix://") or "unix_socket_path" in kwargs:
+        if "unix_socket_path" in kwargs:
+            kwargs["path"] = kwargs.pop("unix_socket_path")
+        for tcp_only in ("host", "port", "socket_keepalive", "socket_keepalive_options"):
+            kwargs.pop(tcp_only, None)
+        kwargs["connection_class"] = aioredis.UnixDomainSocketConnection
+    elif url.startswith("rediss://") or kwargs.pop("ssl", False):
+        kwargs["connection_class"] = aioredis.SSLConnection
+
+    if url:
+        return pool_class.from_url(url, **pool_kwargs, **kwargs)
+    return pool_class(**pool_kwargs, **kwargs)
+
+
+def get_async_connection_pool(config: Dict[str, Any]):
+    """
+    Return the connection pool of the running event loop for this STORAGE_CONFIG,
+    creating it on first use. Every namespace opened on that loop shares it, however
+    many handlers await the storage at once.
+    :param config: the STORAGE_CONFIG (redis connection kwargs and pool options).
+    """
+    loop = asyncio.get_running_loop()
+    key = _pool_key(config)
+    with _async_pools_lock:
+        pools = _async_pools.setdefault(loop, {})
+        pool = pools.get(key)
+        if pool is None:
+            pool = _create_async_pool(config)
+            pool.name = _pool_name(config)
+            pools[key] = pool
+            log.info(
+                "Created asyncio Redis connection pool for %s (max_connections=%s).", pool.name, pool.max_connections
+            )
+        return pool
+
+
+async def disconnect_async_pools() -> None:
+    """
+    Close the pooled connections of the running event loop, e.g. on bot shutdown.
+    """
+    with _async_pools_lock:
+        pools = list(_async_pools.pop(asyncio.get_running_loop(), {}).values())
+    for pool in pools:
+        await pool.disconnect()
+
+
+class AsyncRedisStorage(RedisNamespace):
+    """
+    The RedisStorage API with awaitable calls, on a redis.asyncio client. Keys,
+    key index, values and expiries are laid out exactly as by RedisStorage, so both
+    can be used on the same namespace. Create it with open(), which builds the key
+    index of the namespace when needed.
+    """
+
+    @classmethod
+    async def open(cls, redis, namespace, serializer=None, ttl_policy=None) -> "AsyncRedisStorage":
+        storage = cls(redis, namespace, serializer, ttl_policy)
+        if not await storage.redis.sismember(INDEXED_NAMESPACES, namespace):
+            log.info("No key index for namespace '%s' yet, building it.", namespace)
+            await storage.rebuild_index()
+        return storage
+
+    def _invalidate(self, unique_key):
+        # No read cache: its invalidation thread is tied to the synchronous client.
+        pass
+
+    async def _written(self, count: int) -> None:
+        if self._count_writes(count):
+            await self.prune_index()
+
+    async def get(self, key: str, ttl: Optional[float] = None) -> Any:
+        """
+        :param ttl: push the expiry of the key back to ttl seconds from now,
+                    defaults to the sliding TTL policy of the key if any.
+        """
+        unique_key = self._make_nskey(key)
+        log.debug("Get key: %s", unique_key)
+        ttl = self._read_ttl(key, ttl)
+        if ttl is not None:
+            return await self._get_refresh(key, ttl)
+        try:
+            result = await self.redis.get(unique_key)
+        except redis.ResponseError as e:
+            if not is_wrongtype(e):
+                raise
+            return await self._get_container(unique_key)
+        if result is None:
+            raise KeyError("%s doesn't exists." % (unique_key))
+        return self.serializer.loads(result)
+
+    async def _get_refresh(self, key: str, ttl: float) -> Any:
+        unique_key = self._make_nskey(key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.getex(unique_key, px=int(ttl * 1000))
+        pipe.zadd(self._index_key, {compat_str(key): expiry_score(ttl)}, xx=True)
+        try:
+            result, _ = await pipe.execute()
+        except redis.ResponseError as e:
+            if not is_wrongtype(e):
+                raise
+            value = await self._get_container(unique_key)
+            await self.expire(key, ttl)
+            return value
+        if result is None:
+            raise KeyError("%s doesn't exists." % (unique_key))
+        return self.serializer.loads(result)
+
+    async def remove(self, key: str):
+        unique_key = self._make_nskey(key)
+        log.debug("Removing value at '%s'", unique_key)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(unique_key)
+        pipe.zrem(self._index_key, compat_str(key))
+        result, _ = await pipe.execute()
+        if not result:
+            raise KeyError("%s does not exist" % (unique_key))
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        async with self.batch() as batch:
+            batch.set(key, value, ttl)
+
+    async def expire(self, key: str, ttl: Optional[float]) -> bool:
+        async with self.batch() as batch:
+            batch.expire(key, ttl)
+        if ttl:
+            return bool(batch.results[0])
+        return bool(await self.redis.exists(self._make_nskey(key)))
+
+    async def ttl(self, key: str) -> Optional[float]:
+        pttl = await self.redis.pttl(self._make_nskey(key))
+        if pttl == -2:
+            raise KeyError("%s doesn't exists." % (self._make_nskey(key)))
+        return None if pttl < 0 else pttl / 1000
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get several keys in a single pipelined round-trip.
+        :return: a dict of the keys found and their values, missing keys are left out.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        pipe = self.redis.pipeline(transaction=False)
+        refreshed = {}
+        for key in keys:
+            ttl = self._read_ttl(key, None)
+            if ttl is None:
+                pipe.get(self._make_nskey(key))
+            else:
+                pipe.getex(self._make_nskey(key), px=int(ttl * 1000))
+                refreshed[compat_str(key)] = expiry_score(ttl)
+        if refreshed:
+            pipe.zadd(self._index_key, refreshed, xx=True)
+        results = await pipe.execute()
+        # Without the result of the ZADD, if any
+        found = {key: data for key, data in zip(keys, results[:len(keys)], strict=True) if data is not None}
+        log.debug("Get %d keys, %d found in '%s'", len(keys), len(found), self.ns)
+        return {key: self.serializer.loads(data) for key, data in found.items()}
+
+    async def set_many(self, mapping: Mapping[str, Any], ttl: Optional[float] = None) -> None:
+        if not mapping:
+            return
+        async with self.batch() as batch:
+            for key, value in mapping.items():
+                batch.set(key, value, ttl)
+        log.debug("Set %d keys in '%s'", len(mapping), self.ns)
+
+    async def delete_many(self, keys: Iterable[str]) -> int:
+        keys = [compat_str(key) for key in keys]
+        if not keys:
+            return 0
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(*[self._make_nskey(key) for key in keys])
+        pipe.zrem(self._index_key, *keys)
+        deleted, _ = await pipe.execute()
+        log.debug("Removed %d of %d keys in '%s'", deleted, len(keys), self.ns)
+        return deleted
+
+    def batch(self) -> "AsyncRedisBatch":
+        """
+        Group writes into a single MULTI/EXEC round-trip, applied when the
+        async with block exits without error. Queuing does not await.
+        """
+        return AsyncRedisBatch(self)
+
+    async def get_fields(self, key: str, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        unique_key = self._make_nskey(key)
+        try:
+            if fields is None:
+                raw = await self.redis.hgetall(unique_key)
+            else:
+                fields = list(fields)
+                raw = dict(zip(fields, await self.redis.hmget(unique_key, fields), strict=True))
+        except redis.ResponseError as e:
+            if not is_wrongtype(e):
+                raise
+            record = await self.get(key)
+            if not isinstance(record, dict):
+                raise
+            return record if fields is None else {f: record[f] for f in fields if f in record}
+        record = {compat_str(f): self.serializer.loads(v) for f, v in raw.items() if v is not None}
+        if not record and not await self.redis.exists(unique_key):
+            raise KeyError("%s doesn't exists." % (unique_key))
+        await self._refresh(key)
+        return record
+
+    async def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        async with self.batch() as batch:
+            batch.set_fields(key, mapping, replace, ttl)
+
+    async def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> int:
+        async with self.batch() as batch:
+            batch.append(key, *values, ttl=ttl)
+        return batch.results[0] if values else await self.list_len(key)
+
+    async def get_range(self, key: str, start: int = 0, end: int = -1) -> List[Any]:
+        values = [self.serializer.loads(v) for v in await self.redis.lrange(self._make_nskey(key), start, end)]
+        if values:
+            await self._refresh(key)
+        return values
+
+    async def list_len(self, key: str) -> int:
+        return await self.redis.llen(self._make_nskey(key))
+
+    async def _refresh(self, key: str) -> None:
+        ttl = self._read_ttl(key, None)
+        if ttl is not None:
+            await self.expire(key, ttl)
+
+    async def _get_container(self, unique_key):
+        kind = compat_str(await self.redis.type(unique_key))
+        if kind == "hash":
+            raw = await self.redis.hgetall(unique_key)
+            return {compat_str(f): self.serializer.loads(v) for f, v in raw.items()}
+        if kind == "list":
+            return [self.serializer.loads(v) for v in await self.redis.lrange(unique_key, 0, -1)]
+        raise KeyError("%s holds an unsupported %s value." % (unique_key, kind))
+
+    async def _expired(self, candidates: List[str]) -> List[str]:
+        # See RedisStorage._expired.
+        pipe = self.redis.pipeline(transaction=False)
+        for key in candidates:
+            pipe.pttl(self._make_nskey(key))
+        gone, rescored = [], {}
+        for key, pttl in zip(candidates, await pipe.execute(), strict=True):
+            if pttl == -2:
+                gone.append(key)
+            else:
+                rescored[key] = expiry_score(None if pttl < 0 else pttl / 1000)
+        pipe = self.redis.pipeline(transaction=False)
+        if gone:
+            pipe.zrem(self._index_key, *gone)
+        if rescored:
+            pipe.zadd(self._index_key, rescored, xx=True)
+        await pipe.execute()
+        return gone
+
+    async def _index_read(self, command: str):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(self._index_key, "-inf", int(time.time() * 1000))
+        if command == "len":
+            pipe.zcard(self._index_key)
+        else:
+            pipe.zrange(self._index_key, 0, -1)
+        candidates, result = await pipe.execute()
+        gone = await self._expired([compat_str(key) for key in candidates]) if candidates else []
+        return result, gone
+
+    async def prune_index(self) -> int:
+        candidates = await self.redis.zrangebyscore(self._index_key, "-inf", int(time.time() * 1000))
+        gone = await self._expired([compat_str(key) for key in candidates]) if candidates else []
+        if gone:
+            log.debug("Pruned %d expired keys from the index of '%s'", len(gone), self.ns)
+        return len(gone)
+
+    async def len(self) -> int:
+        count, gone = await self._index_read("len")
+        return count - len(gone)
+
+    async def keys(self) -> List[str]:
+        members, gone = await self._index_read("keys")
+        gone = set(gone)
+        return [key for key in (compat_str(member) for member in members) if key not in gone]
+
+    async def scan_keys(self, count: int = SCAN_COUNT) -> AsyncIterator[str]:
+        """
+        Iterate over the keys of the namespace straight from the keyspace, see RedisStorage.scan_keys.
+        """
+        async for unique_key in self.redis.scan_iter(match=self._all_keys, count=count):
+            yield self._strip_nskey(unique_key)
+
+    async def _index_batch(self, keys: List[str]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.pttl(self._make_nskey(key))
+        scores = {
+            key: expiry_score(None if pttl < 0 else pttl / 1000)
+            for key, pttl in zip(keys, await pipe.execute(), strict=True)
+            if pttl != -2
+        }
+        if scores:
+            await self.redis.zadd(self._index_key, scores)
+
+    async def rebuild_index(self, count: int = SCAN_COUNT) -> int:
+        """
+        Repair the key index from the keyspace, see RedisStorage.rebuild_index.
+        """
+        found = set()
+        batch = []
+        async for key in self.scan_keys(count):
+            if key in found:
+                continue
+            found.add(key)
+            batch.append(key)
+            if len(batch) >= count:
+                await self._index_batch(batch)
+                batch = []
+        if batch:
+            await self._index_batch(batch)
+
+        indexed = await self.redis.zrange(self._index_key, 0, -1)
+        stale = [compat_str(key) for key in indexed if compat_str(key) not in found]
+        if stale:
+            await self._expired(stale)
+        await self.redis.delete(":".join((LEGACY_INDEX_PREFIX, self.ns)))
+        await self.redis.sadd(INDEXED_NAMESPACES, self.ns)
+        log.info("Indexed %d keys for namespace '%s'.", len(found), self.ns)
+        return len(found)
+
+    async def close(self) -> None:
+        pass
+
+
+class AsyncRedisBatch(RedisBatch):
+    """
+    Writes queued in a MULTI/EXEC transaction of the asyncio client, see
+    AsyncRedisStorage.batch(). Commands are queued synchronously, only the
+    execution awaits.
+    """
+
+    async def execute(self) -> List[Any]:
+        if not self._index:
+            return []
+        self._queue_index()
+        writes = self._executed(await self._pipe.execute())
+        await self._storage._written(writes)
+        return self.results
+
+    async def __aenter__(self) -> "AsyncRedisBatch":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            await self.execute()
+        else:
+            await self._pipe.reset()
+
+
+class StorageLoop:
+    """
+    An event loop running in a daemon thread. The synchronous bridges run their
+    calls on it, and asyncio handlers scheduled on it share its connection pool.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="redis-async", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """
+        Run coro on the loop and wait for its result, from any other thread.
+        """
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Blocking storage call made from the storage loop, await the async storage instead.")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self) -> None:
+        self.run(disconnect_async_pools())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class SyncRedisStorage(StorageBase):
+    """
+    Blocking view of an AsyncRedisStorage for the synchronous plugins: each call
+    runs on the storage loop and waits for its result. The underlying storage is
+    async_storage, for the asyncio handlers running on the same loop.
+    """
+
+    def __init__(self, storage_loop: StorageLoop, storage: AsyncRedisStorage):
+        self._run = storage_loop.run
+        self.async_storage = storage
+        self.loop = storage_loop.loop
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Any:
+        return self._run(self.async_storage.get(key, ttl))
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._run(self.async_storage.set(key, value, ttl))
+
+    def remove(self, key: str):
+        self._run(self.async_storage.remove(key))
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        return self._run(self.async_storage.expire(key, ttl))
+
+    def ttl(self, key: str) -> Optional[float]:
+        return self._run(self.async_storage.ttl(key))
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        return self._run(self.async_storage.get_many(keys))
+
+    def set_many(self, mapping: Mapping[str, Any], ttl: Optional[float] = None) -> None:
+        self._run(self.async_storage.set_many(mapping, ttl))
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        return self._run(self.async_storage.delete_many(keys))
+
+    def batch(self) -> "SyncRedisBatch":
+        return SyncRedisBatch(self._run, self.async_storage.batch())
+
+    def get_fields(self, key: str, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        return self._run(self.async_storage.get_fields(key, fields))
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        self._run(self.async_storage.set_fields(key, mapping, replace, ttl))
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> int:
+        return self._run(self.async_storage.append(key, *values, ttl=ttl))
+
+    def get_range(self, key: str, start: int = 0, end: int = -1) -> List[Any]:
+        return self._run(self.async_storage.get_range(key, start, end))
+
+    def list_len(self, key: str) -> int:
+        return self._run(self.async_storage.list_len(key))
+
+    def prune_index(self) -> int:
+        return self._run(self.async_storage.prune_index())
+
+    def rebuild_index(self, count: int = SCAN_COUNT) -> int:
+        return self._run(self.async_storage.rebuild_index(count))
+
+    def scan_keys(self, count: int = SCAN_COUNT) -> Iterator[str]:
+        async def scan():
+            return [key async for key in self.async_storage.scan_keys(count)]
+
+        return iter(self._run(scan()))
+
+    def len(self):
+        return self._run(self.async_storage.len())
+
+    def keys(self):
+        return self._run(self.async_storage.keys())
+
+    def close(self) -> None:
+        pass
+
+
+class SyncRedisBatch:
+    """
+    Blocking view of an AsyncRedisBatch: writes are queued right away, the
+    transaction runs on the storage loop when the with block exits.
+    """
+
+    def __init__(self, run, batch: AsyncRedisBatch):
+        self._run = run
+        self._batch = batch
+
+    @property
+    def results(self) -> List[Any]:
+        return self._batch.results
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._batch.set(key, value, ttl)
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        self._batch.set_fields(key, mapping, replace, ttl)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> None:
+        self._batch.append(key, *values, ttl=ttl)
+
+    def expire(self, key: str, ttl: Optional[float]) -> None:
+        self._batch.expire(key, ttl)
+
+    def delete(self, key: str) -> None:
+        self._batch.delete(key)
+
+    def execute(self) -> List[Any]:
+        return self._run(self._batch.execute())
+
+    def __enter__(self) -> "SyncRedisBatch":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._run(self._batch.__aexit__(exc_type, exc_value, traceback))
+
+
+class AsyncRedisPlugin(StoragePluginBase):
+    def __init__(self, bot_config):
+        super().__init__(bot_config)
+        if self._storage_config.get("shards"):
+            raise ValueError("The AsyncRedis storage does not support shards, use the Redis storage.")
+        if self._storage_config.get("cache"):
+            log.warning("The read cache is not supported by the AsyncRedis storage, it is disabled.")
+        self._config = {k: v for k, v in self._storage_config.items() if k not in STORAGE_OPTIONS}
+        self._ttl_policies = {
+            namespace: TtlPolicy(rules) for namespace, rules in self._storage_config.get("ttl", {}).items()
+        }
+        compression = self._storage_config.get("compression")
+        self._serializer = Serializer(
+            self._storage_config.get("codec", "auto"), make_compressor(compression) if compression else None
+        )
+        self._storage_loop = None
+        self._lock = threading.Lock()
+
+    def _get_storage_loop(self) -> StorageLoop:
+        with self._lock:
+            if self._storage_loop is None:
+                self._storage_loop = StorageLoop()
+            return self._storage_loop
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """
+        The storage loop, started on first use. Handlers scheduled on it with
+        asyncio.run_coroutine_threadsafe() share the pool of the bridged storages.
+        """
+        return self._get_storage_loop().loop
+
+    def open(self, namespace: str) -> StorageBase:
+        storage_loop = self._get_storage_loop()
+        return SyncRedisStorage(storage_loop, storage_loop.run(self.open_async(namespace)))
+
+    async def open_async(self, namespace: str) -> AsyncRedisStorage:
+        """
+        Open namespace on the running event loop, with the connection pool of that loop.
+        """
+        connection = aioredis.StrictRedis(connection_pool=get_async_connection_pool(self._config))
+        return await AsyncRedisStorage.open(
+            connection, namespace, self._serializer, self._ttl_policies.get(namespace)
+        )
+
+    def shutdown(self) -> None:
+        """
+        Close the connections of the storage loop and stop it.
+        """
+        with self._lock:
+            storage_loop, self._storage_loop = self._storage_loop, None
+        if storage_loop is not None:
+            storage_loop.stop()
+
+    def compression_stats(self):
+        """
+        Compression ratio and CPU time spent (de)compressing values, None when it is not configured.
+        """
+        compressor = self._serializer.compressor
+        return compressor.stats() if compressor is not None else None
@@ -0,0 +1,204 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import redis
+
+log = logging.getLogger("errbot.storage.redis.cache")
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+# Keyspace events needed to see every way a key can change: K keyspace channel,
+# g generic (del, expire, rename...), $ strings, h hashes, l lists, x expired,
+# e evicted.
+REQUIRED_KEYSPACE_EVENTS = "Kg$hlxe"
+
+
+class ReadCache:
+    """
+    In-process LRU of raw stored values, bounded by entries and by bytes.
+
+    It holds the encoded bytes rather than the decoded objects, so a plugin
+    mutating what get() returned can never alter the cache. The cache starts
+    disabled and is only served while an invalidator guarantees that writes made
+    by other processes are seen.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = False
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if not self.enabled:
+                return None
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def epoch(self) -> int:
+        """
+        To be read before fetching a value, and given back to put(): a value fetched
+        while an invalidation happened may already be stale and is not cached.
+        """
+        return self._epoch
+
+    def put(self, key: str, data: bytes, epoch: int) -> None:
+        size = len(data)
+        with self._lock:
+            if not self.enabled or epoch != self._epoch or size > self.max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = data
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._epoch += 1
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._bytes -= len(data)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def set_enabled(self, enabled: bool) -> None:
+        self.clear()
+        self.enabled = enabled
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class KeyspaceInvalidator(threading.Thread):
+    """
+    Subscribes to the Redis keyspace notifications of the errbot keys and drops
+    the cached copy of every key modified, deleted, expired or evicted, whichever
+    replica did it.
+
+    The cache is only enabled while the subscription is up: if the connection
+    drops, notifications may have been missed, so the cache is emptied and
+    disabled until the subscription is restored.
+    """
+
+    def __init__(self, pool, cache: ReadCache, prefix: str, retry_delay: float = 5.0):
+        super().__init__(name="redis-cache-invalidator", daemon=True)
+        self.cache = cache
+        self.retry_delay = retry_delay
+        self._redis = redis.StrictRedis(connection_pool=pool)
+        db = pool.connection_kwargs.get("db", 0)
+        self._channel_prefix = "__keyspace@%s__:" % db
+        self._pattern = self._channel_prefix + prefix + ":*"
+        self._stop_event = threading.Event()
+
+    def _enable_notifications(self) -> bool:
+        try:
+            current = self._redis.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            current = current.decode() if isinstance(current, bytes) else current
+            enabled = set(current)
+            if "A" in enabled:
+                enabled.update("g$lshzxe")
+            missing = "".join(flag for flag in REQUIRED_KEYSPACE_EVENTS if flag not in enabled)
+            if missing:
+                self._redis.config_set("notify-keyspace-events", current + missing)
+            return True
+        except redis.RedisError as e:
+            log.warning(
+                "Cannot enable keyspace notifications (%s), set notify-keyspace-events to '%s' on "
+                "the server. The read cache stays disabled.",
+                e,
+                REQUIRED_KEYSPACE_EVENTS,
+            )
+            return False
+
+    def _listen(self) -> None:
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.psubscribe(self._pattern)
+            # Wait for the subscription to be acknowledged before serving from the cache.
+            pubsub.get_message(timeout=1.0, ignore_subscribe_messages=False)
+            self.cache.set_enabled(True)
+            log.info("Read cache enabled, invalidated by keyspace notifications on %s.", self._pattern)
+            while not self._stop_event.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"]
+                channel = channel.decode() if isinstance(channel, bytes) else channel
+                self.cache.invalidate(channel[len(self._channel_prefix):])
+        finally:
+            self.cache.set_enabled(False)
+            pubsub.close()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            if self._enable_notifications():
+                try:
+                    self._listen()
+                except redis.RedisError as e:
+                    log.warning("Lost the keyspace notifications subscription (%s), read cache disabled.", e)
+            self._stop_event.wait(self.retry_delay)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def start_cache(pool, prefix: str, config: Dict[str, Any]) -> ReadCache:
+    """
+    Create the read cache described by the 'cache' section of STORAGE_CONFIG and
+    start its invalidation.
+
+    :param pool: the connection pool of the storage, used for the subscription.
+    :param prefix: the global key prefix of the storage.
+    :param config: max_entries, max_bytes and invalidation ('keyspace', or 'none'
+                   which is only safe with a single bot process).
+    """
+    cache = ReadCache(config.get("max_entries", DEFAULT_MAX_ENTRIES), config.get("max_bytes", DEFAULT_MAX_BYTES))
+    invalidation = config.get("invalidation", "keyspace")
+    if invalidation == "keyspace":
+        cache.invalidator = KeyspaceInvalidator(pool, cache, prefix)
+        cache.invalidator.start()
+    elif invalidation == "none":
+        log.warning("Read cache without invalidation: only safe with a single bot replica.")
+        cache.set_enabled(True)
+    else:
+        raise ValueError("Unknown cache invalidation '%s', use 'keyspace' or 'none'." % invalidation)
+    return cache
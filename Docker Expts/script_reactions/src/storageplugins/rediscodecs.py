@@ -0,0 +1,189 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import logging
+import math
+from typing import Any, Optional
+
+from jsonpickle import decode, encode
+from rediscompress import Compressor, is_compressed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger("errbot.storage.redis.codecs")
+
+# Values written by a fast codec start with this 3 bytes header:
+#   FORMAT_MAGIC, FORMAT_VERSION, codec id
+# Legacy values are bare jsonpickle JSON documents, which never start with 0xEB
+# (not valid UTF-8 as a first byte), so both can live in the same namespace.
+FORMAT_MAGIC = 0xEB
+FORMAT_VERSION = 1
+HEADER_SIZE = 3
+
+_INT64_MIN = -(2**63)
+_UINT64_MAX = 2**64 - 1
+
+
+def is_plain(value: Any) -> bool:
+    """
+    Check that value only contains JSON native types (dict with str keys, list,
+    str, int, finite float, bool, None), i.e. that a fast codec round-trips it exactly.
+    Tuples, sets, bytes or custom objects need jsonpickle.
+    :param value: the value to check.
+    """
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        kind = type(item)
+        if kind is str or kind is bool or item is None:
+            continue
+        if kind is float:
+            if not math.isfinite(item):
+                return False
+        elif kind is int:
+            if not _INT64_MIN <= item <= _UINT64_MAX:
+                return False
+        elif kind is dict:
+            for k, v in item.items():
+                if type(k) is not str:
+                    return False
+                stack.append(v)
+        elif kind is list:
+            stack.extend(item)
+        else:
+            return False
+    return True
+
+
+class Codec:
+    """
+    A value encoding, identified in the header by its id.
+    """
+
+    name = None
+    id = None
+
+    def dumps(self, value: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonPickleCodec(Codec):
+    """
+    The historical encoding: handles any python object. Written without header.
+    """
+
+    name = "jsonpickle"
+    id = 0
+
+    def dumps(self, value: Any) -> bytes:
+        return encode(value).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return decode(data.decode("utf-8"))
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+    id = 1
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    id = 2
+
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+CODECS = {codec.name: codec for codec in (JsonPickleCodec(), OrjsonCodec(), MsgpackCodec())}
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+
+def available_codecs():
+    """
+    The names of the codecs whose library is installed.
+    """
+    names = ["jsonpickle"]
+    if orjson is not None:
+        names.append("orjson")
+    if msgpack is not None:
+        names.append("msgpack")
+    return names
+
+
+def default_codec_name() -> str:
+    """
+    The fastest installed codec: orjson, then msgpack, then jsonpickle.
+    """
+    names = available_codecs()
+    return names[1] if len(names) > 1 else "jsonpickle"
+
+
+class Serializer:
+    """
+    Turns stored values into bytes and back.
+
+    Values are written with the configured fast codec behind a format header when
+    they only contain JSON native types, and with headerless jsonpickle otherwise.
+    Reads detect the format, so values written by older versions of the storage
+    (plain jsonpickle) keep decoding and get rewritten in the new format the next
+    time they are set.
+
+    With a compressor, encoded values above its threshold are compressed, and
+    compressed values are detected on read whatever the current configuration.
+    """
+
+    def __init__(self, codec: str = "auto", compressor: Optional[Compressor] = None):
+        if codec == "auto":
+            codec = default_codec_name()
+        if codec not in CODECS:
+            raise ValueError("Unknown codec '%s', use one of %s." % (codec, ", ".join(CODECS)))
+        if codec not in available_codecs():
+            raise ValueError("The '%s' codec is configured but its library is not installed." % codec)
+        self.codec = CODECS[codec]
+        self._header = bytes((FORMAT_MAGIC, FORMAT_VERSION, self.codec.id))
+        self._fallback = CODECS["jsonpickle"]
+        self.compressor = compressor
+        # Decompresses values written while compression was enabled, even if it no longer is.
+        self._decompressor = compressor if compressor is not None else Compressor("zlib")
+        log.debug("Using the %s codec for stored values.", self.codec.name)
+
+    def dumps(self, value: Any) -> bytes:
+        if self.codec is self._fallback or not is_plain(value):
+            data = self._fallback.dumps(value)
+        else:
+            data = self._header + self.codec.dumps(value)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        return data
+
+    def loads(self, data: bytes) -> Any:
+        if is_compressed(data):
+            data = self._decompressor.decompress(data)
+        if not data or data[0] != FORMAT_MAGIC:
+            return self._fallback.loads(data)
+        if data[1] != FORMAT_VERSION:
+            raise ValueError("Unsupported stored value format version %d." % data[1])
+        codec = CODECS_BY_ID.get(data[2])
+        if codec is None or codec.name not in available_codecs():
+            raise ValueError("Stored value was written with codec id %d which is not available." % data[2])
+        return codec.loads(data[HEADER_SIZE:])
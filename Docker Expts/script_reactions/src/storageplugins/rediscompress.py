@@ -0,0 +1,181 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import logging
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger("errbot.storage.redis.compress")
+
+# Compressed values start with this 2 bytes header:
+#   COMPRESSED_MAGIC, algorithm id
+# followed by the compressed encoded value (itself with or without codec header).
+# 0xEC is not valid as a first UTF-8 byte either, so it cannot be mistaken for a
+# legacy jsonpickle document, nor for the 0xEB codec header.
+COMPRESSED_MAGIC = 0xEC
+COMPRESSED_HEADER_SIZE = 2
+
+DEFAULT_THRESHOLD = 4096
+
+
+class Compression:
+    """
+    A compression algorithm, identified in the header by its id.
+    """
+
+    name = None
+    id = None
+
+    def __init__(self, level: Optional[int] = None):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompression(Compression):
+    name = "zlib"
+    id = 1
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, 6 if self.level is None else self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompression(Compression):
+    name = "zstd"
+    id = 2
+
+    def __init__(self, level: Optional[int] = None):
+        super().__init__(level)
+        # zstandard (de)compressors must not be shared between threads.
+        self._local = threading.local()
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=3 if self.level is None else self.level)
+        return compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor()
+        return decompressor.decompress(data)
+
+
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (ZlibCompression, ZstdCompression)}
+ALGORITHMS_BY_ID = {algorithm.id: algorithm for algorithm in ALGORITHMS.values()}
+
+
+def available_algorithms():
+    """
+    The names of the compression algorithms whose library is installed.
+    """
+    names = ["zlib"]
+    if zstandard is not None:
+        names.append("zstd")
+    return names
+
+
+def is_compressed(data: bytes) -> bool:
+    return bool(data) and data[0] == COMPRESSED_MAGIC
+
+
+class Compressor:
+    """
+    Compresses the encoded values larger than a threshold, and decompresses any
+    compressed value whatever the configured algorithm, so the algorithm or the
+    threshold can be changed without rewriting the stored data.
+
+    Values that do not shrink are stored as they are.
+    """
+
+    def __init__(self, algorithm: str = "auto", threshold: int = DEFAULT_THRESHOLD, level: Optional[int] = None):
+        if algorithm == "auto":
+            algorithm = available_algorithms()[-1]
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unknown compression '%s', use one of %s." % (algorithm, ", ".join(ALGORITHMS)))
+        if algorithm not in available_algorithms():
+            raise ValueError("The '%s' compression is configured but its library is not installed." % algorithm)
+        self.algorithm = ALGORITHMS[algorithm](level)
+        self.threshold = threshold
+        self._header = bytes((COMPRESSED_MAGIC, self.algorithm.id))
+        self._decoders = {self.algorithm.id: self.algorithm}
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.incompressible = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.decompressed = 0
+        self.decompress_time = 0.0
+        log.debug("Compressing stored values over %d bytes with %s.", threshold, algorithm)
+
+    def compress(self, data: bytes) -> bytes:
+        if len(data) < self.threshold:
+            return data
+        start = time.perf_counter()
+        compressed = self._header + self.algorithm.compress(data)
+        elapsed = time.perf_counter() - start
+        shrunk = len(compressed) < len(data)
+        with self._lock:
+            self.compress_time += elapsed
+            if shrunk:
+                self.compressed += 1
+                self.bytes_in += len(data)
+                self.bytes_out += len(compressed)
+            else:
+                self.incompressible += 1
+        return compressed if shrunk else data
+
+    def decompress(self, data: bytes) -> bytes:
+        algorithm = self._decoders.get(data[1])
+        if algorithm is None:
+            cls = ALGORITHMS_BY_ID.get(data[1])
+            if cls is None or cls.name not in available_algorithms():
+                raise ValueError("Stored value was compressed with algorithm id %d which is not available." % data[1])
+            algorithm = self._decoders[data[1]] = cls()
+        start = time.perf_counter()
+        result = algorithm.decompress(data[COMPRESSED_HEADER_SIZE:])
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.decompressed += 1
+            self.decompress_time += elapsed
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "algorithm": self.algorithm.name,
+                "threshold": self.threshold,
+                "compressed": self.compressed,
+                "incompressible": self.incompressible,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": self.bytes_in / self.bytes_out if self.bytes_out else 0.0,
+                "compress_time": self.compress_time,
+                "decompressed": self.decompressed,
+                "decompress_time": self.decompress_time,
+            }
+
+
+def make_compressor(config: Dict[str, Any]) -> Compressor:
+    """
+    Create the compressor described by the 'compression' section of STORAGE_CONFIG.
+
+    :param config: algorithm ('zstd', 'zlib' or 'auto' for zstd when installed),
+                   threshold in bytes of encoded value and level.
+    """
+    return Compressor(config.get("algorithm", "auto"), config.get("threshold", DEFAULT_THRESHOLD), config.get("level"))
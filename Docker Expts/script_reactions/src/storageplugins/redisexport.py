@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+Streaming export and import of the namespaces of the Redis storage:
+
+    python redisexport.py export --url redis://redis:6379/0 --namespace JiraReactionMocker tickets.erbx
+    python redisexport.py import --url redis://other:6379/0 tickets.erbx [--namespace NewName]
+
+The export walks the namespace with SCAN and copies the keys with DUMP, one
+pipelined round-trip per batch, into a file of compressed, checksummed chunks.
+An interrupted export is resumed by running the same command again: the chunks
+already written are kept and SCAN restarts from the cursor of the last one.
+Memory use only depends on the chunk size.
+
+Import RESTOREs the keys (values, records and lists with their expiry) and adds
+them to the key index. It replaces existing keys, so it can be run again after a
+failure, or from a given chunk with --from-chunk.
+
+DUMP payloads can only be restored into a Redis of the same or a newer version.
+"""
+
+import argparse
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import redis
+from rediscompress import ALGORITHMS, available_algorithms
+from redispool import get_connection_pool
+from redisstorage import GLOBAL_PREFIX, INDEX_PREFIX, SCAN_COUNT, compat_str, escape_glob, expiry_score
+
+log = logging.getLogger("errbot.storage.redis.export")
+
+# File layout:
+#   FILE_MAGIC, FILE_VERSION, then frames of
+#   kind (1 byte), body length (u32), CRC32 of the body (u32), body
+# The first frame is a JSON header, then chunks, then a JSON end frame once the
+# export is complete. A chunk body is the SCAN cursor after its keys (u64), the
+# number of keys (u32) and the compressed records:
+#   key length (u16), key, PTTL at export (i64, -1 without expiry), DUMP length (u32), DUMP
+# Keys are stored relative to the namespace, so they can be imported under another.
+FILE_MAGIC = b"ERBX"
+FILE_VERSION = 1
+HEADER = b"H"
+CHUNK = b"C"
+END = b"E"
+
+_FRAME = struct.Struct(">cII")
+_CHUNK = struct.Struct(">QI")
+_KEY = struct.Struct(">H")
+_VALUE = struct.Struct(">qI")
+
+DEFAULT_CHUNK_KEYS = 2000
+PROGRESS_INTERVAL = 5.0
+
+
+class ExportFormatError(Exception):
+    pass
+
+
+def _frame(kind: bytes, body: bytes) -> bytes:
+    return _FRAME.pack(kind, len(body), zlib.crc32(body)) + body
+
+
+def _read_frames(f) -> Iterator[Tuple[int, bytes, bytes]]:
+    """
+    Yield (offset, kind, body) of the valid frames of f, stopping at the end of
+    the file or at the first truncated or corrupted frame.
+    """
+    while True:
+        offset = f.tell()
+        head = f.read(_FRAME.size)
+        if len(head) < _FRAME.size:
+            return
+        kind, length, crc = _FRAME.unpack(head)
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc:
+            log.warning("Truncated or corrupted frame at offset %d, ignoring the rest of the file.", offset)
+            return
+        yield offset, kind, body
+
+
+def _open_export(path: str) -> Tuple[Any, Dict[str, Any]]:
+    f = open(path, "rb")
+    if f.read(len(FILE_MAGIC) + 1) != FILE_MAGIC + bytes((FILE_VERSION,)):
+        f.close()
+        raise ExportFormatError("%s is not a storage export." % path)
+    _, kind, body = next(_read_frames(f), (None, None, None))
+    if kind != HEADER:
+        f.close()
+        raise ExportFormatError("%s has no header." % path)
+    return f, json.loads(body)
+
+
+def _encode_records(records: List[Tuple[str, int, bytes]]) -> bytes:
+    parts = []
+    for key, pttl, data in records:
+        encoded = key.encode("utf-8")
+        parts += (_KEY.pack(len(encoded)), encoded, _VALUE.pack(pttl, len(data)), data)
+    return b"".join(parts)
+
+
+def _decode_records(data: bytes) -> Iterator[Tuple[str, int, bytes]]:
+    pos = 0
+    while pos < len(data):
+        (key_length,) = _KEY.unpack_from(data, pos)
+        pos += _KEY.size
+        key = data[pos:pos + key_length].decode("utf-8")
+        pos += key_length
+        pttl, length = _VALUE.unpack_from(data, pos)
+        pos += _VALUE.size
+        yield key, pttl, data[pos:pos + length]
+        pos += length
+
+
+class Throughput:
+    """
+    Counts keys and bytes and reports the rate at most every interval seconds.
+    """
+
+    def __init__(self, action: str, progress: Optional[Callable[[str], None]], interval: float = PROGRESS_INTERVAL):
+        self.action = action
+        self.progress = progress
+        self.interval = interval
+        self.keys = 0
+        self.bytes = 0
+        self.started = self._reported = time.monotonic()
+
+    def add(self, keys: int, size: int, force: bool = False) -> None:
+        self.keys += keys
+        self.bytes += size
+        now = time.monotonic()
+        if self.progress is not None and (force or now - self._reported >= self.interval):
+            self._reported = now
+            elapsed = max(now - self.started, 1e-9)
+            self.progress(
+                "%s %d keys, %.1f MB in %.1fs (%.0f keys/s, %.2f MB/s)"
+                % (self.action, self.keys, self.bytes / 1e6, elapsed, self.keys / elapsed, self.bytes / 1e6 / elapsed)
+            )
+
+
+def export_namespace(
+    client: redis.StrictRedis,
+    namespace: str,
+    path: str,
+    compression: str = "auto",
+    count: int = SCAN_COUNT,
+    chunk_keys: int = DEFAULT_CHUNK_KEYS,
+    progress: Optional[Callable[[str], None]] = None,
+) -> int:
+    """
+    Export the keys of namespace to path, resuming the export already there if any.
+    :param compression: the chunk compression, 'zlib', 'zstd' or 'auto'.
+    :param count: the SCAN COUNT hint and the number of keys dumped per round-trip.
+    :param chunk_keys: the number of keys per chunk, which bounds memory use.
+    :return: the number of keys in the file.
+    """
+    cursor, exported = 0, 0
+    if os.path.exists(path):
+        f, header = _open_export(path)
+        with f:
+            if header["namespace"] != namespace:
+                raise ExportFormatError("%s is an export of '%s'." % (path, header["namespace"]))
+            end = f.tell()
+            for offset, kind, body in _read_frames(f):
+                end = offset + _FRAME.size + len(body)
+                if kind == END:
+                    log.info("%s is a complete export of %d keys.", path, exported)
+                    return exported
+                cursor, keys = _CHUNK.unpack_from(body)
+                exported += keys
+        algorithm = ALGORITHMS[header["compression"]]()
+        if exported and cursor == 0:
+            log.info("Writing the end of %s.", path)
+        elif exported:
+            log.info("Resuming the export to %s after %d keys.", path, exported)
+        out = open(path, "r+b")
+        out.truncate(end)
+        out.seek(end)
+    else:
+        if compression == "auto":
+            compression = available_algorithms()[-1]
+        algorithm = ALGORITHMS[compression]()
+        out = open(path, "wb")
+        out.write(FILE_MAGIC + bytes((FILE_VERSION,)))
+        header = {"namespace": namespace, "compression": compression, "created": time.time()}
+        out.write(_frame(HEADER, json.dumps(header).encode("utf-8")))
+
+    prefix = ":".join((GLOBAL_PREFIX, namespace, ""))
+    match = escape_glob(prefix) + "*"
+    throughput = Throughput("Exported", progress)
+    with out:
+        records, size = [], 0
+        done = exported > 0 and cursor == 0
+        while not done:
+            cursor, unique_keys = client.scan(cursor, match=match, count=count)
+            done = cursor == 0
+            if unique_keys:
+                # MULTI/EXEC: the DUMP and PTTL of a key see the same state, a key
+                # expiring in between would otherwise be restored without expiry.
+                pipe = client.pipeline(transaction=True)
+                for unique_key in unique_keys:
+                    pipe.dump(unique_key)
+                    pipe.pttl(unique_key)
+                results = pipe.execute()
+                for unique_key, data, pttl in zip(unique_keys, results[::2], results[1::2], strict=True):
+                    # Gone between SCAN and DUMP.
+                    if data is not None and pttl != -2:
+                        records.append((compat_str(unique_key)[len(prefix):], pttl, data))
+                        size += len(data)
+            if records and (len(records) >= chunk_keys or done):
+                body = algorithm.compress(_encode_records(records))
+                out.write(_frame(CHUNK, _CHUNK.pack(cursor, len(records)) + body))
+                out.flush()
+                exported += len(records)
+                throughput.add(len(records), size)
+                records, size = [], 0
+        out.write(_frame(END, json.dumps({"keys": exported, "finished": time.time()}).encode("utf-8")))
+    throughput.add(0, 0, force=True)
+    return exported
+
+
+def import_namespace(
+    client: redis.StrictRedis,
+    path: str,
+    namespace: Optional[str] = None,
+    from_chunk: int = 0,
+    progress: Optional[Callable[[str], None]] = None,
+) -> int:
+    """
+    Restore the keys exported to path, replacing existing keys, and index them.
+    :param namespace: the namespace to restore them in, the exported one by default.
+    :param from_chunk: skip the chunks before this one (counting from 0).
+    :return: the number of keys restored.
+    """
+    f, header = _open_export(path)
+    namespace = namespace or header["namespace"]
+    index_key = ":".join((INDEX_PREFIX, namespace))
+    throughput = Throughput("Imported", progress)
+    algorithm = ALGORITHMS[header["compression"]]
+    if algorithm.name not in available_algorithms():
+        raise ExportFormatError("%s is compressed with %s which is not installed." % (path, algorithm.name))
+    algorithm = algorithm()
+    complete = False
+    chunk = 0
+    with f:
+        for _, kind, body in _read_frames(f):
+            if kind == END:
+                complete = True
+                break
+            _, keys = _CHUNK.unpack_from(body)
+            if chunk >= from_chunk:
+                records = _decode_records(algorithm.decompress(body[_CHUNK.size:]))
+                pipe = client.pipeline(transaction=False)
+                scores = {}
+                size = 0
+                for key, pttl, data in records:
+                    pipe.restore(":".join((GLOBAL_PREFIX, namespace, key)), max(pttl, 0), data, replace=True)
+                    scores[key] = expiry_score(pttl / 1000 if pttl > 0 else None)
+                    size += len(data)
+                # A namespace not indexed yet gets its whole index built when opened.
+                pipe.zadd(index_key, scores)
+                pipe.execute()
+                throughput.add(keys, size)
+            chunk += 1
+    throughput.add(0, 0, force=True)
+    if not complete:
+        log.warning("%s is an incomplete export, %d chunks were read.", path, chunk)
+    return throughput.keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="redis://localhost:6379/0", help="the Redis to read from or write to")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="export a namespace, or resume its export")
+    export.add_argument("--namespace", required=True)
+    export.add_argument("--compression", default="auto", choices=["auto"] + list(ALGORITHMS))
+    export.add_argument("--count", type=int, default=SCAN_COUNT, help="keys per round-trip")
+    export.add_argument("--chunk-keys", type=int, default=DEFAULT_CHUNK_KEYS, help="keys per chunk")
+    export.add_argument("path")
+    restore = commands.add_parser("import", help="import an export")
+    restore.add_argument("--namespace", help="import under another namespace")
+    restore.add_argument("--from-chunk", type=int, default=0)
+    restore.add_argument("path")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    client = redis.StrictRedis(connection_pool=get_connection_pool({"url": args.url}))
+    if args.command == "export":
+        keys = export_namespace(
+            client, args.namespace, args.path, args.compression, args.count, args.chunk_keys, progress=print
+        )
+    else:
+        keys = import_namespace(client, args.path, args.namespace, args.from_chunk, progress=print)
+    print("%s: %d keys" % (args.path, keys))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+Instrumentation of the storage: per namespace and operation latency histograms,
+call and error counts, bytes read and written, and sampled hot and big key
+trackers, exported as a dict or in the Prometheus text format.
+"""
+
+import bisect
+import functools
+import random
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+# Upper bounds of the latency buckets, in seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_TOP_K = 20
+
+_local = threading.local()
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets, as Prometheus expects them.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        The upper bound of the bucket holding the q quantile, inf past the last bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.counts, strict=True):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class TopK:
+    """
+    The k heaviest keys, with the Space-Saving algorithm when counting (a new key
+    evicts the lightest one and inherits its weight, so heavy keys are never
+    missed and light ones may be overestimated), or the largest value seen when
+    keeping maxima.
+    """
+
+    def __init__(self, k: int, maximum: bool = False):
+        self.k = k
+        self.maximum = maximum
+        self.weights = {}
+
+    def add(self, key: str, weight: float = 1) -> None:
+        weights = self.weights
+        if key in weights:
+            weights[key] = max(weights[key], weight) if self.maximum else weights[key] + weight
+        elif len(weights) < self.k:
+            weights[key] = weight
+        else:
+            lightest = min(weights, key=weights.get)
+            if self.maximum and weights[lightest] >= weight:
+                return
+            floor = 0 if self.maximum else weights[lightest]
+            del weights[lightest]
+            weights[key] = floor + weight
+
+    def top(self) -> List[Tuple[str, float]]:
+        return sorted(self.weights.items(), key=lambda item: item[1], reverse=True)
+
+
+class NamespaceMetrics:
+    """
+    The counters of one namespace. Nested operations (the batch behind set(),
+    the get() behind get_fields()...) are only accounted to the outermost one.
+    """
+
+    def __init__(self, namespace: str, sample_rate: float = DEFAULT_SAMPLE_RATE, top_k: int = DEFAULT_TOP_K):
+        self.namespace = namespace
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.hot_keys = TopK(top_k)
+        self.big_keys = TopK(top_k, maximum=True)
+
+    def _sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def observe(self, op: str, elapsed: float, key: Optional[str] = None, failed: bool = False) -> None:
+        with self._lock:
+            histogram = self.latency.get(op)
+            if histogram is None:
+                histogram = self.latency[op] = Histogram()
+            histogram.observe(elapsed)
+            if failed:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            if key is not None and self._sampled():
+                self.hot_keys.add(key)
+
+    def read(self, key: str, size: int) -> None:
+        with self._lock:
+            self.bytes_read += size
+            if self._sampled():
+                self.big_keys.add(key, size)
+
+    def written(self, key: str, size: int) -> None:
+        with self._lock:
+            self.bytes_written += size
+            if self._sampled():
+                self.big_keys.add(key, size)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ops": {
+                    op: {
+                        "calls": histogram.count,
+                        "errors": self.errors.get(op, 0),
+                        "avg": histogram.sum / histogram.count,
+                        "p50": histogram.quantile(0.5),
+                        "p99": histogram.quantile(0.99),
+                    }
+                    for op, histogram in self.latency.items()
+                },
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "hot_keys": self.hot_keys.top(),
+                "big_keys": self.big_keys.top(),
+            }
+
+
+class StorageMetrics:
+    """
+    The metrics of every namespace of a storage plugin, from the 'metrics'
+    section of STORAGE_CONFIG (sample_rate of the key trackers, top_k keys kept).
+    """
+
+    def __init__(self, config: Optional[Mapping[str, Any]] = None):
+        config = config if isinstance(config, Mapping) else {}
+        self.sample_rate = config.get("sample_rate", DEFAULT_SAMPLE_RATE)
+        self.top_k = config.get("top_k", DEFAULT_TOP_K)
+        self._lock = threading.Lock()
+        self._namespaces = {}
+
+    def namespace(self, namespace: str) -> NamespaceMetrics:
+        with self._lock:
+            metrics = self._namespaces.get(namespace)
+            if metrics is None:
+                metrics = self._namespaces[namespace] = NamespaceMetrics(namespace, self.sample_rate, self.top_k)
+            return metrics
+
+    def as_dict(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            namespaces = list(self._namespaces.values())
+        return {metrics.namespace: metrics.as_dict() for metrics in namespaces}
+
+    def prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            namespaces = list(self._namespaces.values())
+        duration = "errbot_storage_op_duration_seconds"
+        lines = ["# HELP %s Latency of the storage operations." % duration, "# TYPE %s histogram" % duration]
+        errors, read, written, hot, big = [], [], [], [], []
+        for metrics in namespaces:
+            ns = _label(metrics.namespace)
+            with metrics._lock:
+                for op, histogram in sorted(metrics.latency.items()):
+                    labels = 'namespace="%s",op="%s"' % (ns, op)
+                    cumulative = 0
+                    # The overflow bucket is the +Inf line below
+                    for bound, count in zip(LATENCY_BUCKETS, histogram.counts[:-1], strict=True):
+                        cumulative += count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (duration, labels, bound, cumulative))
+                    lines.append('%s_bucket{%s,le="+Inf"} %d' % (duration, labels, histogram.count))
+                    lines.append("%s_sum{%s} %f" % (duration, labels, histogram.sum))
+                    lines.append("%s_count{%s} %d" % (duration, labels, histogram.count))
+                    errors.append("errbot_storage_op_errors_total{%s} %d" % (labels, metrics.errors.get(op, 0)))
+                read.append('errbot_storage_read_bytes_total{namespace="%s"} %d' % (ns, metrics.bytes_read))
+                written.append('errbot_storage_written_bytes_total{namespace="%s"} %d' % (ns, metrics.bytes_written))
+                for key, count in metrics.hot_keys.top():
+                    labels = 'namespace="%s",key="%s"' % (ns, _label(key))
+                    hot.append("errbot_storage_hot_key_sampled_calls{%s} %d" % (labels, count))
+                for key, size in metrics.big_keys.top():
+                    labels = 'namespace="%s",key="%s"' % (ns, _label(key))
+                    big.append("errbot_storage_big_key_bytes{%s} %d" % (labels, size))
+        for name, kind, help_text, samples in (
+            ("errbot_storage_op_errors_total", "counter", "Storage operations that raised an error.", errors),
+            ("errbot_storage_read_bytes_total", "counter", "Encoded bytes read from the storage.", read),
+            ("errbot_storage_written_bytes_total", "counter", "Encoded bytes written to the storage.", written),
+            ("errbot_storage_hot_key_sampled_calls", "gauge", "Sampled calls of the most used keys.", hot),
+            ("errbot_storage_big_key_bytes", "gauge", "Largest sampled encoded size of the biggest keys.", big),
+        ):
+            lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, kind)] + samples
+        return "\n".join(lines) + "\n"
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def timed(op: str, keyed: bool = False):
+    """
+    Record the latency of a storage method in the metrics of its storage, if any.
+    :param keyed: the first argument of the method is a key, tracked as a hot key.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None or getattr(_local, "active", False):
+                return method(self, *args, **kwargs)
+            _local.active = True
+            failed = False
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            except KeyError:
+                # A missing key is an answer, not a failure.
+                raise
+            except Exception:
+                failed = True
+                raise
+            finally:
+                _local.active = False
+                key = str(args[0]) if keyed and args else None
+                metrics.observe(op, time.perf_counter() - start, key, failed)
+
+        return wrapper
+
+    return decorator
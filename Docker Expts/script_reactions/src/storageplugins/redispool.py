@@ -0,0 +1,236 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import logging
+import threading
+import time
+from typing import Any, Dict
+
+from redis.connection import (
+    BlockingConnectionPool,
+    Connection,
+    ConnectionPool,
+    SSLConnection,
+    UnixDomainSocketConnection,
+)
+
+log = logging.getLogger("errbot.storage.redis.pool")
+
+# STORAGE_CONFIG options consumed by the pool rather than passed to the connections.
+POOL_OPTIONS = ("url", "max_connections", "pool_blocking", "pool_timeout")
+
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolStats:
+    """
+    Counters shared by a pool and the connections it creates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.exhausted = 0
+        self.peak_in_use = 0
+        self.connects = 0
+        self.connect_time = 0.0
+        self.connect_time_max = 0.0
+
+    def record_acquire(self, waited: bool, elapsed: float, in_use: int) -> None:
+        with self._lock:
+            self.acquired += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += elapsed
+            self.peak_in_use = max(self.peak_in_use, in_use)
+
+    def record_exhausted(self) -> None:
+        with self._lock:
+            self.exhausted += 1
+
+    def record_connect(self, elapsed: float) -> None:
+        with self._lock:
+            self.connects += 1
+            self.connect_time += elapsed
+            self.connect_time_max = max(self.connect_time_max, elapsed)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_time_total": self.wait_time,
+                "exhausted": self.exhausted,
+                "peak_in_use": self.peak_in_use,
+                "connects": self.connects,
+                "connect_latency_avg": self.connect_time / self.connects if self.connects else 0.0,
+                "connect_latency_max": self.connect_time_max,
+            }
+
+
+class _TimedConnectMixin:
+    def __init__(self, *args, stats=None, **kwargs):
+        self._pool_stats = stats
+        super().__init__(*args, **kwargs)
+
+    def connect(self):
+        if self._sock or self._pool_stats is None:
+            return super().connect()
+        start = time.perf_counter()
+        super().connect()
+        self._pool_stats.record_connect(time.perf_counter() - start)
+
+
+class TimedConnection(_TimedConnectMixin, Connection):
+    pass
+
+
+class TimedSSLConnection(_TimedConnectMixin, SSLConnection):
+    pass
+
+
+class TimedUnixDomainSocketConnection(_TimedConnectMixin, UnixDomainSocketConnection):
+    pass
+
+
+class _StatsPoolMixin:
+    def in_use(self) -> int:
+        raise NotImplementedError
+
+    def _free_slots(self) -> bool:
+        raise NotImplementedError
+
+    def get_connection(self, *args, **kwargs):
+        stats = self.connection_kwargs["stats"]
+        waited = not self._free_slots()
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except Exception:
+            if waited:
+                stats.record_exhausted()
+            raise
+        stats.record_acquire(waited, time.perf_counter() - start, self.in_use())
+        return connection
+
+    def stats(self) -> Dict[str, Any]:
+        result = self.connection_kwargs["stats"].as_dict()
+        result["in_use"] = self.in_use()
+        result["max_connections"] = self.max_connections
+        return result
+
+
+class StatsConnectionPool(_StatsPoolMixin, ConnectionPool):
+    """
+    Non blocking pool: raises ConnectionError once max_connections are in use.
+    """
+
+    def in_use(self) -> int:
+        return len(self._in_use_connections)
+
+    def _free_slots(self) -> bool:
+        return bool(self._available_connections) or self._created_connections < self.max_connections
+
+
+class StatsBlockingConnectionPool(_StatsPoolMixin, BlockingConnectionPool):
+    """
+    Blocking pool: waits up to pool_timeout seconds for a connection to be released.
+    """
+
+    def in_use(self) -> int:
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return len(self._connections) - idle
+
+    def _free_slots(self) -> bool:
+        return not self.pool.empty()
+
+
+def _pool_key(config: Dict[str, Any]) -> str:
+    return repr(sorted((k, repr(v)) for k, v in config.items()))
+
+
+def _pool_name(config: Dict[str, Any]) -> str:
+    if "url" in config:
+        return config["url"].split("@")[-1]
+    if "unix_socket_path" in config:
+        return "%s/%s" % (config["unix_socket_path"], config.get("db", 0))
+    return "%s:%s/%s" % (config.get("host", "localhost"), config.get("port", 6379), config.get("db", 0))
+
+
+def _create_pool(config: Dict[str, Any]):
+    kwargs = {k: v for k, v in config.items() if k not in POOL_OPTIONS}
+    kwargs.setdefault("socket_keepalive", True)
+    kwargs.setdefault("health_check_interval", DEFAULT_HEALTH_CHECK_INTERVAL)
+    kwargs["stats"] = PoolStats()
+
+    blocking = config.get("pool_blocking", True)
+    pool_class = StatsBlockingConnectionPool if blocking else StatsConnectionPool
+    pool_kwargs = {"max_connections": config.get("max_connections", DEFAULT_MAX_CONNECTIONS)}
+    if blocking:
+        pool_kwargs["timeout"] = config.get("pool_timeout", DEFAULT_POOL_TIMEOUT)
+
+    url = config.get("url", "")
+    if url.startswith("unix://") or "unix_socket_path" in kwargs:
+        if "unix_socket_path" in kwargs:
+            kwargs["path"] = kwargs.pop("unix_socket_path")
+        for tcp_only in ("host", "port", "socket_keepalive", "socket_keepalive_options"):
+            kwargs.pop(tcp_only, None)
+        connection_class = TimedUnixDomainSocketConnection
+    elif url.startswith("rediss://") or kwargs.pop("ssl", False):
+        connection_class = TimedSSLConnection
+    else:
+        connection_class = TimedConnection
+
+    if url:
+        return pool_class.from_url(url, connection_class=connection_class, **pool_kwargs, **kwargs)
+    return pool_class(connection_class=connection_class, **pool_kwargs, **kwargs)
+
+
+def get_connection_pool(config: Dict[str, Any]):
+    """
+    Return the process-wide connection pool for this STORAGE_CONFIG, creating it
+    on first use. Every namespace opened with the same config shares it, so the
+    number of sockets depends on concurrency, not on the number of plugins.
+    :param config: the STORAGE_CONFIG (redis connection kwargs and pool options).
+    """
+    key = _pool_key(config)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _create_pool(config)
+            pool.name = _pool_name(config)
+            _pools[key] = pool
+            log.info(
+                "Created Redis connection pool for %s (max_connections=%s, blocking=%s).",
+                pool.name,
+                pool.max_connections,
+                isinstance(pool, BlockingConnectionPool),
+            )
+        return pool
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Statistics of every pool of the process: connections in use, acquisitions that
+    had to wait, connect latency...
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.stats() for pool in pools}
+
+
+def disconnect_all() -> None:
+    """
+    Close every pooled connection, e.g. on bot shutdown.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.disconnect()
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+r"""
+Client-side sharding of the storage over several Redis instances, and the tool
+moving keys to their shard after the list of shards changed:
+
+    python redisshard.py --shard redis://redis-0:6379/0 --shard redis://redis-1:6379/0 \
+                         --shard redis://redis-2:6379/0 [--drain redis://old:6379/0] [--dry-run]
+
+Give the same shards, names and virtual_nodes as in STORAGE_CONFIG, and stop
+the bot while it runs: a key written during its move may be lost.
+"""
+
+import argparse
+import bisect
+import hashlib
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+import redis
+from errbot.storage.base import StorageBase
+from redispool import get_connection_pool
+from redisstorage import GLOBAL_PREFIX, INDEX_PREFIX, INDEXED_NAMESPACES, SCAN_COUNT, RedisStorage, expiry_score
+
+log = logging.getLogger("errbot.storage.redis.shard")
+
+DEFAULT_VIRTUAL_NODES = 160
+
+
+def _hash(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring: every node is placed at virtual_nodes points of a 64 bits
+    circle and a key belongs to the first node point after its own hash. Adding
+    or removing a node only moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = DEFAULT_VIRTUAL_NODES):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("A hash ring needs at least one node.")
+        points = sorted((_hash("%s#%d" % (node, i)), node) for node in self.nodes for i in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._owners[i % len(self._owners)]
+
+
+def shard_name(config: Mapping[str, Any], pool) -> str:
+    """
+    The ring identity of a shard: its 'name' if configured, else its address.
+    """
+    return config.get("name") or pool.name
+
+
+class ShardedRedisStorage(StorageBase):
+    """
+    A namespace spread over several Redis instances. Each key lives on the shard
+    the ring picks for its full name (errbot:<namespace>:<key>), and each shard
+    keeps the key index of the part of the namespace it holds, so keys() and
+    len() query every shard in parallel and merge.
+
+    Single key operations are as atomic as with one Redis; a batch or a *_many
+    call is atomic per shard only.
+    """
+
+    def __init__(
+        self,
+        shards: Mapping[str, redis.StrictRedis],
+        namespace: str,
+        serializer=None,
+        ttl_policy=None,
+        ring: Optional[HashRing] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.ns = namespace
+        self.ring = ring or HashRing(shards)
+        self.shards = {
+            name: RedisStorage(client, namespace, serializer, None, ttl_policy) for name, client in shards.items()
+        }
+        self._executor = executor or ThreadPoolExecutor(len(self.shards), thread_name_prefix="redis-shard")
+
+    def shard_for(self, key: str) -> RedisStorage:
+        return self.shards[self.ring.node_for(":".join((GLOBAL_PREFIX, self.ns, key)))]
+
+    def _group(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.ring.node_for(":".join((GLOBAL_PREFIX, self.ns, key)))].append(key)
+        return groups
+
+    def _fan_out(self, call: Callable[[str], Any], names: Optional[Iterable[str]] = None) -> List[Any]:
+        # Run call(shard name) on every shard, or on the given ones, in parallel.
+        names = list(names if names is not None else self.shards)
+        if len(names) == 1:
+            return [call(names[0])]
+        return list(self._executor.map(call, names))
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Any:
+        return self.shard_for(key).get(key, ttl)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.shard_for(key).set(key, value, ttl)
+
+    def remove(self, key: str):
+        self.shard_for(key).remove(key)
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        return self.shard_for(key).expire(key, ttl)
+
+    def ttl(self, key: str) -> Optional[float]:
+        return self.shard_for(key).ttl(key)
+
+    def get_fields(self, key: str, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        return self.shard_for(key).get_fields(key, fields)
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        self.shard_for(key).set_fields(key, mapping, replace, ttl)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> int:
+        return self.shard_for(key).append(key, *values, ttl=ttl)
+
+    def get_range(self, key: str, start: int = 0, end: int = -1) -> List[Any]:
+        return self.shard_for(key).get_range(key, start, end)
+
+    def list_len(self, key: str) -> int:
+        return self.shard_for(key).list_len(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        groups = self._group(keys)
+        found = {}
+        for result in self._fan_out(lambda name: self.shards[name].get_many(groups[name]), groups):
+            found.update(result)
+        return found
+
+    def set_many(self, mapping: Mapping[str, Any], ttl: Optional[float] = None) -> None:
+        groups = self._group(mapping)
+        self._fan_out(lambda name: self.shards[name].set_many({k: mapping[k] for k in groups[name]}, ttl), groups)
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        groups = self._group(keys)
+        return sum(self._fan_out(lambda name: self.shards[name].delete_many(groups[name]), groups))
+
+    def batch(self) -> "ShardedBatch":
+        """
+        Group writes per shard, each shard applying its part in one MULTI/EXEC.
+        """
+        return ShardedBatch(self)
+
+    def len(self):
+        return sum(self._fan_out(lambda name: self.shards[name].len()))
+
+    def keys(self):
+        keys = []
+        for shard_keys in self._fan_out(lambda name: self.shards[name].keys()):
+            keys.extend(shard_keys)
+        return keys
+
+    def scan_keys(self, count: int = SCAN_COUNT) -> Iterator[str]:
+        for storage in self.shards.values():
+            yield from storage.scan_keys(count)
+
+    def prune_index(self) -> int:
+        return sum(self._fan_out(lambda name: self.shards[name].prune_index()))
+
+    def rebuild_index(self, count: int = SCAN_COUNT) -> int:
+        return sum(self._fan_out(lambda name: self.shards[name].rebuild_index(count)))
+
+    def close(self) -> None:
+        pass
+
+
+class ShardedBatch:
+    """
+    A RedisBatch per shard touched, see ShardedRedisStorage.batch(). Once executed,
+    results maps each shard name to the results of its transaction.
+    """
+
+    def __init__(self, storage: ShardedRedisStorage):
+        self._storage = storage
+        self._batches = {}
+        self.results = {}
+
+    def _for(self, key: str):
+        name = self._storage.ring.node_for(":".join((GLOBAL_PREFIX, self._storage.ns, key)))
+        batch = self._batches.get(name)
+        if batch is None:
+            batch = self._batches[name] = self._storage.shards[name].batch()
+        return batch
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._for(key).set(key, value, ttl)
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        self._for(key).set_fields(key, mapping, replace, ttl)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> None:
+        self._for(key).append(key, *values, ttl=ttl)
+
+    def expire(self, key: str, ttl: Optional[float]) -> None:
+        self._for(key).expire(key, ttl)
+
+    def delete(self, key: str) -> None:
+        self._for(key).delete(key)
+
+    def execute(self) -> Dict[str, List[Any]]:
+        self.results = {name: batch.execute() for name, batch in self._batches.items()}
+        self._batches = {}
+        return self.results
+
+    def __enter__(self) -> "ShardedBatch":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.execute()
+        else:
+            for batch in self._batches.values():
+                batch.__exit__(exc_type, exc_value, traceback)
+            self._batches = {}
+
+
+def _index_key(unique_key: str) -> Tuple[str, str, str]:
+    # errbot:<namespace>:<key> -> (index key, namespace, key)
+    _, namespace, key = unique_key.split(":", 2)
+    return ":".join((INDEX_PREFIX, namespace)), namespace, key
+
+
+def rebalance(
+    clients: Mapping[str, redis.StrictRedis],
+    ring: HashRing,
+    count: int = SCAN_COUNT,
+    dry_run: bool = False,
+    progress: Optional[Callable[[str], None]] = None,
+) -> Dict[Tuple[str, str], int]:
+    """
+    Move every key to the shard the ring assigns it, with DUMP/RESTORE so values,
+    records, lists and expiries are kept as they are, and update the key indexes
+    of both shards.
+
+    :param clients: every shard holding data, including the ones being drained
+                    (absent from the ring).
+    :param ring: the new ring.
+    :param count: the SCAN COUNT hint and the number of keys moved per round-trip.
+    :param dry_run: only count the keys that would move.
+    :return: the number of keys moved per (source, target) shard.
+    """
+    moved = defaultdict(int)
+    started = time.monotonic()
+    for source_name, source in clients.items():
+        scanned = 0
+        pending = []
+        for unique_key in source.scan_iter(match=GLOBAL_PREFIX + ":*", count=count):
+            unique_key = unique_key.decode("utf-8") if isinstance(unique_key, bytes) else unique_key
+            scanned += 1
+            target_name = ring.node_for(unique_key)
+            if target_name != source_name:
+                pending.append((unique_key, target_name))
+            if len(pending) >= count:
+                _move(clients, source_name, pending, moved, dry_run)
+                pending = []
+        if pending:
+            _move(clients, source_name, pending, moved, dry_run)
+        if progress is not None:
+            total = sum(n for (src, _), n in moved.items() if src == source_name)
+            progress(
+                "%s: scanned %d keys, %s %d (%.1fs)"
+                % (source_name, scanned, "would move" if dry_run else "moved", total, time.monotonic() - started)
+            )
+    return dict(moved)
+
+
+def _move(clients, source_name: str, keys: List[Tuple[str, str]], moved, dry_run: bool) -> None:
+    if dry_run:
+        for _, target_name in keys:
+            moved[(source_name, target_name)] += 1
+        return
+    source = clients[source_name]
+    pipe = source.pipeline(transaction=False)
+    for unique_key, _ in keys:
+        pipe.dump(unique_key)
+        pipe.pttl(unique_key)
+    results = pipe.execute()
+
+    by_target = defaultdict(list)
+    for (unique_key, target_name), data, pttl in zip(keys, results[::2], results[1::2], strict=True):
+        if data is not None:
+            by_target[target_name].append((unique_key, data, pttl))
+    for target_name, entries in by_target.items():
+        pipe = clients[target_name].pipeline(transaction=False)
+        for unique_key, data, pttl in entries:
+            index_key, namespace, key = _index_key(unique_key)
+            pipe.restore(unique_key, max(pttl, 0), data, replace=True)
+            pipe.zadd(index_key, {key: expiry_score(pttl / 1000 if pttl > 0 else None)})
+            pipe.sadd(INDEXED_NAMESPACES, namespace)
+        pipe.execute()
+
+        pipe = source.pipeline(transaction=False)
+        for unique_key, _, _ in entries:
+            index_key, _, key = _index_key(unique_key)
+            pipe.delete(unique_key)
+            pipe.zrem(index_key, key)
+        pipe.execute()
+        moved[(source_name, target_name)] += len(entries)
+
+
+def _parse_shard(spec: str) -> Tuple[str, Dict[str, Any]]:
+    # NAME=URL or URL
+    name, _, url = spec.partition("=") if "=" in spec.split("://")[0] else ("", "", spec)
+    config = {"url": url}
+    return shard_name({"name": name}, get_connection_pool(config)), config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shard", action="append", required=True, metavar="[NAME=]URL", help="a shard of the new ring")
+    parser.add_argument("--drain", action="append", default=[], metavar="[NAME=]URL", help="a shard to empty")
+    parser.add_argument("--virtual-nodes", type=int, default=DEFAULT_VIRTUAL_NODES)
+    parser.add_argument("--count", type=int, default=SCAN_COUNT, help="keys per round-trip")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    shards = dict(_parse_shard(spec) for spec in args.shard)
+    drained = dict(_parse_shard(spec) for spec in args.drain)
+    clients = {
+        name: redis.StrictRedis(connection_pool=get_connection_pool(config))
+        for name, config in {**shards, **drained}.items()
+    }
+    ring = HashRing(shards, args.virtual_nodes)
+    moved = rebalance(clients, ring, args.count, args.dry_run, progress=print)
+    for (source, target), n in sorted(moved.items()):
+        print("%s -> %s: %d keys" % (source, target, n))
+
+
+if __name__ == "__main__":
+    main()
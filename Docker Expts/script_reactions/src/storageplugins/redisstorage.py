@@ -1,15 +1,41 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 import logging
-from typing import Any
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional
 
 import redis
 from errbot.storage.base import StorageBase, StoragePluginBase
-from jsonpickle import decode, encode
+from rediscache import start_cache
+from rediscodecs import Serializer
+from rediscompress import make_compressor
+from redismetrics import StorageMetrics, timed
+from redispool import get_connection_pool, pool_stats
+from ttlpolicy import TtlPolicy
 
 log = logging.getLogger("errbot.storage.redis")
 
 GLOBAL_PREFIX = "errbot"
+# Per-namespace sorted set of the keys stored in that namespace, scored by their
+# expiry time in milliseconds (+inf for keys that never expire). Kept outside of
+# the "errbot:<ns>:*" pattern so it never shows up as a key of the namespace itself.
+INDEX_PREFIX = "errbot-ttlindex"
+# Plain set index of the versions without expiry, dropped when the index is rebuilt.
+LEGACY_INDEX_PREFIX = "errbot-index"
+# Set of the namespaces whose index has been built at least once.
+INDEXED_NAMESPACES = "errbot-meta:ttlindexed"
+SCAN_COUNT = 500
+# Expired keys are dropped from the index by keys() and len(), and every that many writes.
+PRUNE_EVERY = 256
+
+NO_EXPIRY = float("inf")
+
+# STORAGE_CONFIG options consumed by the storage rather than passed to redis.
+STORAGE_OPTIONS = ("codec", "cache", "compression", "ttl", "shards", "virtual_nodes", "archive", "metrics")
+
+_GLOB_SPECIALS = re.compile(r"([*?\[\]\\])")
 
 
 def compat_str(s):
@@ -25,63 +51,775 @@ def compat_str(s):
         return str(s)
 
 
-class RedisStorage(StorageBase):
-    def _make_nskey(self, key):
-        return ":".join((GLOBAL_PREFIX, self.ns, compat_str(key)))
+def is_wrongtype(error):
+    """
+    Tell if a redis error comes from a command run on a key holding another type.
+    """
+    return str(error).startswith("WRONGTYPE")
+
+
+def escape_glob(s):
+    """
+    Escape the glob special characters of s so it can be used in a MATCH pattern.
+    :param s: the literal string to escape.
+    """
+    return _GLOB_SPECIALS.sub(r"\\\1", s)
 
-    def __init__(self, redis, namespace):
+
+def expiry_score(ttl: Optional[float]) -> float:
+    """
+    The index score of a key expiring in ttl seconds from now, NO_EXPIRY if ttl is None.
+    """
+    return NO_EXPIRY if ttl is None else int((time.time() + ttl) * 1000)
+
+
+class RedisNamespace:
+    """
+    Key layout and expiry policy of a namespace, shared by RedisStorage and its
+    asyncio sibling (see redisasync.py).
+    """
+
+    def __init__(self, redis, namespace, serializer=None, ttl_policy=None):
         self.redis = redis
         self.ns = namespace
-        self._all_keys = self._make_nskey("*")
+        self.serializer = serializer or Serializer()
+        self.ttl_policy = ttl_policy or TtlPolicy()
         self.ns_prefix = self._make_nskey("")
+        self._all_keys = escape_glob(self.ns_prefix) + "*"
+        self._index_key = ":".join((INDEX_PREFIX, self.ns))
+        self._writes = 0
+        self.metrics = None
+
+    def _make_nskey(self, key):
+        return ":".join((GLOBAL_PREFIX, self.ns, compat_str(key)))
 
-    def get(self, key: str) -> Any:
+    def _strip_nskey(self, unique_key):
+        return compat_str(unique_key)[len(self.ns_prefix):]
+
+    def _resolve_ttl(self, key: str, ttl: Optional[float]) -> Optional[float]:
+        """
+        The expiry to give key on write: ttl if given (0 meaning never), else the policy default.
+        """
+        if ttl is None:
+            return self.ttl_policy.for_key(compat_str(key))[0]
+        return ttl or None
+
+    def _read_ttl(self, key: str, ttl: Optional[float]) -> Optional[float]:
+        """
+        The expiry to push back on read: ttl if given, else the policy one when sliding.
+        """
+        if ttl is not None:
+            return ttl or None
+        policy_ttl, sliding = self.ttl_policy.for_key(compat_str(key))
+        return policy_ttl if sliding else None
+
+    def _count_writes(self, count: int) -> bool:
+        """
+        Count writes, True once every PRUNE_EVERY writes when the index should be pruned.
+        """
+        self._writes += count
+        if self._writes >= PRUNE_EVERY:
+            self._writes = 0
+            return True
+        return False
+
+
+class RedisStorage(RedisNamespace, StorageBase):
+    def __init__(self, redis, namespace, serializer=None, cache=None, ttl_policy=None, metrics=None):
+        super().__init__(redis, namespace, serializer, ttl_policy)
+        self.cache = cache
+        self.metrics = metrics
+        self._ensure_index()
+
+    def _read(self, key, data) -> None:
+        # Account the size of an encoded value read, and track big keys.
+        if self.metrics is not None:
+            self.metrics.read(compat_str(key), len(data))
+
+    def _ensure_index(self):
+        """
+        Build the key index from the existing keyspace the first time a namespace
+        is opened, so data written before the index existed stays visible.
+        """
+        if not self.redis.sismember(INDEXED_NAMESPACES, self.ns):
+            log.info("No key index for namespace '%s' yet, building it.", self.ns)
+            self.rebuild_index()
+
+    @timed("get", keyed=True)
+    def get(self, key: str, ttl: Optional[float] = None) -> Any:
+        """
+        :param ttl: push the expiry of the key back to ttl seconds from now,
+                    defaults to the sliding TTL policy of the key if any.
+        """
+        unique_key = self._make_nskey(key)
+        log.debug("Get key: %s", unique_key)
+        ttl = self._read_ttl(key, ttl)
+        if ttl is not None:
+            return self._get_refresh(key, ttl)
+        if self.cache is not None:
+            result = self.cache.get(unique_key)
+            if result is not None:
+                self._read(key, result)
+                return self.serializer.loads(result)
+            epoch = self.cache.epoch()
+        try:
+            result = self.redis.get(unique_key)
+        except redis.ResponseError as e:
+            if not is_wrongtype(e):
+                raise
+            return self._get_container(unique_key)
+        if result is None:
+            raise KeyError("%s doesn't exists." % (unique_key))
+        if self.cache is not None:
+            self.cache.put(unique_key, result, epoch)
+        self._read(key, result)
+        return self.serializer.loads(result)
+
+    def _get_refresh(self, key: str, ttl: float) -> Any:
+        # GETEX and the index update in one round-trip; the cache is bypassed
+        # since the read itself has to reach the server.
         unique_key = self._make_nskey(key)
-        log.debug("Get key: %s" % unique_key)
-        result = self.redis.get(unique_key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.getex(unique_key, px=int(ttl * 1000))
+        pipe.zadd(self._index_key, {compat_str(key): expiry_score(ttl)}, xx=True)
+        try:
+            result, _ = pipe.execute()
+        except redis.ResponseError as e:
+            if not is_wrongtype(e):
+                raise
+            value = self._get_container(unique_key)
+            self.expire(key, ttl)
+            return value
         if result is None:
             raise KeyError("%s doesn't exists." % (unique_key))
-        return decode(result.decode())
+        self._read(key, result)
+        return self.serializer.loads(result)
 
+    @timed("remove", keyed=True)
     def remove(self, key: str):
         unique_key = self._make_nskey(key)
         log.debug("Removing value at '%s'", unique_key)
-        result = self.redis.delete(unique_key)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(unique_key)
+        pipe.zrem(self._index_key, compat_str(key))
+        result, _ = pipe.execute()
+        self._invalidate(unique_key)
         if not result:
             raise KeyError("%s does not exist" % (unique_key))
 
-    def set(self, key: str, value: Any) -> None:
+    @timed("set", keyed=True)
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        :param ttl: expire the key after ttl seconds, 0 to never expire it,
+                    defaults to the TTL policy of the key.
+        """
+        with self.batch() as batch:
+            batch.set(key, value, ttl)
+
+    @timed("expire", keyed=True)
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        """
+        Set the expiry of an existing key (value, record or list).
+        :param ttl: seconds from now, None or 0 to never expire it.
+        :return: False if the key does not exist.
+        """
+        with self.batch() as batch:
+            batch.expire(key, ttl)
+        if ttl:
+            return bool(batch.results[0])
+        return bool(self.redis.exists(self._make_nskey(key)))
+
+    @timed("ttl", keyed=True)
+    def ttl(self, key: str) -> Optional[float]:
+        """
+        :return: the seconds left before key expires, None if it never does.
+        :raises KeyError: if the key does not exist.
+        """
+        pttl = self.redis.pttl(self._make_nskey(key))
+        if pttl == -2:
+            raise KeyError("%s doesn't exists." % (self._make_nskey(key)))
+        return None if pttl < 0 else pttl / 1000
+
+    def _invalidate(self, unique_key):
+        # Other processes learn about the change from the keyspace notification,
+        # this process does not wait for it.
+        if self.cache is not None:
+            self.cache.invalidate(unique_key)
+
+    def _written(self, count: int) -> None:
+        # Opportunistic pruning keeps the index bounded when nobody lists the keys.
+        if self._count_writes(count):
+            self.prune_index()
+
+    @timed("get_many")
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get several keys in a single MGET round-trip.
+        :param keys: the keys to read.
+        :return: a dict of the keys found and their values, missing keys are left out.
+        """
+        keys = list(keys)
+        found = {}
+        wanted = []
+        refreshed = []
+        for key in keys:
+            ttl = self._read_ttl(key, None)
+            if ttl is not None:
+                refreshed.append((key, ttl))
+                continue
+            unique_key = self._make_nskey(key)
+            data = self.cache.get(unique_key) if self.cache is not None else None
+            if data is not None:
+                found[key] = data
+            else:
+                wanted.append((key, unique_key))
+        if wanted:
+            epoch = self.cache.epoch() if self.cache is not None else None
+            results = self.redis.mget([unique_key for _, unique_key in wanted])
+            for (key, unique_key), data in zip(wanted, results, strict=True):
+                if data is None:
+                    continue
+                found[key] = data
+                if self.cache is not None:
+                    self.cache.put(unique_key, data, epoch)
+        if refreshed:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, ttl in refreshed:
+                pipe.getex(self._make_nskey(key), px=int(ttl * 1000))
+            pipe.zadd(self._index_key, {compat_str(key): expiry_score(ttl) for key, ttl in refreshed}, xx=True)
+            # The last result is the one of the ZADD
+            for (key, _), data in zip(refreshed, pipe.execute()[:-1], strict=True):
+                if data is not None:
+                    found[key] = data
+        log.debug("Get %d keys, %d found in '%s'", len(keys), len(found), self.ns)
+        for key, data in found.items():
+            self._read(key, data)
+        return {key: self.serializer.loads(data) for key, data in found.items()}
+
+    @timed("set_many")
+    def set_many(self, mapping: Mapping[str, Any], ttl: Optional[float] = None) -> None:
+        """
+        Atomically set several keys in a single MULTI/EXEC round-trip.
+        :param mapping: the keys and their values.
+        :param ttl: as for set().
+        """
+        if not mapping:
+            return
+        with self.batch() as batch:
+            for key, value in mapping.items():
+                batch.set(key, value, ttl)
+        log.debug("Set %d keys in '%s'", len(mapping), self.ns)
+
+    @timed("delete_many")
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """
+        Atomically remove several keys in a single MULTI/EXEC round-trip. Unlike
+        remove(), missing keys are ignored.
+        :param keys: the keys to remove.
+        :return: the number of keys that existed.
+        """
+        keys = [compat_str(key) for key in keys]
+        if not keys:
+            return 0
+        unique_keys = [self._make_nskey(key) for key in keys]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(*unique_keys)
+        pipe.zrem(self._index_key, *keys)
+        deleted, _ = pipe.execute()
+        for unique_key in unique_keys:
+            self._invalidate(unique_key)
+        log.debug("Removed %d of %d keys in '%s'", deleted, len(keys), self.ns)
+        return deleted
+
+    def batch(self) -> "RedisBatch":
+        """
+        Group writes (set, set_fields, append, delete, expire) into a single
+        MULTI/EXEC round-trip, applied atomically when the with block exits
+        without error.
+        """
+        return RedisBatch(self)
+
+    @timed("get_fields", keyed=True)
+    def get_fields(self, key: str, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Read a record stored as a hash with set_fields(). A record stored whole
+        with set() is read the same way, so callers can migrate lazily.
+        :param key: the key of the record.
+        :param fields: the fields to read, all of them if None. Missing fields are left out.
+        :return: a dict of the fields and their values.
+        """
         unique_key = self._make_nskey(key)
-        log.debug("Setting value '%s' at '%s'", encode(value), unique_key)
-        self.redis.set(unique_key, encode(value))
+        try:
+            if fields is None:
+                raw = self.redis.hgetall(unique_key)
+            else:
+                fields = list(fields)
+                raw = dict(zip(fields, self.redis.hmget(unique_key, fields), strict=True))
+        except redis.ResponseError as e:
+            if not is_wrongtype(e):
+                raise
+            record = self.get(key)
+            if not isinstance(record, dict):
+                raise
+            return record if fields is None else {f: record[f] for f in fields if f in record}
+        self._read(key, b"".join(v for v in raw.values() if v is not None))
+        record = {compat_str(f): self.serializer.loads(v) for f, v in raw.items() if v is not None}
+        if not record and not self.redis.exists(unique_key):
+            raise KeyError("%s doesn't exists." % (unique_key))
+        self._refresh(key)
+        return record
+
+    @timed("set_fields", keyed=True)
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        """
+        Set some fields of a record stored as a hash, leaving the others untouched.
+        :param key: the key of the record.
+        :param mapping: the fields to set and their values.
+        :param replace: drop the fields that are not in mapping (or a value stored with set()).
+        :param ttl: as for set(); without TTL policy an existing expiry is kept.
+        """
+        with self.batch() as batch:
+            batch.set_fields(key, mapping, replace, ttl)
+
+    @timed("append", keyed=True)
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> int:
+        """
+        Append values to a list, without reading it.
+        :param key: the key of the list.
+        :param ttl: as for set_fields().
+        :return: the new length of the list.
+        """
+        with self.batch() as batch:
+            batch.append(key, *values, ttl=ttl)
+        return batch.results[0] if values else self.list_len(key)
+
+    @timed("get_range", keyed=True)
+    def get_range(self, key: str, start: int = 0, end: int = -1) -> List[Any]:
+        """
+        Read a slice of a list built with append(), both ends included, negative
+        indexes count from the end. A missing list reads as empty.
+        """
+        raw = self.redis.lrange(self._make_nskey(key), start, end)
+        self._read(key, b"".join(raw))
+        values = [self.serializer.loads(v) for v in raw]
+        if values:
+            self._refresh(key)
+        return values
+
+    @timed("list_len", keyed=True)
+    def list_len(self, key: str) -> int:
+        return self.redis.llen(self._make_nskey(key))
+
+    def _refresh(self, key: str) -> None:
+        ttl = self._read_ttl(key, None)
+        if ttl is not None:
+            self.expire(key, ttl)
 
+    def _get_container(self, unique_key):
+        kind = compat_str(self.redis.type(unique_key))
+        if kind == "hash":
+            raw = self.redis.hgetall(unique_key)
+            self._read(self._strip_nskey(unique_key), b"".join(raw.values()))
+            return {compat_str(f): self.serializer.loads(v) for f, v in raw.items()}
+        if kind == "list":
+            raw = self.redis.lrange(unique_key, 0, -1)
+            self._read(self._strip_nskey(unique_key), b"".join(raw))
+            return [self.serializer.loads(v) for v in raw]
+        raise KeyError("%s holds an unsupported %s value." % (unique_key, kind))
+
+    def _expired(self, candidates: List[str]) -> List[str]:
+        """
+        Check the index entries whose expiry is past: drop the keys that are gone,
+        and fix the score of the ones still there (expiry changed behind the index).
+        :return: the keys dropped.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for key in candidates:
+            pipe.pttl(self._make_nskey(key))
+        gone, rescored = [], {}
+        for key, pttl in zip(candidates, pipe.execute(), strict=True):
+            if pttl == -2:
+                gone.append(key)
+            else:
+                rescored[key] = expiry_score(None if pttl < 0 else pttl / 1000)
+        pipe = self.redis.pipeline(transaction=False)
+        if gone:
+            pipe.zrem(self._index_key, *gone)
+        if rescored:
+            pipe.zadd(self._index_key, rescored, xx=True)
+        pipe.execute()
+        return gone
+
+    def _index_read(self, command: str):
+        # The expired entries come back in the same round-trip as the read, so
+        # the common case with nothing expired costs a single round-trip.
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(self._index_key, "-inf", int(time.time() * 1000))
+        if command == "len":
+            pipe.zcard(self._index_key)
+        else:
+            pipe.zrange(self._index_key, 0, -1)
+        candidates, result = pipe.execute()
+        gone = self._expired([compat_str(key) for key in candidates]) if candidates else []
+        return result, gone
+
+    def prune_index(self) -> int:
+        """
+        Drop the expired keys from the index.
+        :return: the number of keys dropped.
+        """
+        candidates = self.redis.zrangebyscore(self._index_key, "-inf", int(time.time() * 1000))
+        gone = self._expired([compat_str(key) for key in candidates]) if candidates else []
+        if gone:
+            log.debug("Pruned %d expired keys from the index of '%s'", len(gone), self.ns)
+        return len(gone)
+
+    @timed("len")
     def len(self):
-        return len(self.keys())
+        count, gone = self._index_read("len")
+        return count - len(gone)
 
+    @timed("keys")
     def keys(self):
+        members, gone = self._index_read("keys")
+        gone = set(gone)
+        keys = [key for key in (compat_str(member) for member in members) if key not in gone]
+        log.debug("Keys: %s", keys)
+        return keys
 
-        keys = self.redis.keys(pattern=self._all_keys)
-        filtered_keys = []
+    def scan_keys(self, count: int = SCAN_COUNT) -> Iterator[str]:
+        """
+        Iterate over the keys of the namespace straight from the keyspace with a
+        cursor based SCAN. Unlike keys() this does not rely on the index, and unlike
+        KEYS it never blocks the server; a key may be returned more than once.
+        :param count: the SCAN COUNT hint, i.e. the amount of work per round-trip.
+        """
+        for unique_key in self.redis.scan_iter(match=self._all_keys, count=count):
+            yield self._strip_nskey(unique_key)
 
+    def _index_batch(self, keys: List[str]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
         for key in keys:
-            log.debug("Key: (pre-filter): {0}".format(key))
-            key = compat_str(key)
-            filtered_keys.append(key.split(self.ns_prefix)[1])
+            pipe.pttl(self._make_nskey(key))
+        scores = {
+            key: expiry_score(None if pttl < 0 else pttl / 1000)
+            for key, pttl in zip(keys, pipe.execute(), strict=True)
+            if pttl != -2
+        }
+        if scores:
+            self.redis.zadd(self._index_key, scores)
+
+    def rebuild_index(self, count: int = SCAN_COUNT) -> int:
+        """
+        Repair the key index from the keyspace: add the keys found with SCAN with
+        their expiry, and drop the indexed keys that no longer exist. Safe to run
+        while the bot writes to the namespace.
+        :param count: the SCAN COUNT hint, also used as the indexing batch size.
+        :return: the number of keys found in the namespace.
+        """
+        found = set()
+        batch = []
+        for key in self.scan_keys(count):
+            if key in found:
+                continue
+            found.add(key)
+            batch.append(key)
+            if len(batch) >= count:
+                self._index_batch(batch)
+                batch = []
+        if batch:
+            self._index_batch(batch)
 
-        log.debug("Keys: %s" % filtered_keys)
-        return filtered_keys
+        stale = [compat_str(key) for key in self.redis.zrange(self._index_key, 0, -1) if compat_str(key) not in found]
+        if stale:
+            self._expired(stale)
+        self.redis.delete(":".join((LEGACY_INDEX_PREFIX, self.ns)))
+        self.redis.sadd(INDEXED_NAMESPACES, self.ns)
+        log.info("Indexed %d keys for namespace '%s'.", len(found), self.ns)
+        return len(found)
 
     def close(self) -> None:
         pass
 
 
+class RedisBatch:
+    """
+    Writes queued in a MULTI/EXEC transaction, see RedisStorage.batch(). The
+    results of the queued commands are in results once executed.
+    """
+
+    def __init__(self, storage: RedisStorage):
+        self._storage = storage
+        self._pipe = storage.redis.pipeline(transaction=True)
+        # Index update per key, from the last operation on it: ("set", score) to
+        # index with that expiry, ("keep", NO_EXPIRY) to index without touching
+        # an existing expiry, ("expire", score) to rescore if indexed, ("delete", None).
+        self._index = {}
+        self.results = []
+
+    @property
+    def metrics(self):
+        return self._storage.metrics
+
+    def _written(self, key: str, size: int) -> None:
+        if self._storage.metrics is not None:
+            self._storage.metrics.written(compat_str(key), size)
+
+    def _indexed(self, key: str, ttl: Optional[float], reset: bool) -> None:
+        # reset: the command cleared any previous expiry of the key.
+        key = compat_str(key)
+        if ttl is not None or reset:
+            self._index[key] = ("set", expiry_score(ttl))
+        elif self._index.get(key, ("delete",))[0] == "delete":
+            self._index[key] = ("keep", NO_EXPIRY)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self._storage._resolve_ttl(key, ttl)
+        px = int(ttl * 1000) if ttl is not None else None
+        data = self._storage.serializer.dumps(value)
+        self._pipe.set(self._storage._make_nskey(key), data, px=px)
+        self._indexed(key, ttl, reset=True)
+        self._written(key, len(data))
+
+    def _pexpire(self, unique_key: str, ttl: Optional[float]) -> None:
+        if ttl is not None:
+            self._pipe.pexpire(unique_key, int(ttl * 1000))
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        unique_key = self._storage._make_nskey(key)
+        if replace:
+            self._pipe.delete(unique_key)
+        if mapping:
+            ttl = self._storage._resolve_ttl(key, ttl)
+            dumps = self._storage.serializer.dumps
+            encoded = {f: dumps(v) for f, v in mapping.items()}
+            self._pipe.hset(unique_key, mapping=encoded)
+            self._written(key, sum(len(v) for v in encoded.values()))
+            self._pexpire(unique_key, ttl)
+            self._indexed(key, ttl, reset=replace)
+        elif replace:
+            self._index[compat_str(key)] = ("delete", None)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> None:
+        if values:
+            unique_key = self._storage._make_nskey(key)
+            ttl = self._storage._resolve_ttl(key, ttl)
+            dumps = self._storage.serializer.dumps
+            encoded = [dumps(value) for value in values]
+            self._pipe.rpush(unique_key, *encoded)
+            self._written(key, sum(len(v) for v in encoded))
+            self._pexpire(unique_key, ttl)
+            self._indexed(key, ttl, reset=False)
+
+    def expire(self, key: str, ttl: Optional[float]) -> None:
+        unique_key = self._storage._make_nskey(key)
+        if ttl:
+            self._pipe.pexpire(unique_key, int(ttl * 1000))
+        else:
+            self._pipe.persist(unique_key)
+        key = compat_str(key)
+        previous = self._index.get(key, ("expire",))[0]
+        if previous == "delete":
+            return
+        self._index[key] = ("expire" if previous == "expire" else "set", expiry_score(ttl or None))
+
+    def delete(self, key: str) -> None:
+        self._pipe.delete(self._storage._make_nskey(key))
+        self._index[compat_str(key)] = ("delete", None)
+
+    def _queue_index(self) -> None:
+        # The index updates go at the end of the transaction, after the writes.
+        ops = {}
+        for key, (op, score) in self._index.items():
+            ops.setdefault(op, {})[key] = score
+        index_key = self._storage._index_key
+        if "set" in ops:
+            self._pipe.zadd(index_key, ops["set"])
+        if "keep" in ops:
+            self._pipe.zadd(index_key, ops["keep"], nx=True)
+        if "expire" in ops:
+            self._pipe.zadd(index_key, ops["expire"], xx=True)
+        if "delete" in ops:
+            self._pipe.zrem(index_key, *ops["delete"])
+
+    def _executed(self, results: List[Any]) -> int:
+        # Record the results of the transaction, return the number of keys written.
+        self.results = results
+        for key, (op, _) in self._index.items():
+            if op != "expire":
+                self._storage._invalidate(self._storage._make_nskey(key))
+        writes = len(self._index)
+        self._index = {}
+        return writes
+
+    @timed("batch")
+    def execute(self) -> List[Any]:
+        if not self._index:
+            return []
+        self._queue_index()
+        writes = self._executed(self._pipe.execute())
+        self._storage._written(writes)
+        return self.results
+
+    def __enter__(self) -> "RedisBatch":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.execute()
+        else:
+            self._pipe.reset()
+
+
 class RedisPlugin(StoragePluginBase):
     def __init__(self, bot_config):
         super().__init__(bot_config)
+        self._pool = None
+        self._cache = None
+        self._shards = None
+        self._archive = None
+        self._archiver = None
+        self._metrics = StorageMetrics(self._storage_config["metrics"]) if self._storage_config.get("metrics") else None
+        self._ttl_policies = {
+            namespace: TtlPolicy(rules) for namespace, rules in self._storage_config.get("ttl", {}).items()
+        }
+        compression = self._storage_config.get("compression")
+        self._serializer = Serializer(
+            self._storage_config.get("codec", "auto"), make_compressor(compression) if compression else None
+        )
 
     def open(self, namespace: str) -> StorageBase:
-        config = self._storage_config
+        if self._storage_config.get("shards"):
+            return self._open_sharded(namespace)
+        if self._pool is None:
+            config = {k: v for k, v in self._storage_config.items() if k not in STORAGE_OPTIONS}
+            self._pool = get_connection_pool(config)
+            if self._storage_config.get("cache"):
+                self._cache = start_cache(self._pool, GLOBAL_PREFIX, self._storage_config["cache"])
+
+        connection = redis.StrictRedis(connection_pool=self._pool)
+
+        if self._storage_config.get("archive"):
+            return self._open_tiered(connection, namespace)
+        return RedisStorage(
+            connection,
+            namespace,
+            self._serializer,
+            self._cache,
+            self._ttl_policies.get(namespace),
+            self._metric(namespace),
+        )
+
+    def _metric(self, namespace: str):
+        return self._metrics.namespace(namespace) if self._metrics is not None else None
+
+    def _open_tiered(self, connection, namespace: str) -> StorageBase:
+        # Imported here as redistier builds on this module.
+        from redistier import Archive, Archiver, TieredRedisStorage
+
+        if self._archive is None:
+            self._archive = Archive(self._storage_config["archive"])
+            if self._archive.rules:
+                self._archiver = Archiver(self._archive, self.open)
+                self._archiver.start()
+            log.info("Archiving cold keys to %s.", self._archive.db.path)
+        return TieredRedisStorage(
+            connection,
+            namespace,
+            self._serializer,
+            self._cache,
+            self._ttl_policies.get(namespace),
+            self._archive,
+            self._metric(namespace),
+        )
+
+    def _open_sharded(self, namespace: str) -> StorageBase:
+        # Imported here as redisshard builds on this module.
+        from redisshard import DEFAULT_VIRTUAL_NODES, HashRing, ShardedRedisStorage, shard_name
+
+        if self._shards is None:
+            if self._storage_config.get("archive"):
+                log.warning("The archive is not supported with shards, it is disabled.")
+            common = {k: v for k, v in self._storage_config.items() if k not in STORAGE_OPTIONS}
+            pools = {}
+            for shard in self._storage_config["shards"]:
+                config = {**common, **shard}
+                config.pop("name", None)
+                pool = get_connection_pool(config)
+                pools[shard_name(shard, pool)] = pool
+            if self._storage_config.get("cache"):
+                log.warning("The read cache is not supported with shards, it is disabled.")
+            ring = HashRing(pools, self._storage_config.get("virtual_nodes", DEFAULT_VIRTUAL_NODES))
+            executor = ThreadPoolExecutor(len(pools), thread_name_prefix="redis-shard")
+            self._shards = pools, ring, executor
+            log.info("Sharding the storage over %s.", ", ".join(ring.nodes))
+
+        pools, ring, executor = self._shards
+        return ShardedRedisStorage(
+            {name: redis.StrictRedis(connection_pool=pool) for name, pool in pools.items()},
+            namespace,
+            self._serializer,
+            self._ttl_policies.get(namespace),
+            ring,
+            executor,
+        )
+
+    def pool_stats(self):
+        """
+        Statistics of the process-wide connection pools, see redispool.pool_stats.
+        """
+        return pool_stats()
+
+    def cache_stats(self):
+        """
+        Hit/miss counters and size of the read cache, None when it is not configured.
+        """
+        return self._cache.stats() if self._cache is not None else None
+
+    def compression_stats(self):
+        """
+        Compression ratio and CPU time spent (de)compressing values, None when it is not configured.
+        """
+        compressor = self._serializer.compressor
+        return compressor.stats() if compressor is not None else None
+
+    def archive_stats(self):
+        """
+        Keys archived, Redis memory freed, reads served by the archive and last job run,
+        None when the archive is not configured.
+        """
+        return self._archive.stats.as_dict() if self._archive is not None else None
+
+    def archive_now(self) -> int:
+        """
+        Run the archive job right away rather than waiting for its interval.
+        :return: the number of keys archived.
+        """
+        if self._archive is None:
+            raise ValueError("The archive is not configured.")
+        return self._archive.run(self.open)
 
-        connection = redis.StrictRedis(**config)
+    def storage_stats(self):
+        """
+        Latency, calls, errors, bytes and hot/big keys per namespace, None when metrics are not configured.
+        """
+        return self._metrics.as_dict() if self._metrics is not None else None
 
-        return RedisStorage(connection, namespace)
+    def prometheus_metrics(self) -> str:
+        """
+        The storage metrics and the pool statistics in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, help_text, field in (
+            ("errbot_storage_pool_in_use", "gauge", "Connections of the pool in use.", "in_use"),
+            ("errbot_storage_pool_waits_total", "counter", "Connection acquisitions that had to wait.", "waits"),
+            ("errbot_storage_pool_exhausted_total", "counter", "Connection acquisitions that failed.", "exhausted"),
+        ):
+            lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, kind)]
+            lines += ['%s{pool="%s"} %d' % (name, pool, stats[field]) for pool, stats in pool_stats().items()]
+        text = "\n".join(lines) + "\n"
+        return text + self._metrics.prometheus() if self._metrics is not None else text
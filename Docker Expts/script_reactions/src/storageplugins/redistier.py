@@ -0,0 +1,437 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+Hot/cold tiering of the Redis storage: the records matching an archive rule are
+moved by a background job into a compressed SQLite archive, and read from there
+transparently when they are missing from Redis.
+"""
+
+import datetime
+import logging
+import threading
+import time
+from fnmatch import fnmatchcase
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional
+
+import redis
+from rediscodecs import Serializer
+from rediscompress import Compressor
+from redisstorage import RedisBatch, RedisStorage, compat_str, is_wrongtype
+from sqlitestorage import DEFAULT_MMAP_SIZE, Database, SQLiteStorage
+
+log = logging.getLogger("errbot.storage.redis.tier")
+
+DEFAULT_INTERVAL = 3600
+# Archived values are small records for the most part, compress them all.
+ARCHIVE_COMPRESSION_THRESHOLD = 256
+# Keys examined per round-trip by the archive job.
+ARCHIVE_BATCH = 200
+
+
+def _timestamp(value: Any) -> Optional[float]:
+    """
+    The epoch time of a record date field, stored as epoch seconds or ISO 8601.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+class ArchiveRule:
+    """
+    Which keys of a namespace go to the archive, from the 'archive' section of
+    STORAGE_CONFIG:
+
+    - match: glob pattern of the keys,
+    - where: fields the record must have, with these values,
+    - age_field and older_than: a date field of the record, older than that many seconds,
+    - idle: seconds since Redis last served the key,
+    - companions: keys archived and restored with it, '{key}' being the key itself.
+    """
+
+    def __init__(self, rule: Mapping[str, Any]):
+        self.match = rule["match"]
+        self.where = dict(rule.get("where", {}))
+        self.age_field = rule.get("age_field")
+        self.older_than = rule.get("older_than")
+        self.idle = rule.get("idle")
+        self.companions = list(rule.get("companions", []))
+        if (self.age_field is None) != (self.older_than is None):
+            raise ValueError("Archive rule '%s' needs both age_field and older_than." % self.match)
+        if not (self.where or self.older_than or self.idle):
+            raise ValueError("Archive rule '%s' would archive every key, give a condition." % self.match)
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.where) + ([self.age_field] if self.age_field else [])
+
+    def matches(self, record: Mapping[str, Any], idle: Optional[int], now: float) -> bool:
+        """
+        :param record: the fields of the record needed by the rule.
+        :param idle: the Redis idle time of the key in seconds.
+        """
+        if any(record.get(field) != value for field, value in self.where.items()):
+            return False
+        if self.age_field:
+            at = _timestamp(record.get(self.age_field))
+            if at is None or now - at < self.older_than:
+                return False
+        return not self.idle or (idle is not None and idle >= self.idle)
+
+    def group(self, key: str) -> List[str]:
+        return [key] + [companion.format(key=key) for companion in self.companions]
+
+
+class ArchiveStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.archived = 0
+        self.redis_bytes_freed = 0
+        self.archive_reads = 0
+        self.restored = 0
+        self.conflicts = 0
+        self.last_run = None
+        self.last_run_time = 0.0
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def ran(self, elapsed: float) -> None:
+        with self._lock:
+            self.last_run = time.time()
+            self.last_run_time = elapsed
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "archived": self.archived,
+                "redis_bytes_freed": self.redis_bytes_freed,
+                "archive_reads": self.archive_reads,
+                "restored": self.restored,
+                "conflicts": self.conflicts,
+                "last_run": self.last_run,
+                "last_run_time": self.last_run_time,
+            }
+
+
+class Archive:
+    """
+    The cold tier: a SQLite file holding the archived keys of every namespace,
+    compressed, and the rules deciding what goes there.
+    """
+
+    def __init__(self, config: Mapping[str, Any]):
+        self.db = Database(config["path"], config.get("mmap_size", DEFAULT_MMAP_SIZE))
+        compression = config.get("compression", {})
+        self.serializer = Serializer(
+            config.get("codec", "auto"),
+            Compressor(
+                compression.get("algorithm", "auto"),
+                compression.get("threshold", ARCHIVE_COMPRESSION_THRESHOLD),
+                compression.get("level"),
+            ),
+        )
+        self.rules = {
+            namespace: [ArchiveRule(rule) for rule in rules] for namespace, rules in config.get("rules", {}).items()
+        }
+        self.interval = config.get("interval", DEFAULT_INTERVAL)
+        self.stats = ArchiveStats()
+
+    def open(self, namespace: str) -> SQLiteStorage:
+        return SQLiteStorage(self.db, namespace, self.serializer)
+
+    def run(self, open_storage: Callable[[str], "TieredRedisStorage"]) -> int:
+        """
+        Archive the keys matching the rules in every namespace that has some.
+        :return: the number of keys archived.
+        """
+        start = time.perf_counter()
+        archived = 0
+        for namespace, rules in self.rules.items():
+            storage = open_storage(namespace)
+            for rule in rules:
+                archived += storage.archive_matching(rule)
+        elapsed = time.perf_counter() - start
+        self.stats.ran(elapsed)
+        log.info("Archived %d keys in %.1fs.", archived, elapsed)
+        return archived
+
+
+class Archiver(threading.Thread):
+    """
+    Runs the archive job every interval seconds.
+    """
+
+    def __init__(self, archive: Archive, open_storage: Callable[[str], "TieredRedisStorage"]):
+        super().__init__(name="redis-archiver", daemon=True)
+        self._archive = archive
+        self._open_storage = open_storage
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._archive.interval):
+            try:
+                self._archive.run(self._open_storage)
+            except Exception:
+                log.exception("The archive job failed, retrying in %ds.", self._archive.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class TieredRedisStorage(RedisStorage):
+    """
+    A RedisStorage whose cold keys live in an archive. Reads of a key missing
+    from Redis fall back to the archive; writing to an archived record or list
+    first brings it back to Redis, and overwriting or deleting a key drops its
+    archived copy. keys() and len() cover both tiers.
+    """
+
+    def __init__(
+        self, redis, namespace, serializer=None, cache=None, ttl_policy=None, archive: Archive = None, metrics=None
+    ):
+        super().__init__(redis, namespace, serializer, cache, ttl_policy, metrics)
+        self.archive = archive.open(namespace)
+        self._stats = archive.stats
+
+    def _archived(self, keys: Iterable[str]) -> List[str]:
+        return [key for key in keys if self.archive.kind(compat_str(key)) is not None]
+
+    def _from_archive(self, read: Callable[[], Any]) -> Any:
+        value = read()
+        self._stats.add(archive_reads=1)
+        return value
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Any:
+        try:
+            return super().get(key, ttl)
+        except KeyError:
+            return self._from_archive(lambda: self.archive.get(compat_str(key)))
+
+    def get_fields(self, key: str, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        fields = list(fields) if fields is not None else None
+        try:
+            return super().get_fields(key, fields)
+        except KeyError:
+            return self._from_archive(lambda: self.archive.get_fields(compat_str(key), fields))
+
+    def get_range(self, key: str, start: int = 0, end: int = -1) -> List[Any]:
+        return super().get_range(key, start, end) or self.archive.get_range(compat_str(key), start, end)
+
+    def list_len(self, key: str) -> int:
+        return super().list_len(key) or self.archive.list_len(compat_str(key))
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        found = super().get_many(keys)
+        missing = [compat_str(key) for key in keys if key not in found]
+        if missing:
+            archived = self.archive.get_many(missing)
+            if archived:
+                self._stats.add(archive_reads=len(archived))
+                found.update(archived)
+        return found
+
+    def ttl(self, key: str) -> Optional[float]:
+        try:
+            return super().ttl(key)
+        except KeyError:
+            return self.archive.ttl(compat_str(key))
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        # The expiry of an archived key is changed in place, without restoring it.
+        if self.archive.kind(compat_str(key)) is not None:
+            return self.archive.expire(compat_str(key), ttl)
+        return super().expire(key, ttl)
+
+    def remove(self, key: str):
+        try:
+            super().remove(key)
+        except KeyError:
+            self.archive.remove(compat_str(key))
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        keys = [compat_str(key) for key in keys]
+        return super().delete_many(keys) + self.archive.delete_many(self._archived(keys))
+
+    def batch(self) -> "TieredBatch":
+        return TieredBatch(self)
+
+    def len(self):
+        return super().len() + self.archive.len()
+
+    def keys(self):
+        keys = super().keys()
+        hot = set(keys)
+        return keys + [key for key in self.archive.keys() if key not in hot]
+
+    def restore(self, key: str) -> bool:
+        """
+        Bring an archived key back to Redis, with its expiry.
+        :return: False if the key is not in the archive.
+        """
+        key = compat_str(key)
+        kind = self.archive.kind(key)
+        if kind is None:
+            return False
+        value = self.archive.get(key)
+        ttl = self.archive.ttl(key) or 0
+        with RedisBatch(self) as batch:
+            if kind == "hash":
+                batch.set_fields(key, value, replace=True, ttl=ttl)
+            elif kind == "list":
+                batch.delete(key)
+                batch.append(key, *value, ttl=ttl)
+            else:
+                batch.set(key, value, ttl)
+        self.archive.remove(key)
+        self._stats.add(restored=1)
+        log.debug("Restored '%s' of '%s' from the archive.", key, self.ns)
+        return True
+
+    def _read_raw(self, pipe, unique_key: str):
+        # (redis type, decoded value, pttl) of a watched key, read on the watching connection.
+        kind = compat_str(pipe.type(unique_key))
+        if kind == "none":
+            return None
+        if kind == "hash":
+            value = {compat_str(f): self.serializer.loads(v) for f, v in pipe.hgetall(unique_key).items()}
+        elif kind == "list":
+            value = [self.serializer.loads(v) for v in pipe.lrange(unique_key, 0, -1)]
+        else:
+            value = self.serializer.loads(pipe.get(unique_key))
+        return kind, value, pipe.pttl(unique_key)
+
+    def _move(self, keys: List[str]) -> bool:
+        """
+        Move a group of keys to the archive, unless one of them changes meanwhile.
+        """
+        unique_keys = [self._make_nskey(key) for key in keys]
+        with self.redis.pipeline(transaction=True) as pipe:
+            pipe.watch(*unique_keys)
+            entries = {key: self._read_raw(pipe, unique_key) for key, unique_key in zip(keys, unique_keys, strict=True)}
+            entries = {key: entry for key, entry in entries.items() if entry is not None}
+            freed = sum(pipe.memory_usage(self._make_nskey(key)) or 0 for key in entries)
+            with self.archive.batch() as archive:
+                for key, (kind, value, pttl) in entries.items():
+                    ttl = pttl / 1000 if pttl > 0 else 0
+                    if kind == "hash":
+                        archive.set_fields(key, value, replace=True, ttl=ttl)
+                    elif kind == "list":
+                        archive.delete(key)
+                        archive.append(key, *value, ttl=ttl)
+                    else:
+                        archive.set(key, value, ttl)
+            pipe.multi()
+            pipe.delete(*unique_keys)
+            pipe.zrem(self._index_key, *keys)
+            try:
+                pipe.execute()
+            except redis.WatchError:
+                # Written meanwhile: the Redis copy wins.
+                self.archive.delete_many(list(entries))
+                self._stats.add(conflicts=1)
+                return False
+        for unique_key in unique_keys:
+            self._invalidate(unique_key)
+        self._stats.add(archived=len(entries), redis_bytes_freed=freed)
+        return True
+
+    def archive_matching(self, rule: ArchiveRule) -> int:
+        """
+        Move the keys matching rule, and their companions, to the archive.
+        :return: the number of keys matched and moved.
+        """
+        candidates = [key for key in super().keys() if fnmatchcase(key, rule.match)]
+        moved = 0
+        now = time.time()
+        for i in range(0, len(candidates), ARCHIVE_BATCH):
+            keys = candidates[i:i + ARCHIVE_BATCH]
+            pipe = self.redis.pipeline(transaction=False)
+            for key in keys:
+                if rule.fields:
+                    pipe.hmget(self._make_nskey(key), rule.fields)
+                if rule.idle:
+                    pipe.object("idletime", self._make_nskey(key))
+            results = iter(pipe.execute(raise_on_error=False))
+            for key in keys:
+                record = next(results) if rule.fields else []
+                idle = next(results) if rule.idle else None
+                if isinstance(record, redis.ResponseError):
+                    if not is_wrongtype(record):
+                        raise record
+                    # A record stored whole with set().
+                    try:
+                        value = super().get(key)
+                    except KeyError:
+                        continue
+                    record = value if isinstance(value, dict) else {}
+                else:
+                    record = {
+                        field: self.serializer.loads(data) for field, data in zip(rule.fields, record, strict=True) if data is not None
+                    }
+                if isinstance(idle, Exception):
+                    idle = None
+                if rule.matches(record, idle, now) and self._move(rule.group(key)):
+                    moved += 1
+        if moved:
+            log.info("Archived %d keys matching '%s' in '%s'.", moved, rule.match, self.ns)
+        return moved
+
+
+class TieredBatch(RedisBatch):
+    """
+    A RedisBatch that restores the archived records and lists it updates, drops
+    the archived copies of the keys it overwrites or deletes, and changes the
+    expiry of archived keys in the archive.
+    """
+
+    def __init__(self, storage: TieredRedisStorage):
+        super().__init__(storage)
+        self._replaced = []
+        self._archive_expiries = []
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        super().set(key, value, ttl)
+        self._replaced.append(compat_str(key))
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        if replace:
+            self._replaced.append(compat_str(key))
+        else:
+            self._storage.restore(key)
+        super().set_fields(key, mapping, replace, ttl)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> None:
+        self._storage.restore(key)
+        super().append(key, *values, ttl=ttl)
+
+    def expire(self, key: str, ttl: Optional[float]) -> None:
+        if self._storage.archive.kind(compat_str(key)) is not None:
+            self._archive_expiries.append((compat_str(key), ttl))
+        else:
+            super().expire(key, ttl)
+
+    def delete(self, key: str) -> None:
+        super().delete(key)
+        self._replaced.append(compat_str(key))
+
+    def execute(self) -> List[Any]:
+        results = super().execute()
+        if self._replaced:
+            archived = self._storage._archived(self._replaced)
+            if archived:
+                self._storage.archive.delete_many(archived)
+            self._replaced = []
+        for key, ttl in self._archive_expiries:
+            self._storage.archive.expire(key, ttl)
+        self._archive_expiries = []
+        return results
@@ -0,0 +1,640 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional
+
+from errbot.storage.base import StorageBase, StoragePluginBase
+from rediscodecs import Serializer
+from rediscompress import make_compressor
+from ttlpolicy import TtlPolicy
+
+log = logging.getLogger("errbot.storage.sqlite")
+
+DEFAULT_FILENAME = "storage.sqlite"
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+BUSY_TIMEOUT = 10.0
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL")
+# Bound on the number of keys per IN (...) query.
+CHUNK_SIZE = 500
+# Expired rows are deleted every that many writes, reads skip them meanwhile.
+PRUNE_EVERY = 256
+
+# What a key holds, matching the Redis types used by RedisStorage: a whole
+# value, a record of fields (hash) or an append-only list.
+VALUE = 0
+RECORD = 1
+LIST = 2
+# The Redis type of the same data.
+KIND_NAMES = {VALUE: "string", RECORD: "hash", LIST: "list"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    kind INTEGER NOT NULL,
+    value BLOB,
+    expires_at REAL,
+    PRIMARY KEY (ns, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_expiry ON entries (expires_at) WHERE expires_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS fields (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (ns, key, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS items (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (ns, key, pos)
+) WITHOUT ROWID;
+"""
+
+
+class Database:
+    """
+    The SQLite file shared by every namespace, with one connection per thread.
+
+    The database runs in WAL mode: readers never block each other nor the writer,
+    and a commit only appends to the log. Reads go through a memory map of the
+    file, so hot pages are served from the page cache without copies.
+    """
+
+    def __init__(self, path: str, mmap_size: int = DEFAULT_MMAP_SIZE, synchronous: str = "NORMAL"):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError("Unknown synchronous mode '%s', use one of %s." % (synchronous, ", ".join(SYNCHRONOUS_MODES)))
+        self.path = path
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self.connection().executescript(SCHEMA)
+        log.info("SQLite storage in %s (WAL, mmap %d bytes).", path, mmap_size)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Transactions are handled explicitly, hence isolation_level=None.
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+            conn.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        A write transaction. The write lock is taken upfront so that concurrent
+        writers wait on busy_timeout instead of failing to upgrade a read lock.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @contextmanager
+    def snapshot(self) -> Iterator[sqlite3.Connection]:
+        """
+        A read transaction, for reads spanning several statements.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def _chunks(items: List[Any]) -> Iterator[List[Any]]:
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+class SQLiteStorage(StorageBase):
+    """
+    Same contract as RedisStorage (values, records, lists, batches, TTLs) on an
+    embedded SQLite database. The primary key of the entries table is the key
+    index: keys() and len() never scan values.
+    """
+
+    def __init__(self, db: Database, namespace: str, serializer=None, ttl_policy=None):
+        self.db = db
+        self.ns = namespace
+        self.serializer = serializer or Serializer()
+        self.ttl_policy = ttl_policy or TtlPolicy()
+        self._writes = 0
+
+    def _label(self, key: str) -> str:
+        return "%s:%s" % (self.ns, key)
+
+    def _resolve_ttl(self, key: str, ttl: Optional[float]) -> Optional[float]:
+        """
+        The expiry to give key on write: ttl if given (0 meaning never), else the policy default.
+        """
+        if ttl is None:
+            return self.ttl_policy.for_key(key)[0]
+        return ttl or None
+
+    def _read_ttl(self, key: str, ttl: Optional[float]) -> Optional[float]:
+        """
+        The expiry to push back on read: ttl if given, else the policy one when sliding.
+        """
+        if ttl is not None:
+            return ttl or None
+        policy_ttl, sliding = self.ttl_policy.for_key(key)
+        return policy_ttl if sliding else None
+
+    def _entry(self, conn: sqlite3.Connection, key: str, now: float):
+        """
+        :return: (kind, value) of key, None if it does not exist or has expired.
+        """
+        row = conn.execute(
+            "SELECT kind, value, expires_at FROM entries WHERE ns = ? AND key = ?", (self.ns, key)
+        ).fetchone()
+        if row is None or (row[2] is not None and row[2] <= now):
+            return None
+        return row[0], row[1]
+
+    def _load(self, conn: sqlite3.Connection, key: str, kind: int, data: Optional[bytes]) -> Any:
+        if kind == RECORD:
+            return self._fields(conn, key, None)
+        if kind == LIST:
+            rows = conn.execute("SELECT value FROM items WHERE ns = ? AND key = ? ORDER BY pos", (self.ns, key))
+            return [self.serializer.loads(value) for value, in rows]
+        return self.serializer.loads(data)
+
+    def _fields(self, conn: sqlite3.Connection, key: str, fields: Optional[List[str]]) -> Dict[str, Any]:
+        if fields is None:
+            rows = conn.execute("SELECT field, value FROM fields WHERE ns = ? AND key = ?", (self.ns, key))
+        else:
+            rows = conn.execute(
+                "SELECT field, value FROM fields WHERE ns = ? AND key = ? AND field IN (%s)"
+                % ",".join("?" * len(fields)),
+                (self.ns, key, *fields),
+            )
+        return {field: self.serializer.loads(value) for field, value in rows}
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Any:
+        """
+        :param ttl: push the expiry of the key back to ttl seconds from now,
+                    defaults to the sliding TTL policy of the key if any.
+        """
+        log.debug("Get key: %s", self._label(key))
+        with self.db.snapshot() as conn:
+            entry = self._entry(conn, key, time.time())
+            if entry is None:
+                raise KeyError("%s doesn't exists." % self._label(key))
+            value = self._load(conn, key, *entry)
+        self._refresh(key, ttl)
+        return value
+
+    def kind(self, key: str) -> Optional[str]:
+        """
+        :return: what key holds, as the Redis type name ("string", "hash" or "list"),
+                 None if it does not exist.
+        """
+        entry = self._entry(self.db.connection(), key, time.time())
+        return KIND_NAMES[entry[0]] if entry is not None else None
+
+    def _refresh(self, key: str, ttl: Optional[float] = None) -> None:
+        ttl = self._read_ttl(key, ttl)
+        if ttl is not None:
+            self.expire(key, ttl)
+
+    def remove(self, key: str):
+        log.debug("Removing value at '%s'", self._label(key))
+        with self.batch() as batch:
+            batch.delete(key)
+        if not batch.results[0]:
+            raise KeyError("%s does not exist" % self._label(key))
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        :param ttl: expire the key after ttl seconds, 0 to never expire it,
+                    defaults to the TTL policy of the key.
+        """
+        with self.batch() as batch:
+            batch.set(key, value, ttl)
+
+    def expire(self, key: str, ttl: Optional[float]) -> bool:
+        """
+        Set the expiry of an existing key (value, record or list).
+        :param ttl: seconds from now, None or 0 to never expire it.
+        :return: False if the key does not exist.
+        """
+        with self.batch() as batch:
+            batch.expire(key, ttl)
+        return bool(batch.results[0])
+
+    def ttl(self, key: str) -> Optional[float]:
+        """
+        :return: the seconds left before key expires, None if it never does.
+        :raises KeyError: if the key does not exist.
+        """
+        now = time.time()
+        row = self.db.connection().execute(
+            "SELECT expires_at FROM entries WHERE ns = ? AND key = ?", (self.ns, key)
+        ).fetchone()
+        if row is None or (row[0] is not None and row[0] <= now):
+            raise KeyError("%s doesn't exists." % self._label(key))
+        return None if row[0] is None else row[0] - now
+
+    def _written(self, count: int) -> None:
+        self._writes += count
+        if self._writes >= PRUNE_EVERY:
+            self._writes = 0
+            self.prune_index()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get several keys with one query per few hundred keys.
+        :param keys: the keys to read.
+        :return: a dict of the keys found and their values, missing keys are left out.
+        """
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        with self.db.snapshot() as conn:
+            for chunk in _chunks(keys):
+                rows = conn.execute(
+                    "SELECT key, kind, value, expires_at FROM entries WHERE ns = ? AND key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    (self.ns, *chunk),
+                ).fetchall()
+                for key, kind, data, expires_at in rows:
+                    if expires_at is None or expires_at > now:
+                        found[key] = self._load(conn, key, kind, data)
+        refreshed = [(key, self._read_ttl(key, None)) for key in found]
+        refreshed = [(key, ttl) for key, ttl in refreshed if ttl is not None]
+        if refreshed:
+            with self.batch() as batch:
+                for key, ttl in refreshed:
+                    batch.expire(key, ttl)
+        log.debug("Get %d keys, %d found in '%s'", len(keys), len(found), self.ns)
+        return found
+
+    def set_many(self, mapping: Mapping[str, Any], ttl: Optional[float] = None) -> None:
+        """
+        Atomically set several keys in a single transaction.
+        :param mapping: the keys and their values.
+        :param ttl: as for set().
+        """
+        if not mapping:
+            return
+        with self.batch() as batch:
+            for key, value in mapping.items():
+                batch.set(key, value, ttl)
+        log.debug("Set %d keys in '%s'", len(mapping), self.ns)
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """
+        Atomically remove several keys in a single transaction. Unlike remove(),
+        missing keys are ignored.
+        :param keys: the keys to remove.
+        :return: the number of keys that existed.
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        with self.batch() as batch:
+            for key in keys:
+                batch.delete(key)
+        deleted = sum(batch.results)
+        log.debug("Removed %d of %d keys in '%s'", deleted, len(keys), self.ns)
+        return deleted
+
+    def batch(self) -> "SQLiteBatch":
+        """
+        Group writes (set, set_fields, append, delete, expire) into a single
+        transaction, applied when the with block exits without error.
+        """
+        return SQLiteBatch(self)
+
+    def get_fields(self, key: str, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Read a record stored with set_fields(). A dict stored whole with set() is
+        read the same way, so callers can migrate lazily.
+        :param key: the key of the record.
+        :param fields: the fields to read, all of them if None. Missing fields are left out.
+        :return: a dict of the fields and their values.
+        """
+        fields = list(fields) if fields is not None else None
+        with self.db.snapshot() as conn:
+            entry = self._entry(conn, key, time.time())
+            if entry is None:
+                raise KeyError("%s doesn't exists." % self._label(key))
+            kind, data = entry
+            record = self._fields(conn, key, fields) if kind == RECORD else self._load(conn, key, kind, data)
+        if not isinstance(record, dict):
+            raise TypeError("%s does not hold a record." % self._label(key))
+        if kind != RECORD and fields is not None:
+            record = {f: record[f] for f in fields if f in record}
+        self._refresh(key)
+        return record
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        """
+        Set some fields of a record, leaving the others untouched.
+        :param key: the key of the record.
+        :param mapping: the fields to set and their values.
+        :param replace: drop the fields that are not in mapping (or a value stored with set()).
+        :param ttl: as for set(); without TTL policy an existing expiry is kept.
+        """
+        with self.batch() as batch:
+            batch.set_fields(key, mapping, replace, ttl)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> int:
+        """
+        Append values to a list, without reading it.
+        :param key: the key of the list.
+        :param ttl: as for set_fields().
+        :return: the new length of the list.
+        """
+        with self.batch() as batch:
+            batch.append(key, *values, ttl=ttl)
+        return batch.results[0] if values else self.list_len(key)
+
+    def _list_len(self, conn: sqlite3.Connection, key: str) -> int:
+        entry = self._entry(conn, key, time.time())
+        if entry is None:
+            return 0
+        if entry[0] != LIST:
+            raise TypeError("%s does not hold a list." % self._label(key))
+        # Items are only ever appended, so positions are contiguous from 0.
+        (last,) = conn.execute("SELECT MAX(pos) FROM items WHERE ns = ? AND key = ?", (self.ns, key)).fetchone()
+        return 0 if last is None else last + 1
+
+    def get_range(self, key: str, start: int = 0, end: int = -1) -> List[Any]:
+        """
+        Read a slice of a list built with append(), both ends included, negative
+        indexes count from the end. A missing list reads as empty.
+        """
+        with self.db.snapshot() as conn:
+            length = self._list_len(conn, key)
+            start = max(start + length if start < 0 else start, 0)
+            end = min(end + length if end < 0 else end, length - 1)
+            if start > end:
+                return []
+            rows = conn.execute(
+                "SELECT value FROM items WHERE ns = ? AND key = ? AND pos BETWEEN ? AND ? ORDER BY pos",
+                (self.ns, key, start, end),
+            )
+            values = [self.serializer.loads(value) for value, in rows]
+        self._refresh(key)
+        return values
+
+    def list_len(self, key: str) -> int:
+        with self.db.snapshot() as conn:
+            return self._list_len(conn, key)
+
+    def prune_index(self) -> int:
+        """
+        Delete the expired keys of the namespace.
+        :return: the number of keys deleted.
+        """
+        with self.db.transaction() as conn:
+            expired = [
+                key
+                for key, in conn.execute(
+                    "SELECT key FROM entries WHERE ns = ? AND expires_at <= ?", (self.ns, time.time())
+                ).fetchall()
+            ]
+            for key in expired:
+                _delete(conn, self.ns, key)
+        if expired:
+            log.debug("Pruned %d expired keys of '%s'", len(expired), self.ns)
+        return len(expired)
+
+    def len(self):
+        (count,) = (
+            self.db.connection()
+            .execute(
+                "SELECT COUNT(*) FROM entries WHERE ns = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (self.ns, time.time()),
+            )
+            .fetchone()
+        )
+        return count
+
+    def keys(self):
+        keys = [
+            key
+            for key, in self.db.connection().execute(
+                "SELECT key FROM entries WHERE ns = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (self.ns, time.time()),
+            )
+        ]
+        log.debug("Keys: %s", keys)
+        return keys
+
+    def scan_keys(self, count: int = CHUNK_SIZE) -> Iterator[str]:
+        """
+        Iterate over the keys of the namespace by pages of count keys, without
+        holding a read transaction open between pages.
+        """
+        last = ""
+        conn = self.db.connection()
+        while True:
+            page = [
+                key
+                for key, in conn.execute(
+                    "SELECT key FROM entries WHERE ns = ? AND key > ? "
+                    "AND (expires_at IS NULL OR expires_at > ?) ORDER BY key LIMIT ?",
+                    (self.ns, last, time.time(), count),
+                )
+            ]
+            yield from page
+            if len(page) < count:
+                return
+            last = page[-1]
+
+    def close(self) -> None:
+        pass
+
+
+def _delete(conn: sqlite3.Connection, ns: str, key: str) -> int:
+    conn.execute("DELETE FROM fields WHERE ns = ? AND key = ?", (ns, key))
+    conn.execute("DELETE FROM items WHERE ns = ? AND key = ?", (ns, key))
+    return conn.execute("DELETE FROM entries WHERE ns = ? AND key = ?", (ns, key)).rowcount
+
+
+class SQLiteBatch:
+    """
+    Writes applied in a single transaction, see SQLiteStorage.batch(). The
+    results of the queued operations are in results once executed.
+    """
+
+    def __init__(self, storage: SQLiteStorage):
+        self._storage = storage
+        self._ops = []
+        self.results = []
+
+    def _queue(self, op: Callable[[sqlite3.Connection, float], Any]) -> None:
+        self._ops.append(op)
+
+    def _expires_at(self, ttl: Optional[float], now: float) -> Optional[float]:
+        return None if ttl is None else now + ttl
+
+    def _container(self, conn: sqlite3.Connection, key: str, kind: int, replace: bool, ttl, now: float) -> None:
+        # Create the record or list if needed. As SET in Redis, only a whole value
+        # write clears an expiry; adding fields or items keeps it unless ttl is set.
+        ns = self._storage.ns
+        entry = self._storage._entry(conn, key, now)
+        if entry is None or replace:
+            _delete(conn, ns, key)
+            conn.execute(
+                "INSERT INTO entries (ns, key, kind, value, expires_at) VALUES (?, ?, ?, NULL, ?)",
+                (ns, key, kind, self._expires_at(ttl, now)),
+            )
+        elif entry[0] != kind:
+            raise TypeError("%s holds another type of value." % self._storage._label(key))
+        elif ttl is not None:
+            conn.execute(
+                "UPDATE entries SET expires_at = ? WHERE ns = ? AND key = ?", (self._expires_at(ttl, now), ns, key)
+            )
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self._storage._resolve_ttl(key, ttl)
+        data = self._storage.serializer.dumps(value)
+        ns = self._storage.ns
+
+        def op(conn, now):
+            conn.execute("DELETE FROM fields WHERE ns = ? AND key = ?", (ns, key))
+            conn.execute("DELETE FROM items WHERE ns = ? AND key = ?", (ns, key))
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (ns, key, kind, value, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (ns, key, VALUE, data, self._expires_at(ttl, now)),
+            )
+
+        self._queue(op)
+
+    def set_fields(
+        self, key: str, mapping: Mapping[str, Any], replace: bool = False, ttl: Optional[float] = None
+    ) -> None:
+        ttl = self._storage._resolve_ttl(key, ttl)
+        dumps = self._storage.serializer.dumps
+        rows = [(self._storage.ns, key, field, dumps(value)) for field, value in mapping.items()]
+
+        def op(conn, now):
+            if not rows:
+                if replace:
+                    _delete(conn, self._storage.ns, key)
+                return
+            self._container(conn, key, RECORD, replace, ttl, now)
+            conn.executemany("INSERT OR REPLACE INTO fields (ns, key, field, value) VALUES (?, ?, ?, ?)", rows)
+
+        self._queue(op)
+
+    def append(self, key: str, *values: Any, ttl: Optional[float] = None) -> None:
+        ttl = self._storage._resolve_ttl(key, ttl)
+        dumps = self._storage.serializer.dumps
+        encoded = [dumps(value) for value in values]
+        ns = self._storage.ns
+
+        def op(conn, now):
+            if not encoded:
+                return None
+            self._container(conn, key, LIST, False, ttl, now)
+            (last,) = conn.execute("SELECT MAX(pos) FROM items WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            first = 0 if last is None else last + 1
+            conn.executemany(
+                "INSERT INTO items (ns, key, pos, value) VALUES (?, ?, ?, ?)",
+                [(ns, key, first + i, data) for i, data in enumerate(encoded)],
+            )
+            return first + len(encoded)
+
+        self._queue(op)
+
+    def expire(self, key: str, ttl: Optional[float]) -> None:
+        ns = self._storage.ns
+
+        def op(conn, now):
+            return conn.execute(
+                "UPDATE entries SET expires_at = ? WHERE ns = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (self._expires_at(ttl or None, now), ns, key, now),
+            ).rowcount
+
+        self._queue(op)
+
+    def delete(self, key: str) -> None:
+        ns = self._storage.ns
+
+        def op(conn, now):
+            live = self._storage._entry(conn, key, now) is not None
+            return int(_delete(conn, ns, key) > 0 and live)
+
+        self._queue(op)
+
+    def execute(self) -> List[Any]:
+        if not self._ops:
+            return []
+        now = time.time()
+        with self._storage.db.transaction() as conn:
+            self.results = [op(conn, now) for op in self._ops]
+        writes = len(self._ops)
+        self._ops = []
+        self._storage._written(writes)
+        return self.results
+
+    def __enter__(self) -> "SQLiteBatch":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.execute()
+        else:
+            self._ops = []
+
+
+class SQLitePlugin(StoragePluginBase):
+    def __init__(self, bot_config):
+        super().__init__(bot_config)
+        path = self._storage_config.get("path") or os.path.join(bot_config.BOT_DATA_DIR, DEFAULT_FILENAME)
+        self._db = Database(
+            path,
+            self._storage_config.get("mmap_size", DEFAULT_MMAP_SIZE),
+            self._storage_config.get("synchronous", "NORMAL"),
+        )
+        compression = self._storage_config.get("compression")
+        self._serializer = Serializer(
+            self._storage_config.get("codec", "auto"), make_compressor(compression) if compression else None
+        )
+        self._ttl_policies = {
+            namespace: TtlPolicy(rules) for namespace, rules in self._storage_config.get("ttl", {}).items()
+        }
+
+    def open(self, namespace: str) -> StorageBase:
+        return SQLiteStorage(self._db, namespace, self._serializer, self._ttl_policies.get(namespace))
+
+    def compression_stats(self):
+        """
+        Compression ratio and CPU time spent (de)compressing values, None when it is not configured.
+        """
+        compressor = self._serializer.compressor
+        return compressor.stats() if compressor is not None else None
@@ -0,0 +1,36 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+from fnmatch import fnmatchcase
+from typing import Any, Mapping, Optional, Tuple
+
+
+class TtlPolicy:
+    """
+    Default expiry of the keys of a namespace, from the 'ttl' section of
+    STORAGE_CONFIG: a mapping of key glob patterns to either a number of seconds,
+    applied on every write, or {'ttl': seconds, 'sliding': True} to also push the
+    expiry back on every read. The first matching pattern wins.
+    """
+
+    def __init__(self, rules: Optional[Mapping[str, Any]] = None):
+        self._rules = []
+        for pattern, rule in (rules or {}).items():
+            if isinstance(rule, Mapping):
+                ttl, sliding = rule["ttl"], rule.get("sliding", False)
+            else:
+                ttl, sliding = rule, False
+            if ttl is not None and ttl <= 0:
+                raise ValueError("TTL of '%s' must be a positive number of seconds." % pattern)
+            self._rules.append((pattern, ttl, sliding))
+
+    def for_key(self, key: str) -> Tuple[Optional[float], bool]:
+        """
+        :return: (ttl in seconds or None, whether reads refresh it) for key.
+        """
+        for pattern, ttl, sliding in self._rules:
+            if fnmatchcase(key, pattern):
+                return ttl, sliding
+        return None, False
+
+    def __bool__(self):
+        return bool(self._rules)